@@ -1,37 +1,155 @@
+import asyncio
+import time
 from datetime import timedelta
 
-import httpx
 from fastapi.logger import logger
 
-from app.config import get_current_time
-from app.db.firebase import database
+from app.bill.outbox import notification_outbox
+from app.config import (get_current_time, BILLING_CONCURRENCY, BILLING_WRITE_BATCH_SIZE, BILLING_WRITE_DELAY,
+                        BILLING_LEASE_TTL)
+from app.db.firebase import async_database
+from app.db.lease import Lease
+from app.db.write_behind import WriteBehind, WriteBehindError
+from app.electricity.registry import ProductRegistry
 from app.electricity.service import ElectricityUsageService
 
+BILLING_RUNS_ROOT = "billing_runs"
+
+# Newest bill of each product, as {"month": "YYYY-MM", **bill}
+LATEST_BILLS_ROOT = "electricity_bills_latest"
+
+
+def previous_month(moment) -> str:
+    """The month (YYYY-MM) before the month of moment"""
+    first_day_current_month = moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return (first_day_current_month - timedelta(days=1)).strftime("%Y-%m")
+
 
 async def calculate_monthly_bills_for_all_products():
     """Calculate bills for all products for the previous month"""
-    current_time = get_current_time()
-
-    # Get last month's details
-    first_day_current_month = current_time.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    last_day_last_month = first_day_current_month - timedelta(days=1)
-    last_month = last_day_last_month.strftime("%Y-%m")
+    return await calculate_monthly_bills(previous_month(get_current_time()))
+
+
+async def calculate_monthly_bills(month: str) -> bool:
+    """
+    Calculate bills for all products for a month (YYYY-MM). Returns whether
+    the month is completely billed.
+
+    Only the worker holding the month's billing lease runs it, so the job can
+    fire on every worker without billing twice.
+    """
+    async with Lease(f"billing-{month}", ttl=BILLING_LEASE_TTL) as lease:
+        if not lease.acquired:
+            logger.info(f"Billing for {month} is being run by another worker")
+            return False
+        return await run_billing(month, get_current_time(), lease)
+
+
+async def run_billing(last_month: str, current_time, lease: Lease = None) -> bool:
+    """
+    Bill every product for last_month.
+
+    Products are aggregated in parallel (at most BILLING_CONCURRENCY at once),
+    finished bills are written behind in multi-path batches of up to
+    BILLING_WRITE_BATCH_SIZE bills (or after BILLING_WRITE_DELAY seconds), and
+    each stored bill queues its notification in the outbox, which the
+    notification dispatcher delivers independently of the run.
+
+    Progress is checkpointed in billing_runs/{month}: each batch marks its
+    products done in the same write that stores their bills, so a crashed run
+    resumes with the remaining products and a finished run is not repeated.
+    A product that already has a bill for the month (billed before the
+    checkpoint existed, say) is only marked done: its bill, with its status
+    and payment, is kept and no notification is sent again.
+
+    When the run holds a lease that is lost (see Lease.check), nothing more
+    is written: batches not stored yet fail, and the run stops and stays
+    open for the worker that holds the lease now.
+    Returns whether every product is billed.
+    """
+    run_started = time.perf_counter()
+
+    checkpoint_path = f"{BILLING_RUNS_ROOT}/{last_month}"
+    checkpoint = await async_database.child(checkpoint_path).get() or {}
+    if checkpoint.get("status") == "completed":
+        logger.info(f"Bills for {last_month} were already calculated at {checkpoint.get('finished_at')}")
+        return True
 
     logger.info(f"Calculating bills for {last_month}")
 
-    # Get all product IDs from electricity_usage
-    usage_data = database.child("electricity_usage").get() or {}
-    product_ids = [pid for pid in usage_data.keys() if pid != "connection_status"]
-
-    for product_id in product_ids:
+    # Get all product IDs from the product registry and the meters writing
+    # directly, skipping those already billed
+    billed = checkpoint.get("products") or {}
+    product_ids = [pid for pid in await ProductRegistry.list_product_ids(complete=True) if pid not in billed]
+    if billed:
+        logger.info(f"Resuming billing for {last_month}: {len(billed)} products already billed")
+
+    await async_database.child(checkpoint_path).update({
+        "status": "running",
+        "started_at": checkpoint.get("started_at") or current_time.isoformat()
+    })
+
+    semaphore = asyncio.Semaphore(BILLING_CONCURRENCY)
+    timings = {}
+    failed = []
+    kept = []
+    # A bill, its latest-bill index entry and its checkpoint mark make up 3 paths
+    writer = WriteBehind(max_paths=BILLING_WRITE_BATCH_SIZE * 3, max_delay=BILLING_WRITE_DELAY,
+                         guard=lease.check if lease is not None else None)
+    stored_bills = []
+
+    async def calculate_bill(product_id):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                if await async_database.child(f"electricity_bills/{product_id}/{last_month}").get() is not None:
+                    kept.append(product_id)
+                    return product_id, None
+
+                # Calculate total kWh for the month
+                # Errors propagate, so the product stays unbilled for the next run
+                total_kwh = await ElectricityUsageService.compute_total_kwh_for_month(product_id, last_month)
+
+                # Calculate bill amount
+                bill_amount = ElectricityUsageService.calculate_billing_tiers(total_kwh)
+                return product_id, (total_kwh, bill_amount)
+            except Exception as e:
+                logger.error(f"Error calculating bill for product {product_id}: {str(e)}")
+                return product_id, None
+            finally:
+                timings[product_id] = time.perf_counter() - started
+
+    async def bill_stored(product_id, stored, total_kwh, bill_amount):
         try:
-            # Calculate total kWh for the month
-            total_kwh = ElectricityUsageService.calculate_total_kwh_for_month(product_id, last_month)
+            await stored
+        except WriteBehindError:
+            failed.append(product_id)
+            return
+        logger.info(f"Bill calculated for product {product_id} for {last_month}")
 
-            # Calculate bill amount
-            bill_amount = ElectricityUsageService.calculate_billing_tiers(total_kwh)
+        await queue_bill_notification(product_id, last_month, total_kwh, bill_amount)
 
-            # Save to electricity_bills node
+    async def bill_kept(product_id, stored):
+        try:
+            await stored
+        except WriteBehindError:
+            failed.append(product_id)
+
+    total = len(product_ids)
+    progress_step = max(1, total // 10)
+    completed = 0
+
+    tasks = [asyncio.create_task(calculate_bill(product_id)) for product_id in product_ids]
+    for task in asyncio.as_completed(tasks):
+        if lease is not None and lease.lost:
+            break
+        product_id, result = await task
+        if product_id in kept:
+            # Only the checkpoint mark is written; the bill stays as it is
+            stored = writer.submit({f"{checkpoint_path}/products/{product_id}": True})
+            stored_bills.append(asyncio.create_task(bill_kept(product_id, stored)))
+        elif result is not None:
+            total_kwh, bill_amount = result
             bill_data = {
                 "kw_value": total_kwh,
                 "amount": bill_amount,
@@ -39,21 +157,69 @@ async def calculate_monthly_bills_for_all_products():
                 "payment_date": None,
                 "calculated_at": current_time.isoformat()
             }
-
-            database.child(f"electricity_bills/{product_id}/{last_month}").set(bill_data)
-
-            # Notify external API
-            await notify_external_api(product_id, last_month , total_kwh , bill_amount )
-
-            logger.info(f"Bill calculated for product {product_id} for {last_month}")
-
-        except Exception as e:
-            logger.error(f"Error calculating bill for product {product_id}: {str(e)}")
-
-
-async def notify_external_api(product_id: str, month: str , total_kwh: float , bill_amount: float):
-    """Notify external API about new bill calculation"""
-    url = "https://tenantvolt-5cd875450cc3.herokuapp.com/api/bills/send-notification/"
+            # Save the bill to the electricity_bills node, refresh the
+            # latest-bill index and mark it done in the checkpoint, together
+            stored = writer.submit({
+                f"electricity_bills/{product_id}/{last_month}": bill_data,
+                f"{LATEST_BILLS_ROOT}/{product_id}": {"month": last_month, **bill_data},
+                f"{checkpoint_path}/products/{product_id}": True,
+            })
+            stored_bills.append(asyncio.create_task(
+                bill_stored(product_id, stored, total_kwh, bill_amount)
+            ))
+        else:
+            failed.append(product_id)
+
+        completed += 1
+        if completed % progress_step == 0 or completed == total:
+            logger.info(f"Billing progress for {last_month}: {completed}/{total} products "
+                        f"({completed * 100 // total}%)")
+
+    # Products still being computed when the lease was lost are left for the next run
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await writer.flush()
+    await asyncio.gather(*stored_bills)
+    if kept:
+        logger.info(f"Kept the existing bills of {len(kept)} products for {last_month}")
+
+    lost = lease is not None and lease.lost
+    if lost:
+        logger.error(f"Billing run for {last_month} stopped: its lease was lost")
+
+    # Leave the run open for a retry if any product failed
+    if not failed and not lost:
+        await async_database.child(checkpoint_path).update({
+            "status": "completed",
+            "finished_at": get_current_time().isoformat()
+        })
+
+    log_billing_summary(last_month, timings, failed, time.perf_counter() - run_started)
+    return not failed and not lost
+
+
+def log_billing_summary(month: str, timings: dict, failed: list, elapsed: float):
+    """Log how long the run and its products took"""
+    if not timings:
+        logger.info(f"Billing run for {month} finished in {elapsed:.2f}s with no products")
+        return
+
+    durations = sorted(timings.values())
+    p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+    logger.info(
+        f"Billing run for {month} finished in {elapsed:.2f}s: {len(timings)} products, "
+        f"{len(failed)} failed, per product mean={sum(durations) / len(durations):.3f}s "
+        f"p95={p95:.3f}s max={durations[-1]:.3f}s"
+    )
+
+    slowest = sorted(timings.items(), key=lambda item: item[1], reverse=True)[:5]
+    for product_id, duration in slowest:
+        logger.info(f"  slowest: {product_id} {duration:.3f}s")
+
+
+async def queue_bill_notification(product_id: str, month: str, total_kwh: float, bill_amount: float):
+    """Queue the notification of a new bill for the external API"""
     payload = {
         "product_id": product_id,
         "month": month,
@@ -62,8 +228,8 @@ async def notify_external_api(product_id: str, month: str , total_kwh: float , b
     }
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=payload)
-            response.raise_for_status()
+        # The key makes a resumed run queue each bill once, and lets the
+        # receiver recognize a notification delivered twice
+        await notification_outbox.put(f"bill-{product_id}-{month}", payload)
     except Exception as e:
-        logger.error(f"Failed to notify external API about bill for {product_id}: {str(e)}")
\ No newline at end of file
+        logger.error(f"Failed to queue notification of bill for {product_id}: {str(e)}")
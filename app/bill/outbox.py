@@ -0,0 +1,269 @@
+"""
+Durable outbox for bill notifications.
+
+The billing run used to POST each bill to BILL_NOTIFICATION_URL inline, over
+a fresh connection, and a failed notification was only logged. Bills now
+enqueue their notification into a SQLite outbox (OUTBOX_PATH) and move on;
+a background dispatcher in every worker drains it:
+
+    - over one pooled HTTP/2 client (HTTP/1.1 when the h2 package is missing)
+    - at most BILLING_NOTIFY_CONCURRENCY requests in flight
+    - each request carries an Idempotency-Key header, the key the
+      notification was enqueued under (bill-{product_id}-{YYYY-MM}), so a
+      repeat delivery can be recognized by the receiver and enqueueing the
+      same bill twice (a resumed run, say) stores it once
+    - failures are retried with exponential backoff and jitter, up to
+      OUTBOX_MAX_ATTEMPTS; after that, or on a 4xx answer other than 408 and
+      429, the notification is dead-lettered
+
+Workers sharing the outbox file claim notifications with a single UPDATE
+under their worker_id() (each forked worker has its own, and its own
+connection), so each one is sent by one of them; a claim left by a worker that died expires
+after OUTBOX_CLAIM_TIMEOUT seconds. Dead letters can be inspected and
+requeued with:
+
+    python -m app.bill.outbox stats
+    python -m app.bill.outbox dead
+    python -m app.bill.outbox retry-dead
+"""
+import argparse
+import asyncio
+import json
+import random
+import sqlite3
+import os
+import threading
+import time
+
+import httpx
+from fastapi.logger import logger
+
+from app.config import (BILL_NOTIFICATION_URL, BILLING_NOTIFY_CONCURRENCY, OUTBOX_PATH, OUTBOX_MAX_ATTEMPTS,
+                        OUTBOX_BACKOFF_BASE, OUTBOX_BACKOFF_MAX, OUTBOX_CLAIM_TIMEOUT, OUTBOX_POLL_INTERVAL)
+from app.db.lease import worker_id
+
+try:
+    import h2  # noqa: F401 - httpx needs it for HTTP/2
+    HTTP2 = True
+except ImportError:  # pragma: no cover - optional dependency
+    HTTP2 = False
+
+PENDING, SENDING, SENT, DEAD = "pending", "sending", "sent", "dead"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS notifications (
+    id INTEGER PRIMARY KEY,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    url TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    claimed_by TEXT,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notifications_due ON notifications (status, next_attempt_at);
+"""
+
+
+def backoff(attempts: int) -> float:
+    """Seconds before the next attempt after `attempts` failed ones, with jitter"""
+    delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def retryable(status_code: int) -> bool:
+    return status_code >= 500 or status_code in (408, 429)
+
+
+class NotificationOutbox:
+    def __init__(self, path: str = OUTBOX_PATH, concurrency: int = BILLING_NOTIFY_CONCURRENCY):
+        self.path = path
+        self.concurrency = concurrency
+        self._connection = None
+        self._connection_pid = None
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._dispatcher = None
+        self.client = None
+
+    @property
+    def worker(self) -> str:
+        """The claimed_by of this worker's claims"""
+        return worker_id()
+
+    # Storage
+
+    def _db(self) -> sqlite3.Connection:
+        # A connection inherited from the process that forked this one isn't used
+        if self._connection is None or self._connection_pid != os.getpid():
+            self._connection_pid = os.getpid()
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30,
+                                               isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def _execute(self, sql: str, parameters=()) -> list:
+        with self._lock:
+            return self._db().execute(sql, parameters).fetchall()
+
+    def enqueue(self, key: str, payload: dict, url: str = None) -> bool:
+        """Store a notification to send; False when one with this key exists already"""
+        url = url or BILL_NOTIFICATION_URL
+        if not url:
+            return False
+        now = time.time()
+        rows = self._execute(
+            "INSERT INTO notifications (idempotency_key, url, payload, status, next_attempt_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (idempotency_key) DO NOTHING RETURNING id",
+            (key, url, json.dumps(payload), PENDING, now, now, now)
+        )
+        return bool(rows)
+
+    async def put(self, key: str, payload: dict, url: str = None) -> bool:
+        """enqueue() off the event loop, waking the dispatcher"""
+        queued = await asyncio.to_thread(self.enqueue, key, payload, url)
+        if queued and self._wakeup is not None:
+            self._wakeup.set()
+        return queued
+
+    def claim(self, limit: int) -> list:
+        """Claim due notifications for this worker, as (id, key, url, payload, attempts)"""
+        now = time.time()
+        # Claims expire, so notifications held by a worker that died are sent again
+        return self._execute(
+            "UPDATE notifications SET status = ?, claimed_by = ?, next_attempt_at = ?, updated_at = ? "
+            "WHERE id IN (SELECT id FROM notifications WHERE status IN (?, ?) AND next_attempt_at <= ? "
+            "ORDER BY next_attempt_at LIMIT ?) "
+            "RETURNING id, idempotency_key, url, payload, attempts",
+            (SENDING, self.worker, now + OUTBOX_CLAIM_TIMEOUT, now, PENDING, SENDING, now, limit)
+        )
+
+    def finish(self, notification_id: int, attempts: int, error: str = None, retry: bool = True):
+        """Record an attempt: sent, scheduled again, or dead-lettered"""
+        now = time.time()
+        if error is None:
+            status, next_attempt_at = SENT, now
+        elif retry and attempts < OUTBOX_MAX_ATTEMPTS:
+            status, next_attempt_at = PENDING, now + backoff(attempts)
+        else:
+            status, next_attempt_at = DEAD, now
+        self._execute(
+            "UPDATE notifications SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, "
+            "claimed_by = NULL, updated_at = ? WHERE id = ? AND claimed_by = ?",
+            (status, attempts, next_attempt_at, error, now, notification_id, self.worker)
+        )
+        return status
+
+    def stats(self) -> dict:
+        counts = dict(self._execute("SELECT status, COUNT(*) FROM notifications GROUP BY status"))
+        return {status: counts.get(status, 0) for status in (PENDING, SENDING, SENT, DEAD)}
+
+    def dead_letters(self) -> list:
+        return self._execute(
+            "SELECT idempotency_key, attempts, last_error, updated_at FROM notifications "
+            "WHERE status = ? ORDER BY updated_at", (DEAD,)
+        )
+
+    def retry_dead(self) -> int:
+        """Queue every dead-lettered notification again. Returns how many."""
+        now = time.time()
+        rows = self._execute(
+            "UPDATE notifications SET status = ?, attempts = 0, next_attempt_at = ?, updated_at = ? "
+            "WHERE status = ? RETURNING id", (PENDING, now, now, DEAD)
+        )
+        return len(rows)
+
+    # Dispatch
+
+    def start(self):
+        """Start draining the outbox in the background"""
+        if self._dispatcher is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self.client = httpx.AsyncClient(
+            http2=HTTP2, timeout=30,
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        )
+        self._dispatcher = asyncio.create_task(self._dispatch())
+        logger.info(f"Notification outbox dispatcher started ({'HTTP/2' if HTTP2 else 'HTTP/1.1'})")
+
+    async def stop(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def drain(self):
+        """Send every notification that is due now"""
+        while await self._send_due():
+            pass
+
+    async def _dispatch(self):
+        while True:
+            try:
+                await self.drain()
+            except Exception as e:
+                logger.error(f"Notification outbox dispatch failed: {str(e)}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _send_due(self) -> int:
+        claimed = await asyncio.to_thread(self.claim, self.concurrency)
+        await asyncio.gather(*(self._send(*notification) for notification in claimed))
+        return len(claimed)
+
+    async def _send(self, notification_id: int, key: str, url: str, payload: str, attempts: int):
+        attempts += 1
+        error, retry = None, True
+        try:
+            response = await self.client.post(
+                url, content=payload,
+                headers={"Content-Type": "application/json", "Idempotency-Key": key}
+            )
+            if response.status_code >= 400:
+                error = f"HTTP {response.status_code}"
+                retry = retryable(response.status_code)
+        except httpx.HTTPError as e:
+            error = f"{type(e).__name__}: {str(e)}"
+
+        status = await asyncio.to_thread(self.finish, notification_id, attempts, error, retry)
+        if status == DEAD:
+            logger.error(f"Notification {key} dead-lettered after {attempts} attempt(s): {error}")
+        elif error:
+            logger.warning(f"Notification {key} failed (attempt {attempts}): {error}")
+
+
+notification_outbox = NotificationOutbox()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect the bill notification outbox")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="Count notifications by status")
+    subparsers.add_parser("dead", help="List dead-lettered notifications")
+    subparsers.add_parser("retry-dead", help="Queue dead-lettered notifications again")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "stats":
+        for status, count in notification_outbox.stats().items():
+            print(f"{status}: {count}")
+    elif args.command == "dead":
+        for key, attempts, error, updated_at in notification_outbox.dead_letters():
+            print(key, attempts, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(updated_at)), error)
+    else:
+        print(f"Requeued {notification_outbox.retry_dead()} notification(s)")
+
+
+if __name__ == "__main__":
+    main()
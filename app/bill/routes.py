@@ -1,76 +1,74 @@
 from fastapi import APIRouter, HTTPException
+import asyncio
 import logging
 
+from app.bill.bill_calculator import LATEST_BILLS_ROOT
 from app.bill.models import TenantsResponse, TenantsRequest, Tenant
-from app.db.firebase import database
+from app.config import LATEST_BILL_INDEX
+from app.db.firebase import async_database
 
 router = APIRouter()
 
+
+def bill_details(month, bill_data) -> dict:
+    """Bill details of a tenant in the response format, or a no_bill entry when month is None"""
+    if month is None:
+        return {
+            "month": None,
+            "amount": 0,
+            "kw_value": 0,
+            "status": "no_bill",
+            "payment_date": None,
+            "calculated_at": None
+        }
+
+    return {
+        "month": month,
+        "amount": bill_data.get("amount", 0),
+        "kw_value": bill_data.get("kw_value", 0),
+        "status": bill_data.get("status", "unknown"),
+        "payment_date": bill_data.get("payment_date", None),
+        "calculated_at": bill_data.get("calculated_at", None)
+    }
+
+
+async def get_latest_bill(product_id: str) -> dict:
+    """Bill details of the most recent month billed for a product"""
+    if LATEST_BILL_INDEX:
+        latest = await async_database.child(f"{LATEST_BILLS_ROOT}/{product_id}").get()
+        if isinstance(latest, dict) and latest.get("month"):
+            return bill_details(latest["month"], latest)
+
+    # Only the newest month is downloaded, however long the history is
+    latest_months = await async_database.child(f"electricity_bills/{product_id}").last(1)
+    if not isinstance(latest_months, dict) or not latest_months:
+        return bill_details(None, None)
+
+    latest_month = max(latest_months)
+    return bill_details(latest_month, latest_months[latest_month] or {})
+
+
 @router.post("/latest", response_model=TenantsResponse)
 async def get_latest_bill_details(request: TenantsRequest):
     """
     Get the latest bill details for each tenant's product ID by finding
     the most recent month in the electricity_bills/{product_id} directory
     """
-    response_tenants = []
-
-    for tenant in request.tenants:
+    async def lookup(tenant: Tenant) -> Tenant:
         tenant_data = tenant.dict()
         product_id = tenant.product_id
 
         try:
-            # Get all months available for this product_id
-            all_months_data = database.child(f"electricity_bills/{product_id}").get()
-
-            if all_months_data:
-                # Convert Firebase data to dictionary
-                if hasattr(all_months_data, 'val'):
-                    all_months = all_months_data.val()
-                else:
-                    all_months = all_months_data if isinstance(all_months_data, dict) else {}
-
-                # Find the latest month (highest value when sorted)
-                if all_months:
-                    latest_month = sorted(all_months.keys(), reverse=True)[0]
-                    bill_data = all_months[latest_month]
-
-                    tenant_data["bill_details"] = {
-                        "month": latest_month,
-                        "amount": bill_data.get("amount", 0),
-                        "kw_value": bill_data.get("kw_value", 0),
-                        "status": bill_data.get("status", "unknown"),
-                        "payment_date": bill_data.get("payment_date", None),
-                        "calculated_at": bill_data.get("calculated_at", None)
-                    }
-                else:
-                    # No months available
-                    tenant_data["bill_details"] = {
-                        "month": None,
-                        "amount": 0,
-                        "kw_value": 0,
-                        "status": "no_bill",
-                        "payment_date": None,
-                        "calculated_at": None
-                    }
-            else:
-                # No bill data at all
-                tenant_data["bill_details"] = {
-                    "month": None,
-                    "amount": 0,
-                    "kw_value": 0,
-                    "status": "no_bill",
-                    "payment_date": None,
-                    "calculated_at": None
-                }
-
-            response_tenants.append(Tenant(**tenant_data))
-
+            tenant_data["bill_details"] = await get_latest_bill(product_id)
         except Exception as e:
             logging.error(f"Error retrieving bill data for product {product_id}: {str(e)}")
             tenant_data["bill_details"] = {
                 "error": str(e),
                 "status": "error"
             }
-            response_tenants.append(Tenant(**tenant_data))
+        return Tenant(**tenant_data)
+
+    # Every tenant is looked up at the same time
+    response_tenants = await asyncio.gather(*(lookup(tenant) for tenant in request.tenants))
 
-    return TenantsResponse(tenants=response_tenants)
\ No newline at end of file
+    return TenantsResponse(tenants=list(response_tenants))
@@ -1,19 +1,145 @@
 import os
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Firebase configuration
-FIREBASE_URL = os.getenv("FIREBASE_URL")
-if not FIREBASE_URL:
-    raise ValueError("FIREBASE_URL environment variable is not set. This is required for Firebase operations.")
+# Database backend: "firebase" for the Realtime Database, "local" for the
+# in-memory stand-in used to run and benchmark the API offline
+DATABASE_BACKEND = os.getenv("DATABASE_BACKEND", "firebase")
 
+# Local backend: file the tree is persisted to (.json, or .db/.sqlite for
+# SQLite; empty keeps it in memory), and seconds of latency added to each call
+LOCAL_DB_PATH = os.getenv("LOCAL_DB_PATH", "")
+LOCAL_DB_LATENCY = float(os.getenv("LOCAL_DB_LATENCY", "0"))
+
+# Firebase configuration, checked by require_firebase_config() when the
+# Firebase backend is first used rather than on import
+FIREBASE_URL = os.getenv("FIREBASE_URL")
 FIREBASE_API_KEY = os.getenv("FIREBASE_API_KEY")
-if not FIREBASE_API_KEY:
-    raise ValueError("FIREBASE_API_KEY environment variable is not set. This is required for Firebase operations.")
+
+
+def require_firebase_config():
+    """Raise ValueError if a setting the Firebase backend needs is missing"""
+    if not FIREBASE_URL:
+        raise ValueError("FIREBASE_URL environment variable is not set. This is required for Firebase operations.")
+    if not FIREBASE_API_KEY:
+        raise ValueError("FIREBASE_API_KEY environment variable is not set. This is required for Firebase operations.")
+
+
+# Maximum number of Firebase calls in flight per worker, and the timeout in
+# seconds applied to each of them
+FIREBASE_MAX_CONCURRENCY = int(os.getenv("FIREBASE_MAX_CONCURRENCY", "16"))
+FIREBASE_TIMEOUT = float(os.getenv("FIREBASE_TIMEOUT", "60"))
+
+# Metrics of database calls (GET /metrics, Server-Timing); measuring payload
+# sizes serializes every result once more, so it is off unless diagnosing
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_PAYLOAD_SIZES = os.getenv("METRICS_PAYLOAD_SIZES", "false").lower() == "true"
+
+# History cache: memory budget in bytes, and how long data of the open
+# (current) period may be served from cache, in seconds
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_OPEN_TTL = float(os.getenv("CACHE_OPEN_TTL", "60"))
+
+# Monthly billing run: products computed in parallel, bills per multi-path
+# write (and seconds a finished bill may wait for its batch), and
+# notifications in flight at once
+BILLING_CONCURRENCY = int(os.getenv("BILLING_CONCURRENCY", "8"))
+BILLING_WRITE_BATCH_SIZE = int(os.getenv("BILLING_WRITE_BATCH_SIZE", "50"))
+BILLING_WRITE_DELAY = float(os.getenv("BILLING_WRITE_DELAY", "5"))
+BILLING_NOTIFY_CONCURRENCY = int(os.getenv("BILLING_NOTIFY_CONCURRENCY", "8"))
+
+# Write-behind batching of small writes (connection status heartbeats): most
+# paths per multi-path update, and seconds a write may wait for its batch
+WRITE_BEHIND_MAX_PATHS = int(os.getenv("WRITE_BEHIND_MAX_PATHS", "500"))
+WRITE_BEHIND_MAX_DELAY = float(os.getenv("WRITE_BEHIND_MAX_DELAY", "0.05"))
+
+# Endpoint notified of every new bill; empty disables the notifications
+# (for local runs and benchmarks)
+BILL_NOTIFICATION_URL = os.getenv(
+    "BILL_NOTIFICATION_URL", "https://tenantvolt-5cd875450cc3.herokuapp.com/api/bills/send-notification/"
+)
+
+# Outbox the notifications are queued in until delivered (SQLite, shared by
+# the workers of a machine): attempts before a notification is dead-lettered,
+# first retry delay and its cap in seconds, seconds a worker may hold a
+# claimed notification, and seconds between polls for due retries
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "notification_outbox.db")
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "5"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "3600"))
+OUTBOX_CLAIM_TIMEOUT = float(os.getenv("OUTBOX_CLAIM_TIMEOUT", "120"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+
+# Leases that keep scheduled jobs to a single worker: "firebase" coordinates
+# every node, "local" only the workers sharing LEASE_FILE on one machine
+LEASE_BACKEND = os.getenv("LEASE_BACKEND", "firebase")
+LEASE_FILE = os.getenv("LEASE_FILE", "/tmp/tenantvolt-leases.json")
+BILLING_LEASE_TTL = float(os.getenv("BILLING_LEASE_TTL", "300"))
+
+# Answer latest-bill lookups from the index the billing run maintains instead
+# of querying each product's bills; only enable it when payment updates keep
+# the index in step with electricity_bills
+LATEST_BILL_INDEX = os.getenv("LATEST_BILL_INDEX", "false").lower() == "true"
+
+# Largest number of readings accepted by one ingestion request
+INGEST_MAX_BATCH = int(os.getenv("INGEST_MAX_BATCH", "5000"))
+
+# Days a meter may hold readings back before writing them straight into its
+# raw hours. A period is only settled this long after it ends: rollups are
+# stored and cache entries kept for good for settled periods only, and the
+# packed encoding migration leaves younger days alone
+METER_BUFFER_DAYS = int(os.getenv("METER_BUFFER_DAYS", "7"))
+METER_BUFFER = timedelta(days=METER_BUFFER_DAYS)
+
+# Connection statuses served from memory: whether to keep a Firebase listener
+# on them, and the least seconds between two restarts of a listener whose
+# stream stopped (statuses are read from the database meanwhile)
+CONNECTION_STATUS_LISTENER = os.getenv("CONNECTION_STATUS_LISTENER", "true").lower() == "true"
+CONNECTION_STATUS_MAX_AGE = float(os.getenv("CONNECTION_STATUS_MAX_AGE", "90"))
+
+# Live usage streams: events buffered per subscriber before it is dropped as
+# too slow, and seconds between keep-alive comments on an idle stream
+LIVE_QUEUE_SIZE = int(os.getenv("LIVE_QUEUE_SIZE", "256"))
+LIVE_KEEPALIVE = float(os.getenv("LIVE_KEEPALIVE", "15"))
+
+# Batch chart requests: most queries accepted at once, and charts built concurrently
+CHART_BATCH_MAX = int(os.getenv("CHART_BATCH_MAX", "200"))
+CHART_BATCH_FANOUT = int(os.getenv("CHART_BATCH_FANOUT", "8"))
+
+# Chart responses of at least this many bytes are compressed (brotli or gzip)
+# when the client accepts it
+CHART_COMPRESS_MIN_BYTES = int(os.getenv("CHART_COMPRESS_MIN_BYTES", "4096"))
+
+# Cache-Control max-age of chart responses, in seconds, for settled periods
+# (revalidated by ETag once expired) and for younger ones, still in progress
+# or closed less than METER_BUFFER_DAYS ago
+CHART_CLOSED_MAX_AGE = int(os.getenv("CHART_CLOSED_MAX_AGE", "86400"))
+CHART_OPEN_MAX_AGE = int(os.getenv("CHART_OPEN_MAX_AGE", "60"))
+
+# Directory of the on-disk archive of settled months of minute readings
+# (python -m app.electricity.rollups archive); empty disables it
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", "")
+
+# Range charts: most points a client may ask for, and how many times that
+# many buckets the chosen resolution may hold before it gets coarser
+# (downsampling then picks the points to return among them)
+RANGE_MAX_POINTS = int(os.getenv("RANGE_MAX_POINTS", "5000"))
+RANGE_OVERSAMPLE = int(os.getenv("RANGE_OVERSAMPLE", "4"))
+
+# Cold start: prime the caches of the current month in the background as a
+# worker starts (this also connects the database backend), with at most
+# WARMUP_CONCURRENCY products at once
+WARMUP = os.getenv("WARMUP", "false").lower() == "true"
+WARMUP_CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", "4"))
+
+# Monthly billing scheduler: seconds before an incompletely billed month is
+# tried again, and the longest real-time sleep between two looks at the clock
+SCHEDULER_RETRY_DELAY = float(os.getenv("SCHEDULER_RETRY_DELAY", "600"))
+SCHEDULER_MAX_SLEEP = float(os.getenv("SCHEDULER_MAX_SLEEP", "3600"))
 
 import pytz
 from datetime import datetime, timedelta
@@ -30,18 +156,42 @@ class DebugTimeTracker:
     def __init__(self):
         self._debug_start_time = None
         self._start_real_time = None
+        self._speed = 1.0
         self._lock = threading.Lock()
+        self._listeners = []
 
-    def set_debug_time(self, time_str):
-        """Set the debug start time"""
+    def set_debug_time(self, time_str, speed=1.0):
+        """Set the debug start time, and how many times faster than real time it progresses"""
         with self._lock:
             if time_str:
                 naive_dt = datetime.strptime(time_str, "%Y-%m-%d %H:%M:%S")
                 self._debug_start_time = SRI_LANKA_TZ.localize(naive_dt)
                 self._start_real_time = datetime.now(SRI_LANKA_TZ)
+                self._speed = float(speed)
             else:
                 self._debug_start_time = None
                 self._start_real_time = None
+                self._speed = 1.0
+            listeners = list(self._listeners)
+
+        # Let those waiting for a moment of the clock (the scheduler) recompute
+        for listener in listeners:
+            listener()
+
+    def add_listener(self, callback):
+        """Call callback() whenever the debug time is set"""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._lock:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    def speed(self):
+        """Seconds of current time that pass per real second"""
+        with self._lock:
+            return self._speed if self._debug_start_time else 1.0
 
     def get_current_debug_time(self):
         """Get progressing debug time based on elapsed real time"""
@@ -52,8 +202,8 @@ class DebugTimeTracker:
             # Calculate elapsed time since we started using debug time
             elapsed = datetime.now(SRI_LANKA_TZ) - self._start_real_time
 
-            # Apply that elapsed time to the debug start time
-            return self._debug_start_time + elapsed
+            # Apply that elapsed time, sped up, to the debug start time
+            return self._debug_start_time + elapsed * self._speed
 
     def is_enabled(self):
         """Check if debug time is enabled"""
@@ -67,10 +217,14 @@ debug_time_tracker = DebugTimeTracker()
 # Example format: "2025-03-01 00:00:00"
 
 #DEBUG_START_TIME = "2025-03-01 00:00:00"
-DEBUG_START_TIME = None
+DEBUG_START_TIME = os.getenv("DEBUG_START_TIME") or None
+
+# How many times faster than real time debug time progresses, e.g. 3600 to
+# pass an hour per second when testing the scheduler
+DEBUG_TIME_SPEED = float(os.getenv("DEBUG_TIME_SPEED", "1"))
 
 # Initialize the debug time tracker with the initial value
-debug_time_tracker.set_debug_time(DEBUG_START_TIME)
+debug_time_tracker.set_debug_time(DEBUG_START_TIME, DEBUG_TIME_SPEED)
 
 
 def get_current_time():
@@ -86,12 +240,12 @@ def get_current_time():
     return datetime.now(SRI_LANKA_TZ)
 
 
-def set_debug_time(time_str):
+def set_debug_time(time_str, speed=1.0):
     """
     Set the debug time. Pass None to disable debug time and use real time.
     Format: "YYYY-MM-DD HH:MM:SS"
     """
-    debug_time_tracker.set_debug_time(time_str)
+    debug_time_tracker.set_debug_time(time_str, speed)
 
 
 def is_debug_time_enabled():
@@ -0,0 +1,186 @@
+"""
+Storage backends behind DatabaseReference.
+
+A backend performs the raw database operations on slash-separated paths
+("electricity_usage/product1/2025-03-14"), synchronously, one round trip per
+call. DatabaseReference (and its async wrapper) layer path chaining, round
+trip counting, caching and the executor on top, so every backend gets them.
+
+    FirebaseBackend   the production Realtime Database, through firebase_admin
+    LocalBackend      an in-memory tree, optionally persisted, for running
+                      and benchmarking the API offline (app.db.local)
+
+DATABASE_BACKEND selects which one create_backend() returns. The app's
+backend is a LazyBackend, which creates it on first use.
+"""
+import os
+import json
+import threading
+import time
+
+from fastapi.logger import logger
+
+from app.config import (DATABASE_BACKEND, FIREBASE_URL, FIREBASE_TIMEOUT, LOCAL_DB_PATH, LOCAL_DB_LATENCY,
+                        require_firebase_config)
+
+
+def split_path(path: str) -> list:
+    return [part for part in (path or "").split("/") if part]
+
+
+def join_path(*parts) -> str:
+    return "/".join(part for path in parts for part in split_path(path))
+
+
+class StorageBackend:
+    """Operations every backend implements; paths are relative to the database root"""
+
+    def get(self, path: str, shallow: bool = False):
+        """Value at path; with shallow, nested children are replaced by True"""
+        raise NotImplementedError
+
+    def set(self, path: str, value):
+        """Replace the value at path (None deletes it)"""
+        raise NotImplementedError
+
+    def update(self, path: str, data: dict):
+        """Write each child path of data under path in a single atomic update"""
+        raise NotImplementedError
+
+    def transaction(self, path: str, func):
+        """Atomically replace the value at path with func(current value) and return it"""
+        raise NotImplementedError
+
+    def range(self, path: str, start=None, end=None) -> dict:
+        """Children whose keys lie between start and end (inclusive), ordered by key"""
+        raise NotImplementedError
+
+    def last(self, path: str, count: int) -> dict:
+        """The count children with the highest keys, ordered by key"""
+        raise NotImplementedError
+
+    def listen(self, path: str, callback):
+        """
+        Call callback(event) for the current value at path and every change
+        to it; event has event_type ("put" or "patch"), path (relative to
+        the listened path) and data. Returns an object to close(), streaming
+        on its _thread. Keep-alives never reach the callback.
+        """
+        raise NotImplementedError
+
+
+# Get Firebase credentials from environment variable as JSON
+def get_firebase_credentials():
+    firebase_credentials_json = os.getenv("FIREBASE_CREDENTIALS_JSON")
+
+    if not firebase_credentials_json:
+        raise ValueError("FIREBASE_CREDENTIALS_JSON environment variable is not set")
+
+    try:
+        return json.loads(firebase_credentials_json)
+    except json.JSONDecodeError:
+        raise ValueError("Invalid FIREBASE_CREDENTIALS_JSON format")
+
+
+class FirebaseBackend(StorageBackend):
+    """Firebase Realtime Database through the firebase_admin SDK"""
+
+    def __init__(self):
+        import firebase_admin
+        from firebase_admin import credentials, db
+
+        require_firebase_config()
+
+        # Initialize Firebase Admin SDK with credentials from environment variables
+        cred = credentials.Certificate(get_firebase_credentials())
+        self.app = firebase_admin.initialize_app(cred, {
+            'databaseURL': FIREBASE_URL,
+            'httpTimeout': FIREBASE_TIMEOUT
+        })
+        self.db = db
+
+    def ref(self, path: str):
+        return self.db.reference("/" + join_path(path))
+
+    def get(self, path: str, shallow: bool = False):
+        return self.ref(path).get(shallow=shallow)
+
+    def set(self, path: str, value):
+        self.ref(path).set(value)
+
+    def update(self, path: str, data: dict):
+        self.ref(path).update(data)
+
+    def transaction(self, path: str, func):
+        return self.ref(path).transaction(func)
+
+    def range(self, path: str, start=None, end=None) -> dict:
+        query = self.ref(path).order_by_key()
+        if start is not None:
+            query = query.start_at(start)
+        if end is not None:
+            query = query.end_at(end)
+        return query.get() or {}
+
+    def last(self, path: str, count: int) -> dict:
+        return self.ref(path).order_by_key().limit_to_last(count).get() or {}
+
+    def listen(self, path: str, callback):
+        return self.ref(path).listen(callback)
+
+
+def create_backend() -> StorageBackend:
+    if DATABASE_BACKEND == "local":
+        from app.db.local import LocalBackend
+        return LocalBackend(LOCAL_DB_PATH, latency=LOCAL_DB_LATENCY)
+    if DATABASE_BACKEND == "firebase":
+        return FirebaseBackend()
+    raise ValueError(f"Unknown DATABASE_BACKEND {DATABASE_BACKEND!r}, expected 'firebase' or 'local'")
+
+
+def import_backend():
+    """
+    Import the modules of the configured backend without connecting to it,
+    so that a preloading gunicorn master shares them with its workers.
+    """
+    if DATABASE_BACKEND == "firebase":
+        import firebase_admin  # noqa: F401
+        from firebase_admin import credentials, db  # noqa: F401
+    elif DATABASE_BACKEND == "local":
+        import app.db.local  # noqa: F401
+
+
+class LazyBackend:
+    """
+    The backend create_backend() returns, created when it is first used.
+
+    Creating the Firebase backend parses the credentials and initializes the
+    firebase_admin app. Deferred, that happens in each worker (never in a
+    preloading gunicorn master, whose connections forked workers can't
+    share) once it first touches the database, and not on import.
+    """
+
+    def __init__(self, factory=create_backend):
+        self._factory = factory
+        self._backend = None
+        self._lock = threading.Lock()
+        self.init_seconds = None
+
+    @property
+    def backend(self) -> StorageBackend:
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    started = time.perf_counter()
+                    backend = self._factory()
+                    self.init_seconds = time.perf_counter() - started
+                    logger.info(f"Database backend {DATABASE_BACKEND} initialized in {self.init_seconds:.3f}s")
+                    self._backend = backend
+        return self._backend
+
+    @property
+    def initialized(self) -> bool:
+        return self._backend is not None
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
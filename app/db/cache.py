@@ -0,0 +1,155 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from app.config import get_current_time, CACHE_MAX_BYTES, CACHE_OPEN_TTL, METER_BUFFER
+
+
+# Most children of a container looked at when sizing a cache entry
+SIZE_SAMPLE = 8
+
+
+def estimate_size(value):
+    """Exact JSON size of a payload (serializes it, so costly for large ones)"""
+    try:
+        return len(json.dumps(value, separators=(",", ":"), default=str))
+    except (TypeError, ValueError):
+        return 0
+
+
+def approximate_size(value) -> int:
+    """
+    Approximate JSON size of a payload, the memory cost of a cache entry.
+    Containers with more than SIZE_SAMPLE children are sized from an even
+    sample of them, so a month of minute readings costs a few hundred
+    lookups instead of serializing it on the event loop.
+    """
+    if isinstance(value, dict):
+        items = list(value.items())
+        if not items:
+            return 2
+        sample = items[::-(-len(items) // SIZE_SAMPLE)]
+        sampled = sum(len(str(key)) + 4 + approximate_size(child) for key, child in sample)
+        return 1 + sampled * len(items) // len(sample)
+    if isinstance(value, list):
+        if not value:
+            return 2
+        sample = value[::-(-len(value) // SIZE_SAMPLE)]
+        sampled = sum(1 + approximate_size(child) for child in sample)
+        return 1 + sampled * len(value) // len(sample)
+    if isinstance(value, str):
+        return len(value) + 2
+    if isinstance(value, bool):
+        return 4 if value else 5
+    if value is None:
+        return 4
+    return len(str(value))
+
+
+class HistoryCache:
+    """
+    Read-through cache for database payloads, bounded by size with LRU eviction.
+
+    Every entry records when the period of the data it holds closes. Meters
+    may still write readings they held back for METER_BUFFER_DAYS after that,
+    so only entries of periods that closed longer ago never expire; entries
+    of the open period, or of one closed more recently, live for open_ttl
+    seconds. Cached values are shared between callers and must be treated
+    as read-only.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, open_ttl=CACHE_OPEN_TTL):
+        self.max_bytes = max_bytes
+        self.open_ttl = open_ttl
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Bumped on every invalidation, so reads that started before one
+        # don't cache what they fetched
+        self.generation = 0
+
+    def get(self, key):
+        """Return (found, value) for a key, counting the hit or miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, size, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                self._remove(key)
+
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value, closes_at, generation=None):
+        """
+        Cache a value. closes_at is the moment the period of the underlying
+        data closed (or will close); the data is immutable METER_BUFFER_DAYS
+        later. When generation is given and the cache has been
+        invalidated since, the value may be stale and is not cached.
+        """
+        if generation is not None and generation != self.generation:
+            return
+
+        size = approximate_size(value)
+        if size > self.max_bytes:
+            return
+
+        expires_at = None
+        if closes_at + METER_BUFFER > get_current_time():
+            expires_at = time.monotonic() + self.open_ttl
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expires_at)
+            self._bytes += size
+
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, path=""):
+        """
+        Drop every entry read at, above or below a database path, e.g. after
+        late-arriving data or a write. An empty path clears the cache.
+        """
+        path = path.strip("/")
+        with self._lock:
+            self.generation += 1
+            for key in list(self._entries):
+                cached_path = key[0]
+                if (
+                    not path or not cached_path or cached_path == path
+                    or cached_path.startswith(path + "/")
+                    or path.startswith(cached_path + "/")
+                ):
+                    self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
+# Cache shared by all database reads in this worker
+usage_cache = HistoryCache()
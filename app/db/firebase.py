@@ -1,47 +1,231 @@
-import os
-import json
-import firebase_admin
-from firebase_admin import credentials, db
-from app.config import FIREBASE_URL
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
 
+from app.config import FIREBASE_MAX_CONCURRENCY, FIREBASE_TIMEOUT, METRICS_ENABLED
+from app.db import metrics
+from app.db.backend import LazyBackend, join_path
+from app.db.cache import usage_cache
 
-# Get Firebase credentials from environment variable as JSON
-def get_firebase_credentials():
-    firebase_credentials_json = os.getenv("FIREBASE_CREDENTIALS_JSON")
 
-    if not firebase_credentials_json:
-        raise ValueError("FIREBASE_CREDENTIALS_JSON environment variable is not set")
+# Firebase, or the local stand-in when DATABASE_BACKEND is "local", created
+# on first use
+storage_backend = LazyBackend()
 
-    try:
-        return json.loads(firebase_credentials_json)
-    except json.JSONDecodeError:
-        raise ValueError("Invalid FIREBASE_CREDENTIALS_JSON format")
 
+class RoundTripCounter:
+    """Thread-safe count of network round trips made through DatabaseReference"""
 
-# Initialize Firebase Admin SDK with credentials from environment variables
-cred = credentials.Certificate(get_firebase_credentials())
-firebase_app = firebase_admin.initialize_app(cred, {
-    'databaseURL': FIREBASE_URL
-})
+    def __init__(self):
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def increment(self):
+        with self._lock:
+            self._count += 1
+
+    def reset(self):
+        with self._lock:
+            self._count = 0
+
+    @property
+    def count(self):
+        return self._count
+
+
+round_trips = RoundTripCounter()
+
+
+def instrumented(method):
+    """Count a DatabaseReference method's calls as round trips and record their metrics"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        round_trips.increment()
+        if not METRICS_ENABLED:
+            return method(self, *args, **kwargs)
+
+        started = time.perf_counter()
+        try:
+            result = method(self, *args, **kwargs)
+        except Exception:
+            metrics.record(method.__name__, self.path, time.perf_counter() - started, failed=True)
+            raise
+        metrics.record(method.__name__, self.path, time.perf_counter() - started, result)
+        return result
+    return wrapper
 
 
 # Helper class to wrap Firebase Realtime Database operations with chaining
 class DatabaseReference:
-    def __init__(self, ref=None):
-        self.ref = ref if ref else db.reference()
+    def __init__(self, path="", backend=None):
+        self.path = join_path(path)
+        self.backend = backend if backend else storage_backend
 
     def child(self, path):
-        return DatabaseReference(self.ref.child(path))
+        return DatabaseReference(join_path(self.path, path), self.backend)
 
+    @instrumented
     def get(self):
-        return self.ref.get()
+        return self.backend.get(self.path)
 
+    @instrumented
     def set(self, data):
-        self.ref.set(data)
+        self.backend.set(self.path, data)
 
+    @instrumented
     def update(self, data):
-        self.ref.update(data)
+        self.backend.update(self.path, data)
+
+    @instrumented
+    def transaction(self, func):
+        """Atomically replace this node with func(current value), retrying on contention"""
+        return self.backend.transaction(self.path, func)
+
+    @instrumented
+    def keys(self):
+        """List the child keys only, without downloading their values"""
+        children = self.backend.get(self.path, shallow=True)
+        return sorted(children.keys()) if isinstance(children, dict) else []
+
+    @instrumented
+    def range(self, start=None, end=None, shallow=False):
+        """
+        Read the children whose keys fall between start and end (inclusive)
+        in a single request, ordered by key.
+
+        With shallow=True only the keys are fetched (values are replaced by
+        True), which is enough to find out which children exist.
+        """
+        if shallow:
+            # The REST API doesn't combine shallow reads with ordering, so the
+            # key bounds are applied locally on the (small) key listing
+            keys = self.backend.get(self.path, shallow=True) or {}
+            return {
+                key: value for key, value in sorted(keys.items())
+                if (start is None or key >= start) and (end is None or key <= end)
+            }
+
+        return self.backend.range(self.path, start, end)
+
+    @instrumented
+    def listen(self, callback):
+        """
+        Call callback(event) from a background thread for the current value of
+        this node and every change to it. Returns a registration to close().
+        """
+        return self.backend.listen(self.path, callback)
+
+    @instrumented
+    def last(self, count=1):
+        """Read the count children with the highest keys, ordered by key"""
+        return self.backend.last(self.path, count)
 
 
 # Database reference wrapper
-database = DatabaseReference()
\ No newline at end of file
+database = DatabaseReference()
+
+
+# Bounded pool the blocking firebase_admin calls run on, so they never block the event loop
+executor = ThreadPoolExecutor(max_workers=FIREBASE_MAX_CONCURRENCY, thread_name_prefix="firebase")
+
+# Reads currently on the wire, keyed like usage_cache entries
+in_flight_reads = {}
+
+
+class AsyncDatabaseReference:
+    """
+    Awaitable counterpart of DatabaseReference.
+
+    Each call runs on the bounded firebase executor, so at most
+    FIREBASE_MAX_CONCURRENCY calls are in flight per worker and other requests
+    keep being served while they wait. Calls taking longer than
+    FIREBASE_TIMEOUT seconds raise asyncio.TimeoutError.
+
+    Reads given a closes_at time (the moment the data stops changing) go
+    through usage_cache; writes invalidate the cached entries they touch.
+    Concurrent identical reads share a single request.
+    """
+
+    def __init__(self, reference=None):
+        self.reference = reference if reference else DatabaseReference()
+
+    @property
+    def path(self):
+        return self.reference.path
+
+    def child(self, path):
+        return AsyncDatabaseReference(self.reference.child(path))
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # The executor doesn't carry context variables over, and metrics
+        # need to know which route or job made the call
+        context = contextvars.copy_context()
+        return await asyncio.wait_for(
+            loop.run_in_executor(executor, partial(context.run, func, *args, **kwargs)),
+            timeout=FIREBASE_TIMEOUT
+        )
+
+    async def _cached(self, key, closes_at, func, *args, **kwargs):
+        if closes_at is not None:
+            found, value = usage_cache.get(key)
+            if found:
+                return value
+
+        # Identical reads already on the wire are shared instead of repeated
+        pending = in_flight_reads.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._fetch(key, closes_at, func, *args, **kwargs))
+            in_flight_reads[key] = pending
+            pending.add_done_callback(
+                lambda done: in_flight_reads.pop(key) if in_flight_reads.get(key) is done else None
+            )
+        # Shielded so that one cancelled caller doesn't cancel the read for the others
+        return await asyncio.shield(pending)
+
+    async def _fetch(self, key, closes_at, func, *args, **kwargs):
+        generation = usage_cache.generation
+        value = await self._run(func, *args, **kwargs)
+        if closes_at is not None:
+            usage_cache.put(key, value, closes_at, generation=generation)
+        return value
+
+    async def get(self, closes_at=None):
+        return await self._cached((self.path, "get"), closes_at, self.reference.get)
+
+    async def set(self, data):
+        usage_cache.invalidate(self.path)
+        await self._run(self.reference.set, data)
+        usage_cache.invalidate(self.path)
+
+    async def update(self, data):
+        # Multi-path updates only invalidate the paths they write
+        paths = [f"{self.path}/{key}" for key in data] or [self.path]
+        for path in paths:
+            usage_cache.invalidate(path)
+        await self._run(self.reference.update, data)
+        for path in paths:
+            usage_cache.invalidate(path)
+
+    async def transaction(self, func):
+        usage_cache.invalidate(self.path)
+        return await self._run(self.reference.transaction, func)
+
+    async def keys(self, closes_at=None):
+        return await self._cached((self.path, "keys"), closes_at, self.reference.keys)
+
+    async def range(self, start=None, end=None, shallow=False, closes_at=None):
+        return await self._cached(
+            (self.path, "range", start, end, shallow), closes_at,
+            self.reference.range, start, end, shallow=shallow
+        )
+
+    async def last(self, count=1, closes_at=None):
+        return await self._cached((self.path, "last", count), closes_at, self.reference.last, count)
+
+
+# Async database reference wrapper
+async_database = AsyncDatabaseReference(database)
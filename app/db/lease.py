@@ -0,0 +1,187 @@
+import asyncio
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from fastapi.logger import logger
+
+from app.config import LEASE_BACKEND, LEASE_FILE
+from app.db.firebase import async_database
+
+LEASE_ROOT = "scheduler_leases"
+
+_worker = (None, None)  # (pid, id) of the process worker_id() was computed in
+
+
+def worker_id() -> str:
+    """
+    Identifies this worker process as a lease owner. Computed on first use in
+    each process, so workers forked from a preloading master get their own.
+    """
+    global _worker
+    pid, owner = _worker
+    if pid != os.getpid():
+        owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        _worker = (os.getpid(), owner)
+    return owner
+
+
+class LeaseLostError(Exception):
+    """The lease a worker was holding has expired or been taken over"""
+
+
+def claim(current, owner: str, ttl: float, now: float):
+    """
+    Return the lease record owner should write over current, or None when
+    another owner still holds an unexpired lease.
+    """
+    if current and current.get("owner") != owner and current.get("expires_at", 0) > now:
+        return None
+    return {"owner": owner, "expires_at": now + ttl}
+
+
+class FirebaseLeaseStore:
+    """Leases stored under scheduler_leases/{name}, claimed with a transaction"""
+
+    async def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        def update(current):
+            # Returning the current value unchanged leaves another owner's lease alone
+            return claim(current, owner, ttl, time.time()) or current
+
+        result = await async_database.child(f"{LEASE_ROOT}/{name}").transaction(update)
+        return bool(result) and result.get("owner") == owner
+
+    async def release(self, name: str, owner: str):
+        def update(current):
+            if current and current.get("owner") == owner:
+                return None
+            return current
+
+        await async_database.child(f"{LEASE_ROOT}/{name}").transaction(update)
+
+
+class LocalLeaseStore:
+    """
+    Leases kept in memory, or in a JSON file guarded by flock so that every
+    worker process on the same machine shares them. Also the stand-in store
+    for running without Firebase.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def _modify(self, func):
+        with self._lock:
+            if not self.path:
+                return func(self._leases)
+
+            with open(self.path, "a+") as lease_file:
+                fcntl.flock(lease_file, fcntl.LOCK_EX)
+                lease_file.seek(0)
+                content = lease_file.read()
+                leases = json.loads(content) if content else {}
+                result = func(leases)
+                lease_file.seek(0)
+                lease_file.truncate()
+                json.dump(leases, lease_file)
+                return result
+
+    async def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        def update(leases):
+            record = claim(leases.get(name), owner, ttl, time.time())
+            if record is None:
+                return False
+            leases[name] = record
+            return True
+
+        return self._modify(update)
+
+    async def release(self, name: str, owner: str):
+        def update(leases):
+            if leases.get(name, {}).get("owner") == owner:
+                del leases[name]
+
+        self._modify(update)
+
+
+def create_lease_store():
+    if LEASE_BACKEND == "local":
+        return LocalLeaseStore(LEASE_FILE)
+    return FirebaseLeaseStore()
+
+
+lease_store = create_lease_store()
+
+
+class Lease:
+    """
+    Async context manager holding a named lease for as long as the block runs.
+
+    The lease is renewed in the background every ttl / 3 seconds and released
+    on exit; if the worker dies it expires after ttl seconds. Check `acquired`
+    inside the block, since another worker may already hold it:
+
+        async with Lease("billing-2025-03", ttl=300) as lease:
+            if not lease.acquired:
+                return
+
+    A renewal can find the lease taken over (after a long pause, say), or
+    fail for as long as ttl, after which another worker may hold it. `lost`
+    is then set, and check() raises LeaseLostError, so that work done under
+    the lease can stop before it writes anything more.
+    """
+
+    def __init__(self, name: str, ttl: float, store=None, owner: str = None):
+        self.name = name
+        self.ttl = ttl
+        self.store = store or lease_store
+        self.owner = owner or worker_id()
+        self.acquired = False
+        self.lost = False
+        self._renewal = None
+        self._renewed_at = None
+
+    def check(self):
+        """Raise LeaseLostError unless the lease is still held"""
+        if not self.acquired or self.lost:
+            raise LeaseLostError(f"Lease {self.name} is not held by {self.owner}")
+
+    async def __aenter__(self):
+        self._renewed_at = time.monotonic()
+        self.acquired = await self.store.acquire(self.name, self.owner, self.ttl)
+        if self.acquired:
+            self._renewal = asyncio.create_task(self._renew())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._renewal:
+            self._renewal.cancel()
+        if self.acquired:
+            try:
+                await self.store.release(self.name, self.owner)
+            except Exception as e:
+                logger.error(f"Failed to release lease {self.name}: {str(e)}")
+        return False
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            attempted_at = time.monotonic()
+            try:
+                if not await self.store.acquire(self.name, self.owner, self.ttl):
+                    logger.error(f"Lost lease {self.name} to another worker")
+                    self.lost = True
+                    return
+                self._renewed_at = attempted_at
+            except Exception as e:
+                logger.error(f"Failed to renew lease {self.name}: {str(e)}")
+                if time.monotonic() - self._renewed_at >= self.ttl:
+                    logger.error(f"Lease {self.name} expired while it couldn't be renewed")
+                    self.lost = True
+                    return
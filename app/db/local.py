@@ -0,0 +1,281 @@
+"""
+Local stand-in for the Firebase Realtime Database.
+
+LocalBackend keeps the whole database as one in-memory JSON tree and follows
+the Realtime Database semantics the service relies on: writing None deletes
+a node, empty nodes disappear, multi-path updates are atomic, keys are
+ordered like Firebase orders them, and listeners receive put events.
+
+The tree can be persisted to LOCAL_DB_PATH:
+
+    *.json                  the whole tree, rewritten after every write
+                            (fine for small datasets)
+    *.db, *.sqlite(3)       one SQLite row per leaf, updated incrementally
+
+and every call can be delayed by LOCAL_DB_LATENCY seconds, to run the API on
+a laptop with realistic round-trip costs. Calls already run on the database
+executor, so the delay occupies a worker thread just like a network call.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from fastapi.logger import logger
+
+from app.db.backend import StorageBackend, split_path, join_path
+
+
+def clone(value):
+    """Copy a value the way it would travel over the wire"""
+    return json.loads(json.dumps(value))
+
+
+def prune(value):
+    """Drop None children and empty nodes, which Firebase doesn't store"""
+    if isinstance(value, dict):
+        pruned = {str(key): prune(child) for key, child in value.items()}
+        pruned = {key: child for key, child in pruned.items() if child is not None}
+        return pruned or None
+    return value
+
+
+def key_order(key: str):
+    """Firebase orders integer keys numerically, before all other keys"""
+    if key.isdigit() and (key == "0" or not key.startswith("0")):
+        return 0, int(key), ""
+    return 1, 0, key
+
+
+def leaves(path: str, value):
+    """(path, value) of every leaf under a node, lists counting as leaves"""
+    if isinstance(value, dict):
+        for key, child in value.items():
+            yield from leaves(join_path(path, key), child)
+    elif value is not None:
+        yield path, value
+
+
+class LocalEvent:
+    def __init__(self, event_type: str, path: str, data):
+        self.event_type = event_type
+        self.path = path
+        self.data = data
+
+
+class LocalListener:
+    """A listener registration; close() stops its events"""
+
+    def __init__(self, backend, parts: list, callback):
+        self.backend = backend
+        self.parts = parts
+        self.callback = callback
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="local-listener")
+        self._thread.start()
+
+    def _run(self):
+        # Like firebase_admin's listener thread: an initial snapshot, then
+        # it runs until closed. Firebase's keep-alives never reach callbacks
+        # (firebase_admin drops events without data), so none are sent.
+        self.deliver(LocalEvent("put", "/", self.backend.read(self.parts)))
+        self._closed.wait()
+
+    def deliver(self, event):
+        if self._closed.is_set():
+            return
+        try:
+            self.callback(event)
+        except Exception as e:
+            logger.error(f"Listener on {'/'.join(self.parts)} failed: {str(e)}")
+
+    def close(self):
+        self._closed.set()
+        self.backend.remove_listener(self)
+
+
+class LocalBackend(StorageBackend):
+    def __init__(self, path: str = None, latency: float = 0.0):
+        self.path = path or None
+        self.latency = latency
+        self.root = {}
+        self.listeners = []
+        self._lock = threading.RLock()
+        self._sqlite = None
+
+        if self.path and self.path.endswith(".json"):
+            if os.path.exists(self.path):
+                with open(self.path) as tree_file:
+                    self.root = prune(json.load(tree_file)) or {}
+        elif self.path:
+            self._sqlite = sqlite3.connect(self.path, check_same_thread=False)
+            self._sqlite.execute("CREATE TABLE IF NOT EXISTS nodes (path TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            for leaf_path, value in self._sqlite.execute("SELECT path, value FROM nodes"):
+                self._write(split_path(leaf_path), json.loads(value))
+
+        logger.info(f"Local database backend ready ({self.path or 'in memory'}, {latency * 1000:.0f} ms per call)")
+
+    # StorageBackend
+
+    def get(self, path: str, shallow: bool = False):
+        self._wait()
+        value = self.read(split_path(path))
+        if shallow and isinstance(value, dict):
+            return {key: True if isinstance(child, (dict, list)) else child for key, child in value.items()}
+        return value
+
+    def set(self, path: str, value):
+        self._wait()
+        self._apply({join_path(path): value})
+
+    def update(self, path: str, data: dict):
+        self._wait()
+        self._apply({join_path(path, key): value for key, value in data.items()})
+
+    def transaction(self, path: str, func):
+        self._wait()
+        parts = split_path(path)
+        with self._lock:
+            value = prune(clone(func(self.read(parts))))
+            self._apply({join_path(path): value})
+        return clone(value)
+
+    def range(self, path: str, start=None, end=None) -> dict:
+        self._wait()
+        children = self._children(split_path(path))
+        return {
+            key: children[key] for key in sorted(children, key=key_order)
+            if (start is None or key_order(key) >= key_order(start))
+            and (end is None or key_order(key) <= key_order(end))
+        }
+
+    def last(self, path: str, count: int) -> dict:
+        self._wait()
+        children = self._children(split_path(path))
+        keys = sorted(children, key=key_order)[-count:] if count > 0 else []
+        return {key: children[key] for key in keys}
+
+    def listen(self, path: str, callback):
+        self._wait()
+        listener = LocalListener(self, split_path(path), callback)
+        with self._lock:
+            self.listeners.append(listener)
+        return listener
+
+    def remove_listener(self, listener):
+        with self._lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    # Tree
+
+    def read(self, parts: list):
+        with self._lock:
+            return clone(self._node(parts))
+
+    def _wait(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _node(self, parts: list):
+        node = self.root
+        for part in parts:
+            if isinstance(node, dict):
+                node = node.get(part)
+            elif isinstance(node, list) and part.isdigit() and int(part) < len(node):
+                node = node[int(part)]
+            else:
+                return None
+        return node
+
+    def _children(self, parts: list) -> dict:
+        node = self.read(parts)
+        if isinstance(node, list):
+            return {str(index): value for index, value in enumerate(node) if value is not None}
+        return node if isinstance(node, dict) else {}
+
+    def _apply(self, writes: dict):
+        """Write {path: value} atomically, persist it and notify listeners"""
+        writes = {path: prune(clone(value)) for path, value in writes.items()}
+        with self._lock:
+            for path, value in writes.items():
+                self._write(split_path(path), value)
+            self._persist(writes)
+            events = [
+                (listener, event) for listener in self.listeners
+                for path, value in writes.items()
+                for event in [self._event(listener.parts, split_path(path), value)] if event
+            ]
+
+        # Listeners run outside the lock so that they may read the database
+        for listener, event in events:
+            listener.deliver(event)
+
+    def _event(self, listened: list, written: list, value):
+        if written[:len(listened)] == listened:
+            relative = written[len(listened):]
+            return LocalEvent("put", "/" + "/".join(relative), clone(value))
+        if listened[:len(written)] == written:
+            return LocalEvent("put", "/", clone(self._node(listened)))
+        return None
+
+    def _write(self, parts: list, value):
+        if not parts:
+            self.root = value if isinstance(value, dict) else {}
+            return
+
+        # Walk down, turning lists and leaves on the way into objects
+        node = self.root
+        trail = []
+        for part in parts[:-1]:
+            child = node.get(part)
+            if isinstance(child, list):
+                child = {str(index): item for index, item in enumerate(child) if item is not None}
+            elif not isinstance(child, dict):
+                child = {}
+            node[part] = child
+            trail.append((node, part))
+            node = child
+
+        if value is None:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = value
+
+        # Nodes left empty disappear
+        for parent, part in reversed(trail):
+            if parent[part]:
+                break
+            del parent[part]
+
+    def _persist(self, writes: dict):
+        if not self.path:
+            return
+
+        if self._sqlite is None:
+            temporary = f"{self.path}.tmp"
+            with open(temporary, "w") as tree_file:
+                json.dump(self.root, tree_file, separators=(",", ":"))
+            os.replace(temporary, self.path)
+            return
+
+        with self._sqlite:
+            for path, value in writes.items():
+                path = join_path(path)
+                parts = split_path(path)
+                # The node itself, what was below it, and any leaf it now sits under
+                ancestors = ["/".join(parts[:index]) for index in range(1, len(parts))]
+                if path:
+                    # "0" is the character after "/", so this covers every path below
+                    self._sqlite.execute(
+                        "DELETE FROM nodes WHERE path = ? OR (path > ? AND path < ?)",
+                        (path, path + "/", path + "0")
+                    )
+                else:
+                    self._sqlite.execute("DELETE FROM nodes")
+                self._sqlite.executemany("DELETE FROM nodes WHERE path = ?", [(ancestor,) for ancestor in ancestors])
+                self._sqlite.executemany(
+                    "INSERT OR REPLACE INTO nodes (path, value) VALUES (?, ?)",
+                    [(leaf_path, json.dumps(leaf)) for leaf_path, leaf in leaves(path, value)]
+                )
@@ -0,0 +1,213 @@
+"""
+Database call metrics.
+
+Every DatabaseReference call records its latency and the size of what it
+returned in Prometheus histograms, labelled with:
+
+    operation   the route ("GET /electricity/daily/{product_id}/{year_month}")
+                or scheduler job ("job:monthly_billing") that made the call
+    method      get, update, range, ...
+    path        the database path as a pattern, e.g. electricity_usage/*/{date}
+
+The operation travels in a context variable, which AsyncDatabaseReference
+copies onto the executor threads. Calls made inside `operation()` are also
+added up for that request, which the API reports in its Server-Timing
+header. render() returns everything in the Prometheus text format for
+`GET /metrics`.
+"""
+import bisect
+import re
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+
+from app.config import METRICS_PAYLOAD_SIZES
+from app.db.cache import estimate_size
+
+operation_label = ContextVar("operation_label", default="other")
+request_timings = ContextVar("request_timings", default=None)
+
+# Node names kept as they are in path patterns; any other key is replaced by
+# a placeholder so that product IDs don't create a series each
+PATH_WORDS = {
+    "electricity_usage", "electricity_rollups", "electricity_live", "electricity_bills",
+    "electricity_bills_latest", "product_registry", "connection_status", "billing_runs",
+    "scheduler_leases", "encoding_migrations", "user_details", "payments", "hourly", "daily", "monthly",
+    "hours", "months", "revisions", "products", "first_reading_date", "last_reading_date", "last_seen",
+    "status", "scheduler_state", "monthly_billing", "registry_state", "rebuilt_at",
+}
+
+PATH_PLACEHOLDERS = (
+    (re.compile(r"^\d{4}-\d{2}-\d{2}$"), "{date}"),
+    (re.compile(r"^\d{4}-\d{2}$"), "{month}"),
+    (re.compile(r"^\d{4}$"), "{year}"),
+    (re.compile(r"^\d{1,2}$"), "{nn}"),
+)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+
+
+@lru_cache(maxsize=4096)
+def path_pattern(path: str) -> str:
+    """electricity_usage/product1/2025-03-14 -> electricity_usage/*/{date}"""
+    pattern = []
+    for part in path.split("/"):
+        if not part or part in PATH_WORDS:
+            pattern.append(part)
+            continue
+        for regex, placeholder in PATH_PLACEHOLDERS:
+            if regex.match(part):
+                pattern.append(placeholder)
+                break
+        else:
+            pattern.append("*")
+    return "/".join(pattern) or "/"
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Histogram:
+    """A Prometheus histogram with labels"""
+
+    def __init__(self, name: str, description: str, label_names: tuple, buckets: tuple):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # label values -> [count per bucket..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labels, values in sorted(series.items()):
+            label_text = ",".join(f'{name}="{escape(value)}"' for name, value in zip(self.label_names, labels))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), values[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {values[-1]}")
+            lines.append(f"{self.name}_count{{{label_text}}} {cumulative}")
+        return lines
+
+
+class Counter:
+    """A Prometheus counter with labels"""
+
+    def __init__(self, name: str, description: str, label_names: tuple):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple, amount: float = 1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            series = dict(self._series)
+        for labels, value in sorted(series.items()):
+            label_text = ",".join(f'{name}="{escape(value)}"' for name, value in zip(self.label_names, labels))
+            lines.append(f"{self.name}{{{label_text}}} {value}")
+        return lines
+
+
+class RequestTimings:
+    """Database calls made while serving one request or job"""
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float, size: int):
+        with self._lock:
+            self.calls += 1
+            self.seconds += seconds
+            self.bytes += size
+
+    def server_timing(self, total: float) -> str:
+        # Calls may overlap, so db is their summed time rather than wall time
+        sizes = f", {self.bytes} bytes" if METRICS_PAYLOAD_SIZES else ""
+        return (f'db;dur={self.seconds * 1000:.1f};desc="{self.calls} calls{sizes}", '
+                f"total;dur={total * 1000:.1f}")
+
+
+db_call_seconds = Histogram(
+    "tenantvolt_db_call_seconds", "Latency of database calls",
+    ("operation", "method", "path"), SECONDS_BUCKETS
+)
+db_payload_bytes = Histogram(
+    "tenantvolt_db_payload_bytes", "JSON size of the data database calls returned",
+    ("operation", "method", "path"), BYTES_BUCKETS
+)
+db_errors = Counter(
+    "tenantvolt_db_errors_total", "Database calls that failed",
+    ("operation", "method", "path")
+)
+http_request_seconds = Histogram(
+    "tenantvolt_http_request_seconds", "Latency of API requests",
+    ("route", "method", "status"), SECONDS_BUCKETS
+)
+
+METRICS = [db_call_seconds, db_payload_bytes, db_errors, http_request_seconds]
+
+
+@contextmanager
+def operation(label):
+    """
+    Attribute the database calls made inside the block to label, and add
+    them up. label may also be a function returning it, called when a call
+    is recorded.
+    """
+    timings = RequestTimings()
+    label_token = operation_label.set(label)
+    timings_token = request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        request_timings.reset(timings_token)
+        operation_label.reset(label_token)
+
+
+def record(method: str, path: str, seconds: float, result=None, failed: bool = False):
+    label = operation_label.get()
+    labels = (label() if callable(label) else label, method, path_pattern(path))
+    if failed:
+        db_errors.inc(labels)
+        return
+
+    size = 0
+    if METRICS_PAYLOAD_SIZES and isinstance(result, (dict, list, str)):
+        size = estimate_size(result)
+        db_payload_bytes.observe(labels, size)
+    db_call_seconds.observe(labels, seconds)
+
+    timings = request_timings.get()
+    if timings is not None:
+        timings.add(seconds, size)
+
+
+def render() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,169 @@
+"""
+Write-behind batching of database writes.
+
+Writes submitted to a WriteBehind are held briefly and merged into one
+atomic multi-path update. The batch goes out once it holds max_paths paths,
+once max_delay seconds have passed since its first write, or on flush()
+and close() (at shutdown). A burst of writes, such as connection status
+heartbeats or a month's bills, then costs a handful of round trips. Writes
+to a path already waiting in the batch replace the pending value, so
+repeated heartbeats of a product coalesce into one.
+
+Each submit() takes a group of paths that are written together (always in
+the same update) and returns a future for the group. When a merged update
+fails, its groups are retried one update each, so that one bad write only
+fails its own group; the futures of failing groups raise WriteBehindError
+naming their paths, and flush() returns the errors by path.
+
+A guard, when given, is called right before each batch is written; if it
+raises (the writer's lease was lost, say), the batch is not written and
+every group in it fails with that error.
+
+Batches are written one after the other, in submission order. Firebase
+rejects an update in which one path lies below another, so a write under
+(or above) a pending path starts a new batch.
+"""
+import asyncio
+
+from fastapi.logger import logger
+
+from app.config import WRITE_BEHIND_MAX_PATHS, WRITE_BEHIND_MAX_DELAY
+from app.db.backend import join_path
+from app.db.firebase import async_database
+
+
+class WriteBehindError(Exception):
+    """A group of writes that could not be stored"""
+
+    def __init__(self, paths: list, error: Exception):
+        super().__init__(f"Failed to write {', '.join(paths)}: {error}")
+        self.paths = paths
+        self.error = error
+
+
+def overlaps(path: str, other: str) -> bool:
+    """Whether one of two different paths lies below the other"""
+    return path != other and (path.startswith(other + "/") or other.startswith(path + "/"))
+
+
+class WriteBehind:
+    def __init__(self, reference=None, max_paths: int = WRITE_BEHIND_MAX_PATHS,
+                 max_delay: float = WRITE_BEHIND_MAX_DELAY, guard=None):
+        self.reference = reference if reference else async_database
+        self.max_paths = max_paths
+        self.max_delay = max_delay
+        self.guard = guard
+        self._pending = {}  # path -> value
+        self._groups = []  # (paths, future) of the pending batch
+        self._timer = None
+        self._writing = None  # Task writing the previous batch
+        self.batches = 0
+        self.paths_written = 0
+        self.coalesced = 0
+
+    def submit(self, updates: dict) -> asyncio.Future:
+        """Queue {path: value} writes to land together; the future resolves once they are stored"""
+        updates = {join_path(path): value for path, value in updates.items()}
+        future = asyncio.get_running_loop().create_future()
+        if not updates:
+            future.set_result(None)
+            return future
+
+        if any(overlaps(path, pending) for path in updates for pending in self._pending):
+            self._start_flush()
+
+        self.coalesced += sum(1 for path in updates if path in self._pending)
+        self._pending.update(updates)
+        self._groups.append((list(updates), future))
+
+        if len(self._pending) >= self.max_paths:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._start_flush)
+        return future
+
+    async def write(self, updates: dict):
+        """Submit writes and wait until they are stored"""
+        await self.submit(updates)
+
+    async def flush(self) -> dict:
+        """Write everything pending now. Returns {path: error} of the writes that failed."""
+        self._start_flush()
+        return await self._writing if self._writing else {}
+
+    async def close(self):
+        """Flush the pending writes, e.g. at shutdown"""
+        errors = await self.flush()
+        if errors:
+            logger.error(f"{len(errors)} pending write(s) failed at shutdown")
+
+    def stats(self) -> dict:
+        return {
+            "pending_paths": len(self._pending),
+            "batches": self.batches,
+            "paths_written": self.paths_written,
+            "coalesced": self.coalesced,
+        }
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        batch, groups = self._pending, self._groups
+        self._pending, self._groups = {}, []
+        self._writing = asyncio.ensure_future(self._write(batch, groups, self._writing))
+
+    async def _write(self, batch: dict, groups: list, previous) -> dict:
+        # Batches land in the order they were taken
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+
+        self.batches += 1
+        try:
+            if self.guard is not None:
+                self.guard()
+        except Exception as e:
+            failures = [(group, e) for group in groups]
+        else:
+            try:
+                await self.reference.update(batch)
+                failures = []
+            except Exception as e:
+                if len(groups) == 1:
+                    failures = [(groups[0], e)]
+                else:
+                    logger.warning(f"Batch of {len(batch)} writes failed ({str(e)}), retrying group by group")
+                    failures = await self._retry(batch, groups)
+
+        errors = {}
+        failed = set()
+        for (paths, future), error in failures:
+            failed.add(id(future))
+            errors.update(dict.fromkeys(paths, error))
+            if not future.done():
+                future.set_exception(WriteBehindError(paths, error))
+            logger.error(f"Write-behind failed for {', '.join(paths)}: {str(error)}")
+
+        for paths, future in groups:
+            if id(future) not in failed and not future.done():
+                future.set_result(None)
+        self.paths_written += len(batch) - len(errors)
+        return errors
+
+    async def _retry(self, batch: dict, groups: list) -> list:
+        failures = []
+        for group in groups:
+            paths, _ = group
+            try:
+                # The batch holds the latest value of every path
+                await self.reference.update({path: batch[path] for path in paths})
+            except Exception as e:
+                failures.append((group, e))
+        return failures
+
+
+# Shared by connection status heartbeats; flushed at shutdown
+write_behind = WriteBehind()
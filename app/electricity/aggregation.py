@@ -0,0 +1,274 @@
+"""
+Vectorized aggregation of raw minute readings.
+
+Hour payloads (`{"MM": value}` dicts or lists indexed by minute, with nulls
+and junk values mixed in, or packed hours) are laid out as the rows of one
+float64 array per query, with NaN marking a missing or invalid reading, and
+converted in bulk. Statistics for every hour are then computed at once with
+NumPy and can be grouped into days, months or any other bucket. A single hour
+can also be laid out as a 60-slot array indexed by minute for minute-level
+charts.
+
+All chart and billing figures derive from these statistics:
+
+    mean        = sum / count
+    watt_hours  = sum of the hourly means (one hour's energy per hour)
+
+Packed hours are the canonical compact encoding of an hour node (written by
+`python -m app.electricity.encoding migrate`): "f4:" followed by the base64
+of 60 little-endian float32 values indexed by minute, NaN marking a missing
+minute. They decode in one step, without looking at individual values.
+
+Long series are thinned for display with Largest-Triangle-Three-Buckets
+(lttb), which keeps the points that shape the curve.
+"""
+import base64
+import binascii
+import operator
+from collections import namedtuple
+
+import numpy as np
+
+MINUTES_PER_HOUR = 60
+
+PACKED_PREFIX = "f4:"
+
+Stats = namedtuple("Stats", ["sum", "count", "min", "max", "watt_hours"])
+
+
+# Raw values are converted in chunks of this many (a day), so a junk value
+# only makes the values before it in its own chunk convert again
+PARSE_CHUNK = 24 * MINUTES_PER_HOUR
+
+# Past this many junk values the rest is converted value by value
+JUNK_RETRIES = 64
+
+def minute_positions(keys) -> np.ndarray:
+    """Minute number of each key of a dict hour payload, -1 for keys that aren't minutes"""
+    minutes = []
+    for key in keys:
+        try:
+            minute = int(key)
+        except (ValueError, TypeError):
+            minute = -1
+        minutes.append(minute if 0 <= minute < MINUTES_PER_HOUR else -1)
+    return np.array(minutes, dtype=np.int64)
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return np.nan
+
+
+def parse_values(values: list) -> np.ndarray:
+    """Convert raw values to float64, with NaN for nulls and junk"""
+    result = np.empty(len(values), dtype=np.float64)
+    remaining = iter(values)
+    start = 0
+    for _ in range(JUNK_RETRIES):
+        try:
+            # Fast path: numbers, numeric strings and None (which becomes NaN)
+            while start < len(values):
+                stop = min(start + PARSE_CHUNK, len(values))
+                result[start:stop] = np.fromiter(remaining, dtype=np.float64, count=stop - start)
+                start = stop
+            return result
+        except (ValueError, TypeError):
+            pass
+        # fromiter stopped right after the junk value; the values before it
+        # in its chunk are converted again and the rest picks up after it
+        junk = len(values) - operator.length_hint(remaining) - 1
+        result[start:junk] = np.fromiter(values[start:junk], dtype=np.float64, count=junk - start)
+        result[junk] = to_float(values[junk])
+        start = junk + 1
+
+    result[start:] = [value if type(value) is float else to_float(value) for value in values[start:]]
+    return result
+
+
+def is_packed(hour_data) -> bool:
+    return isinstance(hour_data, str) and hour_data.startswith(PACKED_PREFIX)
+
+
+def pack_hour(minute_values: np.ndarray) -> str:
+    """Packed encoding of a (60,) array indexed by minute, NaN where missing"""
+    return PACKED_PREFIX + base64.b64encode(np.asarray(minute_values, dtype="<f4").tobytes()).decode()
+
+
+def unpack_hour(packed: str) -> np.ndarray:
+    """(60,) float64 array of a packed hour; all NaN if it is corrupt"""
+    try:
+        row = np.frombuffer(base64.b64decode(packed[len(PACKED_PREFIX):]), dtype="<f4")
+    except (binascii.Error, ValueError):
+        row = np.zeros(0, dtype="<f4")
+    if len(row) != MINUTES_PER_HOUR:
+        return np.full(MINUTES_PER_HOUR, np.nan)
+    return row.astype(np.float64)
+
+
+def hour_rows(hour_payloads: list, width: int = MINUTES_PER_HOUR) -> np.ndarray:
+    """
+    Readings of many hour payloads as a (hours, width) float64 array, one row
+    per hour, NaN marking nulls, junk and the padding after short hours.
+
+    Hourly statistics don't depend on which minute a value belongs to, so
+    dict keys are not even looked at. Raw hours are laid end to end and
+    converted in bulk, packed hours decoded as they are.
+    """
+    padding = [np.nan] * width
+    values = []
+    for hour_data in hour_payloads:
+        kind = type(hour_data)
+        if kind is dict:
+            hour_data = hour_data.values()
+        elif kind is not list:
+            hour_data = unpack_hour(hour_data) if is_packed(hour_data) else ()
+        values += hour_data
+        if len(hour_data) != width:
+            if len(hour_data) > width:
+                # Rows are as wide as the longest hour
+                return hour_rows(hour_payloads, len(hour_data))
+            values += padding[len(hour_data):]
+    return parse_values(values).reshape(-1, width)
+
+
+def row_stats(rows: np.ndarray) -> Stats:
+    """Statistics of every row of a 2-D array of readings, NaN marking missing ones"""
+    valid = ~np.isnan(rows)
+    count = valid.sum(axis=1)
+    total = np.where(valid, rows, 0.0).sum(axis=1)
+    # fmin and fmax skip NaN, leaving it only for rows without readings
+    minimum = np.fmin.reduce(rows, axis=1)
+    maximum = np.fmax.reduce(rows, axis=1)
+    mean = np.divide(total, count, out=np.zeros_like(total), where=count > 0)
+    return Stats(total, count, minimum, maximum, mean)
+
+
+def hour_array(hour_data) -> np.ndarray:
+    """Minute readings of one hour as a (60,) array indexed by minute"""
+    if is_packed(hour_data):
+        return unpack_hour(hour_data)
+
+    row = np.full(MINUTES_PER_HOUR, np.nan)
+    if isinstance(hour_data, list):
+        values = hour_data[:MINUTES_PER_HOUR]
+        row[:len(values)] = parse_values(values)
+    elif isinstance(hour_data, dict) and hour_data:
+        minutes = minute_positions(hour_data.keys())
+        known = minutes >= 0
+        row[minutes[known]] = parse_values(list(hour_data.values()))[known]
+    return row
+
+
+def group_stats(stats: Stats, groups: np.ndarray, group_count: int) -> Stats:
+    """Combine row statistics into group_count buckets given each row's bucket"""
+    total = np.bincount(groups, weights=stats.sum, minlength=group_count).astype(np.float64, copy=False)
+    count = np.bincount(groups, weights=stats.count, minlength=group_count).astype(np.int64)
+    watt_hours = np.bincount(groups, weights=stats.watt_hours, minlength=group_count).astype(np.float64, copy=False)
+
+    minimum = np.full(group_count, np.inf)
+    maximum = np.full(group_count, -np.inf)
+    present = stats.count > 0
+    np.minimum.at(minimum, groups[present], stats.min[present])
+    np.maximum.at(maximum, groups[present], stats.max[present])
+    minimum[count == 0] = np.nan
+    maximum[count == 0] = np.nan
+
+    return Stats(total, count, minimum, maximum, watt_hours)
+
+
+def stats_dict(stats: Stats, index: int) -> dict:
+    """One row of statistics in the stored rollup format"""
+    count = int(stats.count[index])
+    return {
+        "sum": float(stats.sum[index]),
+        "count": count,
+        "min": float(stats.min[index]) if count else None,
+        "max": float(stats.max[index]) if count else None,
+        "watt_hours": float(stats.watt_hours[index]),
+    }
+
+
+def day_hours(day_data) -> list:
+    """Sorted hour keys of a raw day payload, skipping keys like "connection_status" """
+    if not isinstance(day_data, dict):
+        return []
+    return sorted([hour for hour in day_data if hour.isdigit()])
+
+
+def summarize_days(days: dict, hourly: bool = True) -> dict:
+    """
+    Summarize several raw day payloads at once.
+
+    days maps a date to its raw payload; the result maps each date to
+    ({hour: stats}, day stats) in rollup format. Reads that only use the day
+    figures (averages and kWh of days whose rollups aren't stored) can unset
+    hourly to skip building the hour rollups, which are then left empty.
+    """
+    dates = list(days)
+    payloads, groups, labels = [], [], []
+    for index, date_str in enumerate(dates):
+        day_data = days[date_str]
+        hours = day_hours(day_data)
+        payloads.extend([day_data[hour] for hour in hours])
+        groups.extend([index] * len(hours))
+        labels.extend(hours)
+
+    per_hour = row_stats(hour_rows(payloads))
+    return day_summaries(dates, per_hour, groups, labels, hourly)
+
+
+def day_summaries(dates: list, per_hour: Stats, groups: list, labels: list, hourly: bool = True) -> dict:
+    """
+    {date: ({hour: stats}, day stats)} in rollup format, given the statistics
+    of hour rows, the index in dates of each row's day and its hour label.
+    The hour rollups are left empty when hourly is unset.
+    """
+    per_day = group_stats(per_hour, np.array(groups, dtype=np.int64), len(dates))
+
+    hour_rollups = [{} for _ in dates]
+    if hourly:
+        # Convert whole columns to Python numbers once instead of per element
+        present = per_hour.count > 0
+        columns = zip(groups, labels, per_hour.sum.tolist(), per_hour.count.tolist(),
+                      np.where(present, per_hour.min, None).tolist(),
+                      np.where(present, per_hour.max, None).tolist(), per_hour.watt_hours.tolist())
+        for index, hour, total, count, minimum, maximum, watt_hours in columns:
+            hour_rollups[index][hour] = {
+                "sum": total, "count": count, "min": minimum, "max": maximum, "watt_hours": watt_hours,
+            }
+    return {date_str: (hours, stats_dict(per_day, index))
+            for index, (date_str, hours) in enumerate(zip(dates, hour_rollups))}
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Indices of the threshold points Largest-Triangle-Three-Buckets keeps out
+    of a series sorted by x. The first and last points are always kept; every
+    bucket in between keeps the point forming the largest triangle with the
+    point kept before it and the average of the next bucket.
+    """
+    count = len(x)
+    if threshold >= count or threshold < 3:
+        return np.arange(count)
+
+    # Buckets of the points between the first and the last one
+    every = (count - 2) / (threshold - 2)
+    edges = (np.arange(threshold - 1) * every).astype(np.int64) + 1
+
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, count - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        next_stop = edges[bucket + 2] if bucket + 2 < len(edges) else count
+        next_x = x[stop:next_stop].mean()
+        next_y = y[stop:next_stop].mean()
+
+        area = np.abs((x[previous] - next_x) * (y[start:stop] - y[previous])
+                      - (x[previous] - x[start:stop]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(area))
+        kept[bucket + 1] = previous
+    return kept
@@ -0,0 +1,151 @@
+"""
+Columnar on-disk archive of settled months of minute readings (months that
+ended more than METER_BUFFER_DAYS ago, which meters no longer write to).
+
+Each archived month of a product is one file under ARCHIVE_PATH:
+
+    {ARCHIVE_PATH}/{product_id}/{YYYY-MM}.bin
+
+    header      64 bytes: magic, format version, year, month, minutes in
+                the month, and the revision of the month it was built from
+    values      float32 per minute of the month, little endian, indexed by
+                (day - 1) * 1440 + hour * 60 + minute; 0 where invalid
+    validity    one bit per minute (little-endian bit order), set where the
+                minute holds a reading
+
+Files are memory-mapped: values are read straight from the page cache
+without copying or parsing, so month and year computations over archived
+history cost a few page reads instead of downloading nested JSON.
+
+An archive records the revision of its month (see
+RollupService.get_revisions) when it is built. Late readings move the
+revision on, and archives built before are ignored until rebuilt.
+Archives are built by `python -m app.electricity.rollups archive`.
+"""
+import mmap
+import os
+import struct
+import calendar
+
+import numpy as np
+
+from app.config import ARCHIVE_PATH
+from app.electricity.aggregation import MINUTES_PER_HOUR, Stats, day_hours, day_summaries, hour_array
+
+MAGIC = b"TVAR"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHHHxxI40s")
+HEADER_SIZE = 64
+MINUTES_PER_DAY = 24 * MINUTES_PER_HOUR
+
+
+def archive_file(product_id: str, year_month: str) -> str:
+    if not product_id or "/" in product_id or product_id.startswith("."):
+        raise ValueError(f"Invalid product ID {product_id!r}")
+    return os.path.join(ARCHIVE_PATH, product_id, f"{year_month}.bin")
+
+
+def month_minutes(year_month: str) -> int:
+    year, month = (int(part) for part in year_month.split('-'))
+    return calendar.monthrange(year, month)[1] * MINUTES_PER_DAY
+
+
+def month_array(year_month: str, month_data: dict) -> np.ndarray:
+    """Raw days of a month ({date: {hour: payload}}) as one float64 array per minute, NaN where missing"""
+    values = np.full(month_minutes(year_month), np.nan)
+    for date_str, day_data in (month_data or {}).items():
+        if not date_str.startswith(f"{year_month}-"):
+            continue
+        day = int(date_str[8:]) - 1
+        for hour in day_hours(day_data):
+            if int(hour) < 24:
+                start = day * MINUTES_PER_DAY + int(hour) * MINUTES_PER_HOUR
+                values[start:start + MINUTES_PER_HOUR] = hour_array(day_data[hour])
+    return values
+
+
+def write_month(product_id: str, year_month: str, month_data: dict, revision: str = "") -> int:
+    """Archive the raw days of a settled month. Returns the size of the file."""
+    values = month_array(year_month, month_data)
+    valid = ~np.isnan(values)
+    year, month = (int(part) for part in year_month.split('-'))
+
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, year, month, len(values), revision.encode()[:40])
+    body = (
+        header.ljust(HEADER_SIZE, b"\0")
+        + np.where(valid, values, 0).astype("<f4").tobytes()
+        + np.packbits(valid, bitorder="little").tobytes()
+    )
+
+    path = archive_file(product_id, year_month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as archive:
+        archive.write(body)
+    os.replace(temporary, path)
+    return len(body)
+
+
+class MonthArchive:
+    """A memory-mapped archived month"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as archive:
+            self._map = mmap.mmap(archive.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, year, month, minutes, revision = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} usage archive")
+        if len(self._map) != HEADER_SIZE + minutes * 4 + (minutes + 7) // 8:
+            raise ValueError(f"{path} is truncated")
+
+        self.year_month = f"{year:04d}-{month:02d}"
+        self.revision = revision.rstrip(b"\0").decode()
+        self.values = np.frombuffer(self._map, dtype="<f4", count=minutes, offset=HEADER_SIZE)
+        bitmap = np.frombuffer(self._map, dtype=np.uint8, count=(minutes + 7) // 8, offset=HEADER_SIZE + minutes * 4)
+        self.valid = np.unpackbits(bitmap, count=minutes, bitorder="little").view(bool)
+
+    def hour(self, day: int, hour: int) -> np.ndarray:
+        """Readings of one hour as a (60,) float64 array indexed by minute, like hour_array"""
+        start = (day - 1) * MINUTES_PER_DAY + hour * MINUTES_PER_HOUR
+        stop = start + MINUTES_PER_HOUR
+        return np.where(self.valid[start:stop], self.values[start:stop], np.nan)
+
+    def summarize_days(self, days: list) -> dict:
+        """
+        Summaries of some days of the month (given as DD), in the format of
+        aggregation.summarize_days. Only hours holding readings are listed.
+        """
+        rows = np.array([int(day) - 1 for day in days], dtype=np.int64)
+        shape = (len(rows) * 24, MINUTES_PER_HOUR)
+        values = self.values.reshape(-1, MINUTES_PER_DAY)[rows].reshape(shape).astype(np.float64)
+        valid = self.valid.reshape(-1, MINUTES_PER_DAY)[rows].reshape(shape)
+
+        count = valid.sum(axis=1)
+        total = np.where(valid, values, 0.0).sum(axis=1)
+        present = count > 0
+        minimum = np.where(valid, values, np.inf).min(axis=1, initial=np.inf)
+        maximum = np.where(valid, values, -np.inf).max(axis=1, initial=-np.inf)
+        minimum[~present] = np.nan
+        maximum[~present] = np.nan
+        mean = np.divide(total, count, out=np.zeros_like(total), where=present)
+
+        hours = np.flatnonzero(present)
+        per_hour = Stats(total[hours], count[hours], minimum[hours], maximum[hours], mean[hours])
+        dates = [f"{self.year_month}-{day}" for day in days]
+        groups = (hours // 24).tolist()
+        labels = [f"{hour:02d}" for hour in (hours % 24).tolist()]
+        return day_summaries(dates, per_hour, groups, labels)
+
+
+def open_month(product_id: str, year_month: str):
+    """The archive of a month, or None when there is none (or it is unreadable)"""
+    if not ARCHIVE_PATH:
+        return None
+    path = archive_file(product_id, year_month)
+    if not os.path.exists(path):
+        return None
+    try:
+        return MonthArchive(path)
+    except (OSError, ValueError, struct.error):
+        return None
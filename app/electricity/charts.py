@@ -0,0 +1,181 @@
+"""
+Chart payloads and their fast response path.
+
+The usage service builds charts as plain label and value lists (Chart)
+instead of one pydantic model per point. Chart routes serialize them
+straight to JSON bytes, with orjson when it is installed, in one of two
+shapes:
+
+    points     {"data_points": [{"label", "value"}, ...], ...}   (ChartDataResponse)
+    columnar   {"labels": [...], "values": [...], ...}           (ColumnarChartResponse)
+
+and compress bodies larger than CHART_COMPRESS_MIN_BYTES with brotli (when
+installed) or gzip, following the client's Accept-Encoding.
+
+Chart responses also carry HTTP caching headers (ChartValidators). Settled
+periods (closed more than METER_BUFFER_DAYS ago) get a long Cache-Control
+and an ETag / Last-Modified derived from when the period closed and the month
+revisions late readings leave behind, so a conditional request is answered
+with 304 before any aggregation runs. Younger periods, the one in progress
+or one meters may still upload held-back readings into, are cached briefly
+and their ETag is a hash of the body.
+A chart built on an error path is sent with no-store and no validators, so
+it is never kept in place of the real one.
+"""
+import gzip
+import hashlib
+import json
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import List, NamedTuple, Optional
+
+from fastapi import Request, Response
+
+from app.config import (get_current_time, CHART_COMPRESS_MIN_BYTES, CHART_CLOSED_MAX_AGE, CHART_OPEN_MAX_AGE,
+                        METER_BUFFER)
+from app.electricity.rollups import RollupService, hour_end, day_end, month_end, year_end
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional speedup
+    brotli = None
+
+# Part of every ETag; bump it when the content of chart responses changes
+# for the same data, so that caches drop what they hold
+CHART_VERSION = "1"
+
+class Chart(NamedTuple):
+    labels: List[str]
+    values: List[float]
+    chart_title: str
+    x_axis_label: str
+    y_axis_label: str = "Power Consumption (W)"
+    # Built on an error path (the data could not be read, or only in part),
+    # so the response must not be cached
+    failed: bool = False
+
+    def as_dict(self, chart_format: str = "points") -> dict:
+        axes = {"chart_title": self.chart_title, "x_axis_label": self.x_axis_label, "y_axis_label": self.y_axis_label}
+        if chart_format == "columnar":
+            return {"labels": self.labels, "values": self.values, **axes}
+        return {
+            "data_points": [{"label": label, "value": value} for label, value in zip(self.labels, self.values)],
+            **axes,
+        }
+
+
+class ChartValidators(NamedTuple):
+    """HTTP caching headers of a chart response"""
+    etag: Optional[str]
+    last_modified: Optional[datetime]
+    cache_control: str
+
+    def matches(self, request: Request) -> bool:
+        """Whether the client's cached copy is still current"""
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            if self.etag is None:
+                return False
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            return "*" in tags or self.etag.removeprefix("W/") in tags
+
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since and self.last_modified is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return since.tzinfo is not None and self.last_modified.replace(microsecond=0) <= since
+        return False
+
+    def headers(self) -> dict:
+        headers = {"Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        if self.etag is not None:
+            headers["ETag"] = self.etag
+        if self.last_modified is not None:
+            headers["Last-Modified"] = format_datetime(self.last_modified.astimezone(timezone.utc), usegmt=True)
+        return headers
+
+    def uncached(self) -> "ChartValidators":
+        """The headers of a response that must not be stored (an error-path chart)"""
+        return ChartValidators(None, None, "no-store")
+
+    def not_modified(self) -> Response:
+        return Response(status_code=304, headers=self.headers())
+
+
+def period_window(granularity: str, period: str):
+    """(moment the period closes, months whose revisions it depends on)"""
+    if granularity == "minutely":
+        date_str, hour = period.split("/")
+        return hour_end(date_str, hour), [date_str[:7]]
+    if granularity == "hourly":
+        return day_end(period), [period[:7]]
+    if granularity == "daily":
+        return month_end(period), [period]
+    return year_end(period), [f"{period}-{month:02d}" for month in range(1, 13)]
+
+
+async def chart_validators(request: Request, product_id: str, granularity: str, period: str) -> ChartValidators:
+    """
+    Caching headers of a chart. Those of settled periods are known without
+    building the chart; the ETag of younger periods comes from their body.
+    """
+    try:
+        closes_at, months = period_window(granularity, period)
+    except ValueError:
+        return ChartValidators(None, None, "no-cache")
+
+    # Until the period settles, readings written straight to the database
+    # (which leave no revision behind) may still change it
+    if closes_at + METER_BUFFER > get_current_time():
+        return ChartValidators(None, None, f"public, max-age={CHART_OPEN_MAX_AGE}")
+
+    # Late readings for a closed month leave a revision behind
+    revisions = await RollupService.get_revisions(product_id)
+    last_modified = max([closes_at, *(
+        datetime.fromisoformat(revisions[month]) for month in months if month in revisions
+    )])
+    key = f"{CHART_VERSION}|{request.url.path}|{request.url.query}|{last_modified.isoformat()}"
+    etag = f'W/"{hashlib.sha1(key.encode()).hexdigest()[:20]}"'
+    return ChartValidators(etag, last_modified, f"public, max-age={CHART_CLOSED_MAX_AGE}")
+
+
+def dumps(payload) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+def json_response(request: Request, payload, validators: ChartValidators = None) -> Response:
+    """
+    Serialize a payload, compressed when it is large and the client accepts
+    it, with the caching headers of validators if given
+    """
+    body = dumps(payload)
+    headers = {"Vary": "Accept-Encoding"}
+
+    if validators is not None:
+        if validators.cache_control == "no-store":
+            headers.update(validators.headers())
+        elif validators.etag is None:
+            validators = validators._replace(etag=f'W/"{hashlib.sha1(body).hexdigest()[:20]}"')
+            if validators.matches(request):
+                return validators.not_modified()
+        headers.update(validators.headers())
+
+    if len(body) >= CHART_COMPRESS_MIN_BYTES:
+        accepted = request.headers.get("accept-encoding", "")
+        if brotli is not None and "br" in accepted:
+            body = brotli.compress(body, quality=4)
+            headers["Content-Encoding"] = "br"
+        elif "gzip" in accepted:
+            body = gzip.compress(body, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+
+    return Response(content=body, media_type="application/json", headers=headers)
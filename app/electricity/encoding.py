@@ -0,0 +1,190 @@
+"""
+Migration of raw readings to the packed hour encoding.
+
+Meters write hours under electricity_usage/{product_id}/{YYYY-MM-DD}/{HH} as
+{"MM": value} dicts or sparse lists, with strings and junk mixed in. The
+canonical encoding packs an hour into one string (see aggregation.pack_hour)
+that decodes without per-value parsing and takes less space. Readers accept
+both, so the migration can run while the service is up:
+
+    python -m app.electricity.encoding migrate <product_id> [--dry-run]
+    python -m app.electricity.encoding migrate-all [--dry-run]
+
+A packed hour is a single string, so a meter writing a minute straight to
+.../{HH}/{MM} replaces the whole hour with that minute (ingestion, which
+repacks, is safe). Packing a day is therefore only safe once its meters are
+done writing to it: days are rewritten one transaction each, oldest first,
+and only once they are older than METER_BUFFER_DAYS, the longest a meter
+holds readings back. Ingestion records readings that arrive later than that
+(late_reading below), and such a product is only migrated with a
+--min-age-days of at least the lateness seen. Progress is checkpointed per
+product in
+
+    encoding_migrations/{product_id}
+        last_date:      the newest day migrated so far
+        days, bytes_before, bytes_after
+        late_reading:   {date, lag_days} of the most delayed reading seen,
+                        if one came more than METER_BUFFER_DAYS late
+
+so an interrupted run carries on where it stopped, and a later run picks up
+the days that have closed since. Hours without any valid reading are
+removed, and junk values are dropped like the readers already ignore them.
+"""
+import argparse
+import asyncio
+from datetime import timedelta
+
+import numpy as np
+from fastapi.logger import logger
+
+from app.config import get_current_time, METER_BUFFER_DAYS
+from app.db.cache import estimate_size
+from app.db.firebase import async_database
+from app.electricity.aggregation import day_hours, hour_array, pack_hour
+from app.electricity.registry import ProductRegistry, is_date_key
+
+MIGRATION_ROOT = "encoding_migrations"
+
+# Days rewritten concurrently between two checkpoints
+MIGRATION_BATCH = 7
+
+
+def pack_day(day_data):
+    """A raw day with every hour packed, and hours without readings removed"""
+    if not isinstance(day_data, dict):
+        return day_data
+
+    packed = dict(day_data)
+    for hour in day_hours(day_data):
+        minute_values = hour_array(day_data[hour])
+        if np.isnan(minute_values).all():
+            del packed[hour]
+        else:
+            packed[hour] = pack_hour(minute_values)
+    return packed or None
+
+
+class EncodingMigration:
+    @staticmethod
+    async def migrate_day(product_id: str, date_str: str, dry_run: bool = False) -> tuple:
+        """Pack the hours of one day. Returns its (bytes before, bytes after)."""
+        reference = async_database.child(f"electricity_usage/{product_id}/{date_str}")
+        if dry_run:
+            day_data = await reference.get()
+            return estimate_size(day_data), estimate_size(pack_day(day_data))
+
+        sizes = [0, 0]
+
+        def pack(day_data):
+            # May run again if the day changes meanwhile; the last run counts
+            packed = pack_day(day_data)
+            sizes[:] = estimate_size(day_data), estimate_size(packed)
+            return packed
+
+        await reference.transaction(pack)
+        return tuple(sizes)
+
+    @staticmethod
+    async def record_late_reading(product_id: str, date_str: str, lag_days: int):
+        """Note that a product's meters delivered a reading lag_days after its day"""
+        def keep_latest(current):
+            if current and current.get("lag_days", 0) >= lag_days:
+                return current
+            return {"date": date_str, "lag_days": lag_days}
+
+        await async_database.child(f"{MIGRATION_ROOT}/{product_id}/late_reading").transaction(keep_latest)
+
+    @staticmethod
+    async def migrate(product_id: str, min_age_days: int = None, dry_run: bool = False) -> dict:
+        """
+        Migrate the days of a product that aren't migrated yet. Returns the
+        product's progress record, with the run's totals in a dry run.
+        """
+        if min_age_days is None:
+            min_age_days = METER_BUFFER_DAYS
+        if min_age_days < METER_BUFFER_DAYS:
+            raise ValueError(f"Days younger than METER_BUFFER_DAYS ({METER_BUFFER_DAYS}) may still be "
+                             f"written by meters and can't be packed")
+
+        checkpoint = async_database.child(f"{MIGRATION_ROOT}/{product_id}")
+        progress = {"last_date": "", "days": 0, "bytes_before": 0, "bytes_after": 0}
+        record = await checkpoint.get() or {}
+        if not dry_run:
+            progress.update(record)
+
+        late_reading = record.get("late_reading")
+        if late_reading and late_reading["lag_days"] > min_age_days:
+            logger.warning(f"Not migrating {product_id}: a reading for {late_reading['date']} arrived "
+                           f"{late_reading['lag_days']} days late, raise --min-age-days to at least that")
+            return progress
+
+        newest = (get_current_time() - timedelta(days=min_age_days)).strftime("%Y-%m-%d")
+        dates = [
+            key for key in await async_database.child(f"electricity_usage/{product_id}").keys()
+            if is_date_key(key) and progress["last_date"] < key < newest
+        ]
+
+        for start in range(0, len(dates), MIGRATION_BATCH):
+            batch = dates[start:start + MIGRATION_BATCH]
+            sizes = await asyncio.gather(*(
+                EncodingMigration.migrate_day(product_id, date_str, dry_run) for date_str in batch
+            ))
+            progress["last_date"] = batch[-1]
+            progress["days"] += len(batch)
+            progress["bytes_before"] += sum(before for before, _ in sizes)
+            progress["bytes_after"] += sum(after for _, after in sizes)
+            if not dry_run:
+                # Leaves late_reading alone, which ingestion may be writing meanwhile
+                await checkpoint.update({
+                    "last_date": progress["last_date"], "days": progress["days"],
+                    "bytes_before": progress["bytes_before"], "bytes_after": progress["bytes_after"],
+                    "updated_at": get_current_time().isoformat(),
+                })
+
+        logger.info(f"Migrated {len(dates)} day(s) of {product_id} to packed hours")
+        return progress
+
+
+async def run_migration(args):
+    if args.command == "migrate":
+        product_ids = [args.product_id]
+    else:
+        product_ids = await ProductRegistry.list_product_ids()
+
+    total_before = total_after = 0
+    for product_id in product_ids:
+        progress = await EncodingMigration.migrate(product_id, args.min_age_days, args.dry_run)
+        before, after = progress["bytes_before"], progress["bytes_after"]
+        total_before += before
+        total_after += after
+        saved = f"{(before - after) / before:.1%}" if before else "-"
+        print(f"{product_id}: {progress['days']} day(s), {before} -> {after} bytes, "
+              f"saved {before - after} ({saved})")
+
+    print(f"Total: {total_before} -> {total_after} bytes, saved {total_before - total_after}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migrate raw readings to the packed hour encoding")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="Migrate the readings of one product")
+    migrate_parser.add_argument("product_id")
+    subparsers.add_parser("migrate-all", help="Migrate the readings of every registered product")
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument("--min-age-days", type=int, default=METER_BUFFER_DAYS,
+                               help="Leave the days younger than this alone, at least METER_BUFFER_DAYS "
+                                    f"(default {METER_BUFFER_DAYS})")
+        subparser.add_argument("--dry-run", action="store_true",
+                               help="Report the bytes that would be saved without writing")
+
+    args = parser.parse_args(argv)
+    if args.min_age_days < METER_BUFFER_DAYS:
+        parser.error(f"--min-age-days can't be below METER_BUFFER_DAYS ({METER_BUFFER_DAYS}): "
+                     f"meters may still write to younger days")
+    asyncio.run(run_migration(args))
+
+
+if __name__ == "__main__":
+    main()
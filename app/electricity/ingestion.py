@@ -0,0 +1,219 @@
+"""
+Batched ingestion of minute readings with running energy totals.
+
+Each hour a batch touches is merged into its raw node in a transaction,
+and the running statistics of the hour are stored alongside it:
+
+    electricity_usage/{product_id}/{YYYY-MM-DD}/{HH}/{MM}   raw watts
+    electricity_live/{product_id}/hours/{YYYY-MM-DD}/{HH}   hour rollup so far
+    electricity_live/{product_id}/months/{YYYY-MM}          month-to-date totals
+
+Hours already in the packed encoding (see aggregation) are rewritten whole.
+
+The month-to-date watt-hours (the sum of hourly averages, as billing counts
+them) are then adjusted by each hour's change in average inside a
+transaction. The change is taken from the hour the merge replaced, so
+concurrent batches for one hour add up. The total only counts readings that
+came through this endpoint (meters may write to Firebase directly), so it
+serves live "kWh so far" estimates; bills come from rollups.
+
+Readings that arrive more than METER_BUFFER_DAYS after their day show that a
+product's meters hold readings back longer than the packed encoding
+migration assumes; they are recorded so it doesn't pack that product's days
+too early (see encoding).
+"""
+import asyncio
+import calendar
+from collections import defaultdict
+from datetime import datetime
+from typing import List
+
+import numpy as np
+from fastapi.logger import logger
+
+from app.config import get_current_time, SRI_LANKA_TZ, INGEST_MAX_BATCH, METER_BUFFER_DAYS
+from app.db.firebase import async_database
+from app.electricity.aggregation import hour_array, is_packed, pack_hour, unpack_hour
+from app.electricity.encoding import EncodingMigration
+from app.electricity.models import MeterReading, MonthToDateResponse
+from app.electricity.registry import ProductRegistry
+from app.electricity.rollups import RollupService, summarize_hour
+
+LIVE_ROOT = "electricity_live"
+
+# Characters Firebase does not allow in keys
+INVALID_KEY_CHARACTERS = set(".$#[]/")
+
+
+def minute_map(hour_data) -> dict:
+    """Normalize a raw hour payload to {"MM": value}"""
+    if is_packed(hour_data):
+        minute_values = unpack_hour(hour_data)
+        minutes = np.flatnonzero(~np.isnan(minute_values))
+        return {f"{minute:02d}": value for minute, value in zip(minutes.tolist(), minute_values[minutes].tolist())}
+    if isinstance(hour_data, dict):
+        return dict(hour_data)
+    if isinstance(hour_data, list):
+        return {f"{index:02d}": value for index, value in enumerate(hour_data) if value is not None}
+    return {}
+
+
+class IngestionService:
+    @staticmethod
+    def group_readings(readings: list) -> dict:
+        """Group readings as {(product_id, date, hour): {minute: value}}"""
+        if len(readings) > INGEST_MAX_BATCH:
+            raise ValueError(f"A batch can hold at most {INGEST_MAX_BATCH} readings")
+
+        hours = defaultdict(dict)
+        for reading in readings:
+            if not reading.product_id or INVALID_KEY_CHARACTERS & set(reading.product_id):
+                raise ValueError(f"Invalid product_id: {reading.product_id!r}")
+
+            timestamp = reading.timestamp
+            if timestamp.tzinfo is None:
+                timestamp = SRI_LANKA_TZ.localize(timestamp)
+            else:
+                timestamp = timestamp.astimezone(SRI_LANKA_TZ)
+
+            key = (reading.product_id, timestamp.strftime("%Y-%m-%d"), timestamp.strftime("%H"))
+            hours[key][timestamp.strftime("%M")] = reading.value
+        return hours
+
+    @staticmethod
+    async def ingest(readings: List[MeterReading]) -> dict:
+        """
+        Store a batch of readings and update the running totals.
+        Returns {product_id: month-to-date kWh} for the products in the batch.
+        """
+        hours = IngestionService.group_readings(readings)
+        keys = list(hours)
+
+        # Every touched hour is merged in a transaction, which reports the
+        # stats of the hour it replaced and of the hour it wrote
+        changes = await asyncio.gather(*(
+            IngestionService.merge_hour(product_id, date_str, hour, hours[(product_id, date_str, hour)])
+            for product_id, date_str, hour in keys
+        ))
+
+        month_deltas = defaultdict(lambda: [0.0, 0])  # (product_id, YYYY-MM) -> [watt_hours, readings]
+        first_dates, last_dates = {}, {}
+        late_days = set()
+
+        for (product_id, date_str, hour), (old_stats, new_stats) in zip(keys, changes):
+            delta = month_deltas[(product_id, date_str[:7])]
+            delta[0] += new_stats["watt_hours"] - old_stats["watt_hours"]
+            delta[1] += new_stats["count"] - old_stats["count"]
+
+            first_dates[product_id] = min(first_dates.get(product_id, date_str), date_str)
+            last_dates[product_id] = max(last_dates.get(product_id, date_str), date_str)
+            if RollupService.is_closed_day(date_str):
+                late_days.add((product_id, date_str))
+
+        await asyncio.gather(*(
+            ProductRegistry.record_reading_dates(product_id, first_dates[product_id], last_date)
+            for product_id, last_date in last_dates.items()
+        ))
+
+        # Readings for days that were already rolled up make those rollups stale
+        for product_id, date_str in late_days:
+            await RollupService.invalidate_day(product_id, date_str)
+
+        today = get_current_time().date()
+        for product_id, first_date in first_dates.items():
+            lag_days = (today - datetime.strptime(first_date, "%Y-%m-%d").date()).days
+            if lag_days > METER_BUFFER_DAYS:
+                logger.warning(f"Reading for {product_id} on {first_date} arrived {lag_days} days late, "
+                               f"beyond METER_BUFFER_DAYS ({METER_BUFFER_DAYS})")
+                await EncodingMigration.record_late_reading(product_id, first_date, lag_days)
+
+        totals = await asyncio.gather(*(
+            IngestionService.add_to_month(product_id, year_month, watt_hours, count)
+            for (product_id, year_month), (watt_hours, count) in month_deltas.items()
+        ))
+
+        month = get_current_time().strftime("%Y-%m")
+        result = {}
+        for (product_id, year_month), total in zip(month_deltas, totals):
+            if year_month == month or product_id not in result:
+                result[product_id] = round(total.get("watt_hours", 0.0) / 1000, 2)
+        logger.info(f"Ingested {len(readings)} readings for {len(last_dates)} products")
+        return result
+
+    @staticmethod
+    async def merge_hour(product_id: str, date_str: str, hour: str, minutes: dict) -> tuple:
+        """
+        Add minute readings to a raw hour and refresh its live rollup.
+        Returns the (old, new) stats of the hour.
+        """
+        changes = []
+
+        def merge(current):
+            # May run again if a concurrent batch changes the hour; the last run counts
+            before = minute_map(current)
+            merged = {**before, **minutes}
+            changes[:] = [summarize_hour(before), summarize_hour(merged)]
+            if is_packed(current):
+                # Minutes below a packed hour would replace it, so the whole
+                # hour is packed again with the new readings
+                return pack_hour(hour_array(merged))
+            return merged
+
+        await async_database.child(f"electricity_usage/{product_id}/{date_str}/{hour}").transaction(merge)
+        old_stats, new_stats = changes
+
+        def refresh(current):
+            # A concurrent batch's rollup of the same hour may land first; the
+            # one covering more readings is the later hour
+            if current and current.get("count", 0) > new_stats["count"]:
+                return current
+            return new_stats
+
+        await async_database.child(f"{LIVE_ROOT}/{product_id}/hours/{date_str}/{hour}").transaction(refresh)
+        return old_stats, new_stats
+
+    @staticmethod
+    async def add_to_month(product_id: str, year_month: str, watt_hours: float, count: int) -> dict:
+        """Atomically add an energy delta to a month-to-date total"""
+        updated_at = get_current_time().isoformat()
+
+        def apply(current):
+            current = current or {}
+            return {
+                "watt_hours": current.get("watt_hours", 0.0) + watt_hours,
+                "readings": current.get("readings", 0) + count,
+                "updated_at": updated_at,
+            }
+
+        return await async_database.child(f"{LIVE_ROOT}/{product_id}/months/{year_month}").transaction(apply) or {}
+
+    @staticmethod
+    async def get_month_total(product_id: str, year_month: str) -> dict:
+        """Running total of a month, or None if no readings were ingested for it"""
+        return await async_database.child(f"{LIVE_ROOT}/{product_id}/months/{year_month}").get()
+
+    @staticmethod
+    async def get_month_to_date(product_id: str) -> MonthToDateResponse:
+        """Month-to-date energy with a linear projection to the end of the month"""
+        # Imported here because the usage service reads running totals from this module
+        from app.electricity.service import ElectricityUsageService
+
+        now = get_current_time()
+        year_month = now.strftime("%Y-%m")
+        total = await IngestionService.get_month_total(product_id, year_month) or {}
+        kwh = total.get("watt_hours", 0.0) / 1000
+
+        month_start = SRI_LANKA_TZ.localize(datetime(now.year, now.month, 1))
+        elapsed_hours = max((now - month_start).total_seconds() / 3600, 1.0)
+        month_hours = calendar.monthrange(now.year, now.month)[1] * 24
+        projected_kwh = kwh * month_hours / elapsed_hours
+
+        return MonthToDateResponse(
+            product_id=product_id,
+            year_month=year_month,
+            kwh=round(kwh, 2),
+            projected_kwh=round(projected_kwh, 2),
+            projected_amount=round(ElectricityUsageService.calculate_billing_tiers(projected_kwh), 2),
+            readings=total.get("readings", 0),
+            updated_at=total.get("updated_at")
+        )
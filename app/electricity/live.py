@@ -0,0 +1,223 @@
+"""
+Live usage streams.
+
+Viewers of a meter subscribe to `GET /electricity/live/{product_id}` (Server-
+Sent Events) instead of polling the minutely chart. However many viewers a
+product has, the worker holds one Firebase listener for it, on the current
+day's readings:
+
+    electricity_usage/{product_id}/{YYYY-MM-DD}
+
+and moves it to the next day at midnight. Connection status changes come
+from the status table's single listener. Every event is copied into each
+subscriber's bounded queue; a subscriber whose queue is full is too slow to
+keep up and is dropped, so that it never holds up the others.
+"""
+import asyncio
+import json
+import threading
+
+from fastapi.logger import logger
+
+from app.config import get_current_time, LIVE_QUEUE_SIZE, LIVE_KEEPALIVE
+from app.db.firebase import database, executor
+from app.electricity.aggregation import is_packed, unpack_hour
+from app.electricity.status import status_table
+
+# Queued for a subscriber that has been dropped for falling behind
+DROPPED = {"type": "dropped"}
+
+# How often a feed checks whether the day it listens to is over, in seconds
+DAY_CHECK_INTERVAL = 30
+
+
+def reading_events(date_str: str, path: str, data) -> list:
+    """Reading events carried by a change at path under a day node"""
+    parts = [part for part in path.split("/") if part]
+    if len(parts) == 2:
+        hour, minute = parts
+        minutes = {minute: data}
+    elif len(parts) == 1 and parts[0].isdigit():
+        hour = parts[0]
+        if is_packed(data):
+            minute_values = unpack_hour(data)
+            minutes = {f"{minute:02d}": value for minute, value in enumerate(minute_values.tolist())
+                       if value == value}  # NaN marks a missing minute
+        elif isinstance(data, list):
+            minutes = {f"{index:02d}": value for index, value in enumerate(data)}
+        elif isinstance(data, dict):
+            minutes = data
+        else:
+            return []
+    else:
+        return []  # The whole day, or keys like connection_status
+
+    return [
+        {"type": "reading", "date": date_str, "hour": hour, "minute": minute, "value": value}
+        for minute, value in sorted(minutes.items()) if value is not None
+    ]
+
+
+class Subscriber:
+    def __init__(self, size: int = LIVE_QUEUE_SIZE):
+        self.queue = asyncio.Queue(maxsize=size)
+        self.dropped = False
+
+    def offer(self, event) -> bool:
+        """Queue an event; False when the subscriber has fallen behind"""
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def drop(self):
+        # Discard the backlog so that the notice fits
+        self.dropped = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(DROPPED)
+
+
+class ProductFeed:
+    """One upstream listener for a product, fanned out to its subscribers"""
+
+    def __init__(self, product_id: str, loop):
+        self.product_id = product_id
+        self.loop = loop
+        self.subscribers = set()
+        self.date_str = None
+        self._registration = None
+        self._lock = threading.Lock()
+        self._rollover = None
+
+    async def start(self):
+        await self.listen(get_current_time().strftime("%Y-%m-%d"))
+        self._rollover = asyncio.create_task(self._follow_days())
+
+    async def stop(self):
+        if self._rollover:
+            self._rollover.cancel()
+        await self.loop.run_in_executor(executor, self._close)
+
+    async def listen(self, date_str: str):
+        """Listen to a new day, closing the listener on the previous one"""
+        await self.loop.run_in_executor(executor, self._close)
+        self.date_str = date_str
+        try:
+            # Opening the stream blocks until Firebase answers
+            registration = await self.loop.run_in_executor(
+                executor, database.child(f"electricity_usage/{self.product_id}/{date_str}").listen,
+                lambda event: self._on_event(date_str, event)
+            )
+        except Exception as e:
+            logger.error(f"Failed to listen for readings of {self.product_id}: {str(e)}")
+            return
+        with self._lock:
+            self._registration = registration
+
+    def _close(self):
+        with self._lock:
+            registration, self._registration = self._registration, None
+        if registration is not None:
+            try:
+                registration.close()
+            except Exception as e:
+                logger.warning(f"Failed to close listener for {self.product_id}: {str(e)}")
+
+    async def _follow_days(self):
+        while True:
+            await asyncio.sleep(DAY_CHECK_INTERVAL)
+            # Also retries a listener that failed to open
+            date_str = get_current_time().strftime("%Y-%m-%d")
+            if date_str != self.date_str or self._registration is None:
+                await self.listen(date_str)
+
+    def _on_event(self, date_str: str, event):
+        # Runs on the listener's thread. The first event holds the whole day
+        # so far, which subscribers don't need
+        if event.event_type not in ("put", "patch") or event.path == "/":
+            return
+        for reading in reading_events(date_str, event.path, event.data):
+            self.loop.call_soon_threadsafe(self.publish, reading)
+
+    def publish(self, event):
+        """Copy an event to every subscriber, dropping the ones that fell behind"""
+        for subscriber in list(self.subscribers):
+            if not subscriber.offer(event):
+                logger.warning(f"Dropping a slow subscriber of {self.product_id}")
+                subscriber.drop()
+                self.subscribers.discard(subscriber)
+
+
+class LiveHub:
+    """The product feeds of this worker, started and stopped with their subscribers"""
+
+    def __init__(self):
+        self.feeds = {}
+        self.loop = None
+        self._lock = None
+        status_table.watchers.append(self._on_status)
+
+    async def subscribe(self, product_id: str) -> Subscriber:
+        if self._lock is None:
+            # Created here so that it belongs to the server's event loop
+            self.loop = asyncio.get_running_loop()
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            feed = self.feeds.get(product_id)
+            if feed is None:
+                feed = ProductFeed(product_id, self.loop)
+                await feed.start()
+                self.feeds[product_id] = feed
+            subscriber = Subscriber()
+            feed.subscribers.add(subscriber)
+            return subscriber
+
+    async def unsubscribe(self, product_id: str, subscriber: Subscriber):
+        async with self._lock:
+            feed = self.feeds.get(product_id)
+            if feed is None:
+                return
+            feed.subscribers.discard(subscriber)
+            if not feed.subscribers:
+                del self.feeds[product_id]
+                await feed.stop()
+
+    async def stream(self, product_id: str):
+        """Server-Sent Events for one subscriber, until it disconnects or falls behind"""
+        subscriber = await self.subscribe(product_id)
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), timeout=LIVE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # Comments keep proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+                if event is DROPPED:
+                    return
+        finally:
+            await self.unsubscribe(product_id, subscriber)
+
+    def stats(self) -> dict:
+        return {product_id: len(feed.subscribers) for product_id, feed in self.feeds.items()}
+
+    def _on_status(self, product_id: str, connection_status: bool):
+        # Called by the status table, possibly from its listener's thread
+        if self.loop is None or product_id not in self.feeds:
+            return
+        event = {"type": "status", "product_id": product_id, "connection_status": connection_status}
+
+        def publish():
+            feed = self.feeds.get(product_id)
+            if feed is not None:
+                feed.publish(event)
+
+        self.loop.call_soon_threadsafe(publish)
+
+
+# Feeds shared by all streams in this worker
+live_hub = LiveHub()
@@ -1,5 +1,6 @@
 from pydantic import BaseModel
-from typing import List, Dict, Optional, Union
+from datetime import datetime
+from typing import List, Dict, Optional, Union, Literal
 
 class MinutelyUsageRequest(BaseModel):
     product_id: str
@@ -28,6 +29,41 @@ class ChartDataResponse(BaseModel):
     x_axis_label: str
     y_axis_label: str = "Power Consumption (W)"
 
+class ColumnarChartResponse(BaseModel):
+    # labels[i] goes with values[i]
+    labels: List[str]
+    values: List[float]
+    chart_title: str
+    x_axis_label: str
+    y_axis_label: str = "Power Consumption (W)"
+
+class RangeChartResponse(ChartDataResponse):
+    resolution: Literal["minutely", "hourly", "daily"]
+    source_points: int  # Points at that resolution before downsampling
+
+class ColumnarRangeChartResponse(ColumnarChartResponse):
+    resolution: Literal["minutely", "hourly", "daily"]
+    source_points: int
+
+class ChartQuery(BaseModel):
+    product_id: str
+    granularity: Literal["minutely", "hourly", "daily", "monthly"]
+    # YYYY-MM-DD/HH for minutely, YYYY-MM-DD for hourly, YYYY-MM for daily, YYYY for monthly
+    period: str
+
+class ChartBatchRequest(BaseModel):
+    queries: List[ChartQuery]
+
+class ChartBatchResult(BaseModel):
+    product_id: str
+    granularity: str
+    period: str
+    chart: Optional[Union[ChartDataResponse, ColumnarChartResponse]] = None
+    error: Optional[str] = None
+
+class ChartBatchResponse(BaseModel):
+    results: List[ChartBatchResult]  # In the order of the queries
+
 # New models for payment and billing
 class PaymentRecord(BaseModel):
     month: str  # YYYY-MM format
@@ -65,10 +101,34 @@ class TenantStatusResponse(BaseModel):
 
 class TenantsStatusResponse(BaseModel):
     tenants: List[TenantStatusResponse]
+    listener_live: bool = False  # Whether statuses came from the in-memory table
+    listener_age_seconds: Optional[float] = None  # Seconds since the table last received a change
 
 class ConnectionStatusUpdate(BaseModel):
     connection_status: bool
     product_id: str
 
 class ConnectionStatusUpdateResponse(BaseModel):
-    message: str
\ No newline at end of file
+    message: str
+
+
+class MeterReading(BaseModel):
+    product_id: str
+    timestamp: datetime  # Minute of the reading, Sri Lanka time if no offset is given
+    value: float  # Watts
+
+class MeterReadingsBatch(BaseModel):
+    readings: List[MeterReading]
+
+class MeterReadingsResponse(BaseModel):
+    accepted: int
+    products: Dict[str, float]  # product_id -> month-to-date kWh after the batch
+
+class MonthToDateResponse(BaseModel):
+    product_id: str
+    year_month: str  # YYYY-MM format
+    kwh: float
+    projected_kwh: float
+    projected_amount: float
+    readings: int
+    updated_at: Optional[str] = None
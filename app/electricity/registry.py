@@ -0,0 +1,135 @@
+"""
+Product registry.
+
+Listing meters used to mean downloading the whole electricity_usage tree.
+The registry keeps one small record per product instead:
+
+    product_registry/{product_id}
+        first_reading_date: YYYY-MM-DD
+        last_reading_date:  YYYY-MM-DD
+        last_seen:          ISO timestamp of the last connection status update
+
+Products register themselves on their first connection status update or
+ingested reading, and the registry can be rebuilt from shallow key listings
+(which never download readings) with `python -m app.electricity.registry
+rebuild`. Meters that write readings straight to Firebase never register
+themselves, so the registry is only taken as complete once a rebuild is
+recorded in registry_state/rebuilt_at; until then it is merged with a shallow
+listing of electricity_usage. Billing always merges that listing in, so a
+meter added since the last rebuild is still billed.
+"""
+import argparse
+import asyncio
+
+from fastapi.logger import logger
+
+from app.config import get_current_time
+from app.db.firebase import async_database
+
+REGISTRY_ROOT = "product_registry"
+REGISTRY_STATE_PATH = "registry_state"
+
+
+def is_date_key(key: str) -> bool:
+    """Date nodes under electricity_usage/{product_id} look like YYYY-MM-DD"""
+    return len(key) == 10 and key[4] == '-' and key[7] == '-'
+
+
+class ProductRegistry:
+    @staticmethod
+    async def list_products(complete: bool = False) -> dict:
+        """
+        Return {product_id: metadata} for every known product. With complete,
+        products found in electricity_usage but not registered are included
+        even when the registry has been rebuilt.
+        """
+        registry, state = await asyncio.gather(
+            async_database.child(REGISTRY_ROOT).get(),
+            async_database.child(REGISTRY_STATE_PATH).get()
+        )
+        registry = registry or {}
+        if registry and (state or {}).get("rebuilt_at") and not complete:
+            return registry
+
+        # Meters writing to Firebase directly are only known to the listing
+        unregistered = [pid for pid in await ProductRegistry.shallow_product_ids() if pid not in registry]
+        if unregistered:
+            logger.warning(f"{len(unregistered)} product(s) with readings are not in the product registry "
+                           f"(run `python -m app.electricity.registry rebuild`): {', '.join(unregistered[:10])}")
+        return {**{product_id: {} for product_id in unregistered}, **registry}
+
+    @staticmethod
+    async def list_product_ids(complete: bool = False) -> list:
+        return sorted(await ProductRegistry.list_products(complete))
+
+    @staticmethod
+    async def shallow_product_ids() -> list:
+        """Product IDs under electricity_usage, read without their readings"""
+        keys = await async_database.child("electricity_usage").keys()
+        return [key for key in keys if key != "connection_status"]
+
+    @staticmethod
+    def registration_updates(product_id: str, **metadata) -> dict:
+        """Multi-path update entries that record metadata for a product"""
+        return {f"{REGISTRY_ROOT}/{product_id}/{key}": value for key, value in metadata.items()}
+
+    @staticmethod
+    async def record_reading_dates(product_id: str, first_date: str, last_date: str):
+        """
+        Widen a product's first_reading_date / last_reading_date to cover
+        readings from first_date to last_date, registering it if needed.
+        Late readings never move last_reading_date back.
+        """
+        def widen(record):
+            record = dict(record or {})
+            record["first_reading_date"] = min(record.get("first_reading_date") or first_date, first_date)
+            record["last_reading_date"] = max(record.get("last_reading_date") or last_date, last_date)
+            return record
+
+        await async_database.child(f"{REGISTRY_ROOT}/{product_id}").transaction(widen)
+
+    @staticmethod
+    async def describe(product_id: str) -> dict:
+        """Build a product's registry record from a shallow listing of its dates"""
+        dates = [key for key in await async_database.child(f"electricity_usage/{product_id}").keys() if is_date_key(key)]
+        record = {}
+        if dates:
+            record["first_reading_date"] = dates[0]
+            record["last_reading_date"] = dates[-1]
+        return record
+
+    @staticmethod
+    async def rebuild() -> int:
+        """Rebuild the registry from electricity_usage. Returns the number of products."""
+        product_ids = await ProductRegistry.shallow_product_ids()
+        records = await asyncio.gather(*(ProductRegistry.describe(product_id) for product_id in product_ids))
+
+        updates = {}
+        for product_id, record in zip(product_ids, records):
+            record["registered_at"] = get_current_time().isoformat()
+            updates.update(ProductRegistry.registration_updates(product_id, **record))
+
+        updates[f"{REGISTRY_STATE_PATH}/rebuilt_at"] = get_current_time().isoformat()
+        await async_database.update(updates)
+        logger.info(f"Product registry rebuilt with {len(product_ids)} products")
+        return len(product_ids)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the product registry")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("rebuild", help="Rebuild the registry from electricity_usage")
+    subparsers.add_parser("list", help="List registered products")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "rebuild":
+        count = asyncio.run(ProductRegistry.rebuild())
+        print(f"Registered {count} product(s)")
+    else:
+        for product_id, record in sorted(asyncio.run(ProductRegistry.list_products()).items()):
+            print(product_id, record.get("first_reading_date", "-"), record.get("last_reading_date", "-"))
+
+
+if __name__ == "__main__":
+    main()
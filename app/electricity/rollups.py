@@ -0,0 +1,399 @@
+"""
+Materialized usage rollups.
+
+Raw readings live at electricity_usage/{product_id}/{date}/{hour}/{minute}.
+Rollups keep (sum, count, min, max) of those readings per hour, day and month
+so that chart and billing queries over long periods don't have to download
+every minute value again:
+
+    electricity_rollups/{product_id}/hourly/{YYYY-MM-DD}/{HH}
+    electricity_rollups/{product_id}/daily/{YYYY-MM}/{DD}
+    electricity_rollups/{product_id}/monthly/{YYYY}/{MM}
+
+Only settled periods are stored: those that ended more than METER_BUFFER_DAYS
+ago. Raw data of the open period still changes, and meters writing straight
+to Firebase may add readings they held back to a closed period until then,
+so younger periods are computed from raw readings on every read. Rollups are
+written the first time a settled period is read from raw data (one range
+read per month of raw days), and can be backfilled for history with
+`python -m app.electricity.rollups backfill` (or `backfill-all` for every
+product in the product registry).
+
+Settled months can also be compacted into the memory-mapped on-disk archive
+(app.electricity.archive) with `archive` / `archive-all`. Where an up to
+date archive exists, rollups and minute charts are computed from it instead
+of raw readings.
+
+"watt_hours" on every rollup is the sum of the hourly averages, which is the
+energy figure billing uses.
+
+    electricity_rollups/{product_id}/revisions/{YYYY-MM}
+
+records when late readings last changed a closed month, so that chart
+responses for it can be revalidated by HTTP caches.
+"""
+import argparse
+import asyncio
+import calendar
+from datetime import datetime, timedelta
+
+from fastapi.logger import logger
+
+from app.config import get_current_time, SRI_LANKA_TZ, ARCHIVE_PATH, METER_BUFFER
+from app.db.cache import usage_cache
+from app.db.firebase import async_database
+from app.electricity import archive
+from app.electricity.aggregation import hour_rows, row_stats, stats_dict, summarize_days
+from app.electricity.registry import ProductRegistry
+
+ROLLUP_ROOT = "electricity_rollups"
+
+
+def empty_stats():
+    return {"sum": 0.0, "count": 0, "min": None, "max": None, "watt_hours": 0.0}
+
+
+def summarize_hour(hour_data):
+    """Build the rollup of a single raw hour payload."""
+    return stats_dict(row_stats(hour_rows([hour_data])), 0)
+
+
+def merge_stats(stats_list):
+    """Combine finer rollups into a coarser one."""
+    total = empty_stats()
+    for stats in stats_list:
+        if not stats or not stats.get("count"):
+            continue
+        total["sum"] += stats.get("sum", 0.0)
+        total["count"] += stats["count"]
+        total["watt_hours"] += stats.get("watt_hours", 0.0)
+        for key, pick in (("min", min), ("max", max)):
+            value = stats.get(key)
+            if value is not None:
+                total[key] = value if total[key] is None else pick(total[key], value)
+    return total
+
+
+def summarize_day(day_data):
+    """Return ({hour: stats}, day stats) for a raw day payload."""
+    return summarize_days({"day": day_data})["day"]
+
+
+def stats_mean(stats):
+    """Average reading of a rollup, or None when it holds no readings."""
+    if not stats or not stats.get("count"):
+        return None
+    return stats["sum"] / stats["count"]
+
+
+def hour_end(date_str: str, hour: str):
+    """Moment an hour of readings stops changing"""
+    start = datetime.strptime(f"{date_str} {hour}", "%Y-%m-%d %H")
+    return SRI_LANKA_TZ.localize(start + timedelta(hours=1))
+
+
+def day_end(date_str: str):
+    """Moment a day of readings stops changing"""
+    start = datetime.strptime(date_str, "%Y-%m-%d")
+    return SRI_LANKA_TZ.localize(start + timedelta(days=1))
+
+
+def month_end(year_month: str):
+    """Moment a month of readings stops changing"""
+    year, month = (int(part) for part in year_month.split('-'))
+    if month == 12:
+        return SRI_LANKA_TZ.localize(datetime(year + 1, 1, 1))
+    return SRI_LANKA_TZ.localize(datetime(year, month + 1, 1))
+
+
+def year_end(year: str):
+    """Moment a year of readings stops changing"""
+    return SRI_LANKA_TZ.localize(datetime(int(year) + 1, 1, 1))
+
+
+# closes_at of nodes that never stop changing, cached for CACHE_OPEN_TTL only
+NEVER_CLOSES = SRI_LANKA_TZ.localize(datetime(9999, 1, 1))
+
+
+class RollupService:
+    @staticmethod
+    def is_closed_day(date_str: str) -> bool:
+        """A day is closed once the current day has started."""
+        return date_str < get_current_time().strftime("%Y-%m-%d")
+
+    @staticmethod
+    def is_settled_day(date_str: str) -> bool:
+        """A day is settled, and its rollups final, METER_BUFFER_DAYS after it ended."""
+        return day_end(date_str) + METER_BUFFER <= get_current_time()
+
+    @staticmethod
+    def is_settled_month(year_month: str) -> bool:
+        """A month is settled, and its rollup final, METER_BUFFER_DAYS after it ended."""
+        return month_end(year_month) + METER_BUFFER <= get_current_time()
+
+    @staticmethod
+    async def get_hourly_rollup(product_id: str, date_str: str) -> dict:
+        return await async_database.child(f"{ROLLUP_ROOT}/{product_id}/hourly/{date_str}").get(
+            closes_at=day_end(date_str)
+        ) or {}
+
+    @staticmethod
+    async def get_daily_rollups(product_id: str, year_month: str) -> dict:
+        return await async_database.child(f"{ROLLUP_ROOT}/{product_id}/daily/{year_month}").get(
+            closes_at=month_end(year_month)
+        ) or {}
+
+    @staticmethod
+    async def get_monthly_rollups(product_id: str, year: str) -> dict:
+        return await async_database.child(f"{ROLLUP_ROOT}/{product_id}/monthly/{year}").get(
+            closes_at=year_end(year)
+        ) or {}
+
+    @staticmethod
+    async def get_revisions(product_id: str) -> dict:
+        """{YYYY-MM: ISO time} of the closed months late readings changed"""
+        return await async_database.child(f"{ROLLUP_ROOT}/{product_id}/revisions").get(
+            closes_at=NEVER_CLOSES
+        ) or {}
+
+    @staticmethod
+    async def open_archive(product_id: str, year_month: str):
+        """The archive of a settled month if there is one and no late readings came after it"""
+        if not ARCHIVE_PATH or not RollupService.is_settled_month(year_month):
+            return None
+        month_archive = archive.open_month(product_id, year_month)
+        if month_archive is None:
+            return None
+        revisions = await RollupService.get_revisions(product_id)
+        if month_archive.revision != revisions.get(year_month, ""):
+            return None
+        return month_archive
+
+    @staticmethod
+    async def get_raw_month(product_id: str, year_month: str) -> dict:
+        """Read every raw day of a month with one ordered-by-key range query."""
+        return await async_database.child(f"electricity_usage/{product_id}").range(
+            f"{year_month}-01", f"{year_month}-31", closes_at=month_end(year_month)
+        )
+
+    @staticmethod
+    async def store_days(product_id: str, days: dict):
+        """
+        Store the rollups of several settled days in one multi-path write.
+        days maps YYYY-MM-DD to (hourly, daily).
+        """
+        updates = {}
+        for date_str, (hourly, daily) in days.items():
+            updates[f"daily/{date_str[:7]}/{date_str[8:]}"] = daily
+            if hourly:
+                updates[f"hourly/{date_str}"] = hourly
+
+        if updates:
+            await async_database.child(f"{ROLLUP_ROOT}/{product_id}").update(updates)
+
+    @staticmethod
+    async def store_day(product_id: str, date_str: str, hourly: dict, daily: dict):
+        """Store the hourly and daily rollups of a settled day in one write."""
+        await RollupService.store_days(product_id, {date_str: (hourly, daily)})
+
+    @staticmethod
+    async def store_month(product_id: str, year_month: str, monthly: dict):
+        year, month = year_month.split('-')
+        await async_database.child(f"{ROLLUP_ROOT}/{product_id}/monthly/{year}/{month}").set(monthly)
+
+    @staticmethod
+    async def rollup_day(product_id: str, date_str: str, day_data=None) -> dict:
+        """
+        Summarize one day from raw readings, storing the result if the day is settled.
+        Returns the day's rollup.
+        """
+        if day_data is None:
+            day_data = await async_database.child(f"electricity_usage/{product_id}/{date_str}").get(
+                closes_at=day_end(date_str)
+            ) or {}
+
+        hourly, daily = summarize_day(day_data)
+        if RollupService.is_settled_day(date_str):
+            await RollupService.store_day(product_id, date_str, hourly, daily)
+        return daily
+
+    @staticmethod
+    async def rollup_days(product_id: str, year_month: str, daily_rollups=None) -> dict:
+        """
+        Return the rollup of every day of a month keyed by DD.
+
+        Days without a stored rollup are filled from the month's archive, or
+        else from a single range read of the raw month, and the settled ones
+        are stored in a single write.
+        """
+        if daily_rollups is None:
+            daily_rollups = await RollupService.get_daily_rollups(product_id, year_month)
+
+        year, month = year_month.split('-')
+        _, days_in_month = calendar.monthrange(int(year), int(month))
+        missing = [f"{day:02d}" for day in range(1, days_in_month + 1) if f"{day:02d}" not in daily_rollups]
+        if not missing:
+            return dict(daily_rollups)
+
+        month_archive = await RollupService.open_archive(product_id, year_month)
+        if month_archive is not None:
+            summaries = month_archive.summarize_days(missing)
+        else:
+            month_data = await RollupService.get_raw_month(product_id, year_month)
+
+            # Every hour of the missing days is aggregated in one pass. Hour
+            # rollups are only built when some of the days will be stored
+            hourly = any(RollupService.is_settled_day(f"{year_month}-{day_str}") for day_str in missing)
+            summaries = summarize_days({f"{year_month}-{day_str}": month_data.get(f"{year_month}-{day_str}")
+                                        for day_str in missing}, hourly=hourly)
+
+        result = dict(daily_rollups)
+        settled_days = {}
+        for date_str, (hourly, daily) in summaries.items():
+            result[date_str[8:]] = daily
+            if RollupService.is_settled_day(date_str):
+                settled_days[date_str] = (hourly, daily)
+
+        await RollupService.store_days(product_id, settled_days)
+        return result
+
+    @staticmethod
+    async def rollup_month(product_id: str, year_month: str, daily_rollups=None) -> dict:
+        """
+        Summarize one month from daily rollups, falling back to raw readings for
+        days that have no rollup yet. The result is stored if the month is settled.
+        """
+        days = await RollupService.rollup_days(product_id, year_month, daily_rollups)
+
+        monthly = merge_stats(days.values())
+        if RollupService.is_settled_month(year_month):
+            await RollupService.store_month(product_id, year_month, monthly)
+        return monthly
+
+    @staticmethod
+    async def invalidate_day(product_id: str, date_str: str):
+        """
+        Discard the stored and cached rollups covering a day, e.g. when readings
+        arrive after the day was rolled up. They are rebuilt on the next read,
+        and the month's revision moves on so cached responses get refetched.
+        """
+        year, month, day = date_str.split('-')
+        await async_database.child(f"{ROLLUP_ROOT}/{product_id}").update({
+            f"hourly/{date_str}": None,
+            f"daily/{year}-{month}/{day}": None,
+            f"monthly/{year}/{month}": None,
+            f"revisions/{year}-{month}": get_current_time().isoformat(),
+        })
+        usage_cache.invalidate(f"electricity_usage/{product_id}/{date_str}")
+
+    @staticmethod
+    async def backfill(product_id: str, start_month: str, end_month: str, force: bool = False) -> int:
+        """
+        Materialize rollups for every settled month between start_month and
+        end_month (YYYY-MM, inclusive). Existing rollups are kept unless force
+        is set. Returns the number of months processed.
+        """
+        year, month = (int(part) for part in start_month.split('-'))
+        processed = 0
+
+        while f"{year:04d}-{month:02d}" <= end_month:
+            year_month = f"{year:04d}-{month:02d}"
+            if not RollupService.is_settled_month(year_month):
+                break
+
+            daily_rollups = {} if force else await RollupService.get_daily_rollups(product_id, year_month)
+            monthly = await RollupService.rollup_month(product_id, year_month, daily_rollups)
+            logger.info(f"Rolled up {year_month} for product {product_id}: {monthly['count']} readings")
+            processed += 1
+
+            month += 1
+            if month > 12:
+                year, month = year + 1, 1
+
+        return processed
+
+    @staticmethod
+    async def archive(product_id: str, start_month: str, end_month: str, force: bool = False) -> int:
+        """
+        Write the on-disk archive of every settled month between start_month
+        and end_month (YYYY-MM, inclusive). Months that ended less than
+        METER_BUFFER_DAYS ago are refused, since meters may still write
+        readings they held back into them. Up to date archives are kept
+        unless force is set. Returns the number of months written.
+        """
+        if not ARCHIVE_PATH:
+            raise ValueError("ARCHIVE_PATH is not set")
+
+        year, month = (int(part) for part in start_month.split('-'))
+        written = 0
+
+        while f"{year:04d}-{month:02d}" <= end_month:
+            year_month = f"{year:04d}-{month:02d}"
+            if not RollupService.is_settled_month(year_month):
+                if RollupService.is_settled_day(f"{year_month}-01"):
+                    logger.warning(f"Not archiving {year_month} for product {product_id}: it ended less than "
+                                   f"METER_BUFFER_DAYS ago and meters may still write to it")
+                break
+
+            if force or await RollupService.open_archive(product_id, year_month) is None:
+                revision = (await RollupService.get_revisions(product_id)).get(year_month, "")
+                month_data = await RollupService.get_raw_month(product_id, year_month)
+                size = archive.write_month(product_id, year_month, month_data, revision)
+                logger.info(f"Archived {year_month} for product {product_id}: {size} bytes")
+                written += 1
+
+            month += 1
+            if month > 12:
+                year, month = year + 1, 1
+
+        return written
+
+
+async def run_backfill(args, end_month: str):
+    if args.command in ("backfill", "archive"):
+        product_ids = [args.product_id]
+    else:
+        product_ids = await ProductRegistry.list_product_ids()
+
+    for product_id in product_ids:
+        if args.command.startswith("archive"):
+            written = await RollupService.archive(product_id, args.start_month, end_month, force=args.force)
+            print(f"Archived {written} month(s) for {product_id}")
+        else:
+            processed = await RollupService.backfill(product_id, args.start_month, end_month, force=args.force)
+            print(f"Backfilled {processed} month(s) for {product_id}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Materialize electricity usage rollups and archives")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    backfill_parser = subparsers.add_parser("backfill", help="Backfill rollups for settled months")
+    backfill_parser.add_argument("product_id")
+    backfill_parser.add_argument("start_month", help="YYYY-MM")
+    backfill_parser.add_argument("end_month", nargs="?", default=None, help="YYYY-MM (defaults to last month)")
+    backfill_parser.add_argument("--force", action="store_true", help="Recompute existing rollups")
+
+    backfill_all_parser = subparsers.add_parser("backfill-all", help="Backfill rollups for every registered product")
+    backfill_all_parser.add_argument("start_month", help="YYYY-MM")
+    backfill_all_parser.add_argument("end_month", nargs="?", default=None, help="YYYY-MM (defaults to last month)")
+    backfill_all_parser.add_argument("--force", action="store_true", help="Recompute existing rollups")
+
+    archive_parser = subparsers.add_parser("archive", help="Archive settled months of readings to ARCHIVE_PATH")
+    archive_parser.add_argument("product_id")
+    archive_parser.add_argument("start_month", help="YYYY-MM")
+    archive_parser.add_argument("end_month", nargs="?", default=None, help="YYYY-MM (defaults to last month)")
+    archive_parser.add_argument("--force", action="store_true", help="Rewrite up to date archives")
+
+    archive_all_parser = subparsers.add_parser("archive-all", help="Archive settled months of every registered product")
+    archive_all_parser.add_argument("start_month", help="YYYY-MM")
+    archive_all_parser.add_argument("end_month", nargs="?", default=None, help="YYYY-MM (defaults to last month)")
+    archive_all_parser.add_argument("--force", action="store_true", help="Rewrite up to date archives")
+
+    args = parser.parse_args(argv)
+
+    end_month = args.end_month or datetime.strftime(get_current_time(), "%Y-%m")
+    asyncio.run(run_backfill(args, end_month))
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,27 @@
-from fastapi import APIRouter, HTTPException
+from typing import Literal, Union
 
-from app.electricity.models import ( ChartDataResponse, ConnectionStatusUpdate, TenantsStatusResponse, TenantsListRequest)
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+from app.electricity.charts import json_response, chart_validators
+from app.electricity.models import ( ChartDataResponse, ColumnarChartResponse, RangeChartResponse, ColumnarRangeChartResponse, ConnectionStatusUpdate, TenantsStatusResponse, TenantsListRequest,
+                                     MeterReadingsBatch, MeterReadingsResponse, MonthToDateResponse,
+                                     ChartBatchRequest, ChartBatchResponse)
 from app.electricity.service import ElectricityUsageService, ConnectionService
+from app.electricity.ingestion import IngestionService
+from app.electricity.status import status_table
+from app.electricity.live import live_hub
 
 router = APIRouter()
 
+# Chart shapes: "points" is the original list of {label, value} objects,
+# "columnar" sends labels[] and values[] side by side
+ChartFormat = Literal["points", "columnar"]
+ChartResponse = Union[ChartDataResponse, ColumnarChartResponse]
+
 
-@router.get("/minutely/{product_id}/{date}/{hour}", response_model=ChartDataResponse)
-async def get_minutely_usage_get(product_id: str, date: str, hour: str):
+@router.get("/minutely/{product_id}/{date}/{hour}", response_model=ChartResponse)
+async def get_minutely_usage_get(request: Request, product_id: str, date: str, hour: str, format: ChartFormat = "points"):
     """
     Get minute-by-minute electricity usage for a specific hour in a day using GET.
 
@@ -19,13 +33,25 @@ async def get_minutely_usage_get(product_id: str, date: str, hour: str):
     - X-axis shows minutes (00-59)
     - Y-axis shows average watt values
 
+    format=columnar returns labels[] and values[] instead of data_points.
+    Responses carry ETag, Last-Modified and Cache-Control headers; past
+    periods are answered with 304 to a matching If-None-Match without
+    building the chart.
+
     This endpoint is publicly accessible.
     """
-    return ElectricityUsageService.get_minutely_usage(product_id, date, hour)
+    validators = await chart_validators(request, product_id, "minutely", f"{date}/{hour}")
+    if validators.matches(request):
+        return validators.not_modified()
 
+    chart = await ElectricityUsageService.get_minutely_usage(product_id, date, hour)
+    if chart.failed:
+        validators = validators.uncached()
+    return json_response(request, chart.as_dict(format), validators)
 
-@router.get("/hourly/{product_id}/{date}", response_model=ChartDataResponse)
-async def get_hourly_usage_get(product_id: str, date: str):
+
+@router.get("/hourly/{product_id}/{date}", response_model=ChartResponse)
+async def get_hourly_usage_get(request: Request, product_id: str, date: str, format: ChartFormat = "points"):
     """
     Get hourly electricity usage for a specific day using GET.
 
@@ -36,13 +62,25 @@ async def get_hourly_usage_get(product_id: str, date: str):
     - X-axis shows hours (00-23)
     - Y-axis shows average watt values
 
+    format=columnar returns labels[] and values[] instead of data_points.
+    Responses carry ETag, Last-Modified and Cache-Control headers; past
+    periods are answered with 304 to a matching If-None-Match without
+    building the chart.
+
     This endpoint is publicly accessible.
     """
-    return ElectricityUsageService.get_hourly_usage(product_id, date)
+    validators = await chart_validators(request, product_id, "hourly", date)
+    if validators.matches(request):
+        return validators.not_modified()
+
+    chart = await ElectricityUsageService.get_hourly_usage(product_id, date)
+    if chart.failed:
+        validators = validators.uncached()
+    return json_response(request, chart.as_dict(format), validators)
 
 
-@router.get("/daily/{product_id}/{year_month}", response_model=ChartDataResponse)
-async def get_daily_usage_get(product_id: str, year_month: str):
+@router.get("/daily/{product_id}/{year_month}", response_model=ChartResponse)
+async def get_daily_usage_get(request: Request, product_id: str, year_month: str, format: ChartFormat = "points"):
     """
     Get daily electricity usage for a specific month using GET.
 
@@ -53,13 +91,25 @@ async def get_daily_usage_get(product_id: str, year_month: str):
     - X-axis shows days (01-31)
     - Y-axis shows average watt values
 
+    format=columnar returns labels[] and values[] instead of data_points.
+    Responses carry ETag, Last-Modified and Cache-Control headers; past
+    periods are answered with 304 to a matching If-None-Match without
+    building the chart.
+
     This endpoint is publicly accessible.
     """
-    return ElectricityUsageService.get_daily_usage(product_id, year_month)
+    validators = await chart_validators(request, product_id, "daily", year_month)
+    if validators.matches(request):
+        return validators.not_modified()
+
+    chart = await ElectricityUsageService.get_daily_usage(product_id, year_month)
+    if chart.failed:
+        validators = validators.uncached()
+    return json_response(request, chart.as_dict(format), validators)
 
 
-@router.get("/monthly/{product_id}/{year}", response_model=ChartDataResponse)
-async def get_monthly_usage_get(product_id: str, year: str):
+@router.get("/monthly/{product_id}/{year}", response_model=ChartResponse)
+async def get_monthly_usage_get(request: Request, product_id: str, year: str, format: ChartFormat = "points"):
     """
     Get monthly electricity usage for a specific year using GET.
 
@@ -70,18 +120,104 @@ async def get_monthly_usage_get(product_id: str, year: str):
     - X-axis shows months (01-12)
     - Y-axis shows average watt values
 
+    format=columnar returns labels[] and values[] instead of data_points.
+    Responses carry ETag, Last-Modified and Cache-Control headers; past
+    periods are answered with 304 to a matching If-None-Match without
+    building the chart.
+
     This endpoint is publicly accessible.
     """
-    return ElectricityUsageService.get_monthly_usage(product_id, year)
+    validators = await chart_validators(request, product_id, "monthly", year)
+    if validators.matches(request):
+        return validators.not_modified()
+
+    chart = await ElectricityUsageService.get_monthly_usage(product_id, year)
+    if chart.failed:
+        validators = validators.uncached()
+    return json_response(request, chart.as_dict(format), validators)
+
+
+@router.get("/range/{product_id}", response_model=Union[RangeChartResponse, ColumnarRangeChartResponse])
+async def get_range_usage(request: Request, product_id: str, start: str, end: str, max_points: int = 1000,
+                          format: ChartFormat = "points"):
+    """
+    Get electricity usage between two moments, for zoomable charts.
+
+    - product_id: The product identifier
+    - start, end: YYYY-MM-DD or YYYY-MM-DDTHH:MM (Sri Lanka time unless an offset is given)
+    - max_points: Most points to return
+
+    The resolution (minutely, hourly or daily averages) is chosen from the
+    length of the range and the series is downsampled with
+    Largest-Triangle-Three-Buckets, so a three month view returns about
+    max_points representative points instead of every minute.
+    """
+    try:
+        chart, resolution, source_points = await ElectricityUsageService.get_range_usage(
+            product_id, start, end, max_points
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return json_response(request, {**chart.as_dict(format), "resolution": resolution, "source_points": source_points})
+
+
+@router.get("/live/{product_id}")
+async def stream_live_usage(product_id: str):
+    """
+    Stream new minute readings and connection status changes of a product as
+    Server-Sent Events.
+
+    - `reading` events: {"date", "hour", "minute", "value"} as readings land
+    - `status` events: {"connection_status"} when the status changes
+    - `dropped` event: the client fell behind and the stream ends; reconnect
+
+    All viewers of a product share one upstream Firebase listener.
+    """
+    return StreamingResponse(
+        live_hub.stream(product_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.post("/batch", response_model=ChartBatchResponse)
+async def get_charts_batch(request: Request, batch: ChartBatchRequest, format: ChartFormat = "points"):
+    """
+    Get many charts in one request, e.g. every tenant's daily chart for a dashboard.
+
+    Each query names a product_id, a granularity (minutely, hourly, daily or
+    monthly) and a period in the format of the matching endpoint:
+    YYYY-MM-DD/HH, YYYY-MM-DD, YYYY-MM or YYYY.
+
+    Results come back in the order of the queries. A query that fails carries
+    an error message instead of a chart without failing the others.
+    format=columnar returns every chart as labels[] and values[].
+    """
+    try:
+        results = await ElectricityUsageService.get_charts(batch.queries, format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return json_response(request, {"results": results})
 
 
 @router.post("/connection-status", response_model=TenantsStatusResponse)
 async def get_connection_status(request: TenantsListRequest):
     """
     Get the connection status for each product ID in the request
+
+    Answered from this worker's in-memory status table while its Firebase
+    listener is live. listener_age_seconds tells how long ago the listener
+    last received a change.
     """
     tenant_statuses = await ConnectionService.get_connection_statuses(request.tenants)
-    return TenantsStatusResponse(tenants=tenant_statuses)
+    age = status_table.age()
+    return TenantsStatusResponse(
+        tenants=tenant_statuses,
+        listener_live=status_table.is_live(),
+        listener_age_seconds=round(age, 3) if age is not None else None
+    )
 
 
 @router.post("/update-connection-status")
@@ -102,4 +238,30 @@ async def update_connection_status(request: ConnectionStatusUpdate):
 
     return {
         "message": f"Connection Status of {request.product_id} updated to {request.connection_status} successfully"
-    }
\ No newline at end of file
+    }
+
+
+@router.post("/readings", response_model=MeterReadingsResponse)
+async def ingest_readings(request: MeterReadingsBatch):
+    """
+    Store a batch of minute readings from one or more meters.
+
+    The raw values and the running hourly averages / month-to-date energy of
+    every product in the batch are updated together. Returns the
+    month-to-date kWh of each product after the batch.
+    """
+    try:
+        products = await IngestionService.ingest(request.readings)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return MeterReadingsResponse(accepted=len(request.readings), products=products)
+
+
+@router.get("/month-to-date/{product_id}", response_model=MonthToDateResponse)
+async def get_month_to_date(product_id: str):
+    """
+    Get the energy used so far this month from the running totals, with the
+    kWh and bill amount projected to the end of the month.
+    """
+    return await IngestionService.get_month_to_date(product_id)
@@ -1,128 +1,133 @@
 from datetime import datetime, timedelta
+import asyncio
 import calendar
 import logging
-from typing import List
+from typing import List, Tuple
+import numpy as np
 from fastapi.logger import logger
-from app.db.firebase import database
-from app.electricity.models import ChartDataPoint, ChartDataResponse,  BillResponse ,TenantRequest, TenantStatusResponse
+from app.config import (get_current_time, SRI_LANKA_TZ, CHART_BATCH_MAX, CHART_BATCH_FANOUT,
+                        RANGE_MAX_POINTS, RANGE_OVERSAMPLE)
+from app.db.firebase import async_database
+from app.db.write_behind import write_behind
+from app.electricity.aggregation import hour_array, day_hours, lttb
+from app.electricity.registry import ProductRegistry
+from app.electricity.status import status_table, STATUS_ROOT
+from app.electricity.rollups import RollupService, summarize_day, stats_mean, hour_end, day_end
+from app.electricity.charts import Chart
+from app.electricity.models import (BillResponse ,TenantRequest, TenantStatusResponse, ChartQuery)
+
+# Range chart resolutions, finest first, with their bucket size in minutes
+RANGE_RESOLUTIONS = (("minutely", 1), ("hourly", 60), ("daily", 24 * 60))
+
+
+def parse_range_time(value: str) -> datetime:
+    """YYYY-MM-DD or an ISO date and time, as naive Sri Lanka local time"""
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid time {value!r}, expected YYYY-MM-DD or YYYY-MM-DDTHH:MM")
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(SRI_LANKA_TZ).replace(tzinfo=None)
+    return moment
+
+
+def range_resolution(start: datetime, end: datetime, max_points: int) -> str:
+    """Finest resolution with at most RANGE_OVERSAMPLE times max_points buckets in the range"""
+    minutes = (end - start).total_seconds() / 60
+    for resolution, size in RANGE_RESOLUTIONS:
+        if minutes / size <= max_points * RANGE_OVERSAMPLE:
+            return resolution
+    return RANGE_RESOLUTIONS[-1][0]
 
 
 class ElectricityUsageService:
     @staticmethod
-    def get_minutely_usage(product_id: str, date_str: str, hour: str) -> ChartDataResponse:
+    async def get_minutely_usage(product_id: str, date_str: str, hour: str) -> Chart:
         """Get minutely average electricity usage for a specific hour in a day."""
         try:
-            # Access the Firebase path for the specific product, date, and hour
-            ref_path = f"electricity_usage/{product_id}/{date_str}/{hour}"
-            minute_data = database.child(ref_path).get() or {}
-
-            # Convert to chart data points sorted by minute
-            data_points = []
-
-            # Handle both object format and array format data
-            if isinstance(minute_data, dict):
-                # Process dictionary-style data (minute: value)
-                for minute, value in sorted(minute_data.items()):
-                    # Skip null values and ensure we have a valid float
-                    if value is not None:
-                        try:
-                            watt_value = float(value)
-                            data_points.append(ChartDataPoint(
-                                label=minute,
-                                value=round(watt_value, 2)
-                            ))
-                        except (ValueError, TypeError):
-                            # Skip invalid values
-                            logger.warning(f"Invalid value for minute {minute}: {value}")
-            elif isinstance(minute_data, list):
-                # Process array-style data where index is the minute
-                for index, value in enumerate(minute_data):
-                    # Skip null values
-                    if value is not None:
-                        try:
-                            watt_value = float(value)
-                            minute_str = f"{index:02d}"
-                            data_points.append(ChartDataPoint(
-                                label=minute_str,
-                                value=round(watt_value, 2)
-                            ))
-                        except (ValueError, TypeError):
-                            # Skip invalid values
-                            logger.warning(f"Invalid value for minute {index}: {value}")
-
-            return ChartDataResponse(
-                data_points=data_points,
+            month_archive = await RollupService.open_archive(product_id, date_str[:7])
+            if month_archive is not None:
+                minute_values = month_archive.hour(int(date_str[8:]), int(hour))
+            else:
+                # Access the Firebase path for the specific product, date, and hour
+                ref_path = f"electricity_usage/{product_id}/{date_str}/{hour}"
+                minute_data = await async_database.child(ref_path).get(closes_at=hour_end(date_str, hour)) or {}
+
+                # Dict and list payloads become one 60-slot array, NaN where a
+                # minute is missing or invalid
+                minute_values = hour_array(minute_data)
+
+            # Labels and values of the minutes with readings, in minute order
+            minutes = np.flatnonzero(~np.isnan(minute_values))
+            labels = [f"{minute:02d}" for minute in minutes.tolist()]
+            values = [round(value, 2) for value in minute_values[minutes].tolist()]
+
+            return Chart(
+                labels=labels,
+                values=values,
                 chart_title=f"Minute-by-Minute Usage on {date_str} at {hour}:00",
                 x_axis_label="Minute"
             )
         except Exception as e:
             logger.error(f"Error retrieving minutely data: {str(e)}")
-            return ChartDataResponse(
-                data_points=[],
+            return Chart(
+                labels=[],
+                values=[],
                 chart_title=f"No data available for {date_str} at {hour}:00",
-                x_axis_label="Minute"
+                x_axis_label="Minute",
+                failed=True
             )
 
     @staticmethod
-    def get_hourly_usage(product_id: str, date_str: str) -> ChartDataResponse:
+    async def get_hourly_usage(product_id: str, date_str: str) -> Chart:
         """Get hourly average electricity usage for a specific day."""
         try:
-            # Access the Firebase path for the specific product and date
-            ref_path = f"electricity_usage/{product_id}/{date_str}"
-            day_data = database.child(ref_path).get() or {}
-
-            data_points = []
+            # Settled days are answered from the hourly rollup when it exists
+            hourly = {}
+            if RollupService.is_settled_day(date_str):
+                hourly = await RollupService.get_hourly_rollup(product_id, date_str)
+
+            if not hourly:
+                month_archive = await RollupService.open_archive(product_id, date_str[:7])
+                if month_archive is not None:
+                    hourly, daily = month_archive.summarize_days([date_str[8:]])[date_str]
+                else:
+                    # Access the Firebase path for the specific product and date
+                    ref_path = f"electricity_usage/{product_id}/{date_str}"
+                    day_data = await async_database.child(ref_path).get(closes_at=day_end(date_str)) or {}
+                    hourly, daily = summarize_day(day_data)
+                if hourly and RollupService.is_settled_day(date_str):
+                    await RollupService.store_day(product_id, date_str, hourly, daily)
+
+            labels, values = [], []
 
             # Process each hour in the day
-            for hour in sorted(day_data.keys()):
-                # Skip non-hour keys like "connection_status"
-                if not hour.isdigit():
-                    continue
-
-                hour_data = day_data.get(hour, {})
-                hour_values = []
-
-                # Handle both object format and array format data
-                if isinstance(hour_data, dict):
-                    # Dictionary format (minute: value)
-                    for minute, value in hour_data.items():
-                        if value is not None:
-                            try:
-                                hour_values.append(float(value))
-                            except (ValueError, TypeError):
-                                continue
-                elif isinstance(hour_data, list):
-                    # Array format where index is the minute
-                    for value in hour_data:
-                        if value is not None:
-                            try:
-                                hour_values.append(float(value))
-                            except (ValueError, TypeError):
-                                continue
-
-                # Calculate the hour's average if we have values
-                if hour_values:
-                    hour_avg = sum(hour_values) / len(hour_values)
-                    data_points.append(ChartDataPoint(
-                        label=f"{hour}:00",
-                        value=round(hour_avg, 2)
-                    ))
-
-            return ChartDataResponse(
-                data_points=data_points,
+            for hour in sorted(hourly.keys()):
+                hour_avg = stats_mean(hourly[hour])
+
+                # Skip hours without readings
+                if hour_avg is not None:
+                    labels.append(f"{hour}:00")
+                    values.append(round(hour_avg, 2))
+
+            return Chart(
+                labels=labels,
+                values=values,
                 chart_title=f"Hourly Usage on {date_str}",
                 x_axis_label="Hour"
             )
         except Exception as e:
             logger.error(f"Error retrieving hourly data: {str(e)}")
-            return ChartDataResponse(
-                data_points=[],
+            return Chart(
+                labels=[],
+                values=[],
                 chart_title=f"No data available for {date_str}",
-                x_axis_label="Hour"
+                x_axis_label="Hour",
+                failed=True
             )
 
     @staticmethod
-    def get_daily_usage(product_id: str, year_month: str) -> ChartDataResponse:
+    async def get_daily_usage(product_id: str, year_month: str) -> Chart:
         """Get daily average electricity usage for a specific month."""
         try:
             # Extract year and month from input
@@ -131,148 +136,254 @@ class ElectricityUsageService:
             # Calculate the number of days in the month
             _, days_in_month = calendar.monthrange(int(year), int(month))
 
-            data_points = []
+            # Rollup of every day of the month keyed by DD; days not summarized
+            # yet are filled from a single range read of the month
+            daily_rollups = await RollupService.rollup_days(product_id, year_month)
+
+            labels, values = [], []
 
             # For each day in the month
             for day in range(1, days_in_month + 1):
-                # Format the date string for Firebase
-                date_str = f"{year_month}-{day:02d}"
-
-                try:
-                    # Get data for the day
-                    day_ref_path = f"electricity_usage/{product_id}/{date_str}"
-                    day_data = database.child(day_ref_path).get()
-
-                    if not day_data:
-                        continue  # Skip if no data for this day
-
-                    # Calculate the daily average across all hours and minutes
-                    all_values = []
-
-                    for hour, hour_data in day_data.items():
-                        # Skip non-hour keys
-                        if not hour.isdigit():
-                            continue
-
-                        # Process each minute in the hour
-                        if isinstance(hour_data, dict):
-                            for minute, value in hour_data.items():
-                                if value is not None:
-                                    try:
-                                        all_values.append(float(value))
-                                    except (ValueError, TypeError):
-                                        continue
-                        elif isinstance(hour_data, list):
-                            for value in hour_data:
-                                if value is not None:
-                                    try:
-                                        all_values.append(float(value))
-                                    except (ValueError, TypeError):
-                                        continue
-
-                    # Add data point if we have values
-                    if all_values:
-                        daily_avg = sum(all_values) / len(all_values)
-                        data_points.append(ChartDataPoint(
-                            label=f"{day:02d}",
-                            value=round(daily_avg, 2)
-                        ))
-                except Exception as e:
-                    logger.warning(f"Error processing day {date_str}: {str(e)}")
-                    continue  # Skip this day if there's an error
+                # Add data point if we have values
+                daily_avg = stats_mean(daily_rollups.get(f"{day:02d}"))
+                if daily_avg is not None:
+                    labels.append(f"{day:02d}")
+                    values.append(round(daily_avg, 2))
 
             # Get month name for the chart title
             month_name = datetime.strptime(month, "%m").strftime("%B")
 
-            return ChartDataResponse(
-                data_points=data_points,
+            return Chart(
+                labels=labels,
+                values=values,
                 chart_title=f"Daily Usage in {month_name} {year}",
                 x_axis_label="Day"
             )
         except Exception as e:
             logger.error(f"Error retrieving daily data: {str(e)}")
-            return ChartDataResponse(
-                data_points=[],
+            return Chart(
+                labels=[],
+                values=[],
                 chart_title=f"No data available for {year_month}",
-                x_axis_label="Day"
+                x_axis_label="Day",
+                failed=True
             )
 
     @staticmethod
-    def get_monthly_usage(product_id: str, year: str) -> ChartDataResponse:
+    async def get_monthly_usage(product_id: str, year: str) -> Chart:
         """Get monthly average electricity usage for a specific year."""
         try:
-            data_points = []
+            labels, values = [], []
+            failed = False
+
+            # Monthly rollups already computed for this year, keyed by MM
+            monthly_rollups = await RollupService.get_monthly_rollups(product_id, year)
+
+            # Months without a rollup are built concurrently
+            month_strs = [f"{month:02d}" for month in range(1, 13)]
+            missing = [month_str for month_str in month_strs if month_str not in monthly_rollups]
+            built = await asyncio.gather(
+                *(RollupService.rollup_month(product_id, f"{year}-{month_str}") for month_str in missing),
+                return_exceptions=True
+            )
+            monthly_rollups = {**monthly_rollups, **dict(zip(missing, built))}
 
             # For each month in the year
-            for month in range(1, 13):
-                month_str = f"{month:02d}"
-
-                try:
-                    # Get all data for the month
-                    month_ref_path = f"electricity_usage/{product_id}"
-                    year_month = f"{year}-{month_str}"
-
-                    # Get all days for this month
-                    all_month_values = []
-
-                    # For each day in the month
-                    _, days_in_month = calendar.monthrange(int(year), int(month))
-                    for day in range(1, days_in_month + 1):
-                        date_str = f"{year_month}-{day:02d}"
-                        day_ref_path = f"{month_ref_path}/{date_str}"
-                        day_data = database.child(day_ref_path).get()
-
-                        if not day_data:
-                            continue  # Skip if no data for this day
-
-                        # Process each hour in the day
-                        for hour, hour_data in day_data.items():
-                            # Skip non-hour keys
-                            if not hour.isdigit():
-                                continue
-
-                            # Process each minute in the hour
-                            if isinstance(hour_data, dict):
-                                for minute, value in hour_data.items():
-                                    if value is not None:
-                                        try:
-                                            all_month_values.append(float(value))
-                                        except (ValueError, TypeError):
-                                            continue
-                            elif isinstance(hour_data, list):
-                                for value in hour_data:
-                                    if value is not None:
-                                        try:
-                                            all_month_values.append(float(value))
-                                        except (ValueError, TypeError):
-                                            continue
-
-                    # Calculate monthly average if we have values
-                    if all_month_values:
-                        monthly_avg = sum(all_month_values) / len(all_month_values)
-
-                        # Get month name for the label
-                        month_name = datetime.strptime(month_str, "%m").strftime("%b")
-                        data_points.append(ChartDataPoint(
-                            label=month_name,
-                            value=round(monthly_avg, 2)
-                        ))
-                except Exception as e:
-                    logger.warning(f"Error processing month {year_month}: {str(e)}")
+            for month_str in month_strs:
+                stats = monthly_rollups[month_str]
+                if isinstance(stats, Exception):
+                    logger.warning(f"Error processing month {year}-{month_str}: {str(stats)}")
+                    failed = True
                     continue  # Skip this month if there's an error
 
-            return ChartDataResponse(
-                data_points=data_points,
+                # Calculate monthly average if we have values
+                monthly_avg = stats_mean(stats)
+                if monthly_avg is not None:
+                    # Get month name for the label
+                    month_name = datetime.strptime(month_str, "%m").strftime("%b")
+                    labels.append(month_name)
+                    values.append(round(monthly_avg, 2))
+
+            return Chart(
+                labels=labels,
+                values=values,
                 chart_title=f"Monthly Usage in {year}",
-                x_axis_label="Month"
+                x_axis_label="Month",
+                failed=failed
             )
         except Exception as e:
             logger.error(f"Error retrieving monthly data: {str(e)}")
-            return ChartDataResponse(
-                data_points=[],
+            return Chart(
+                labels=[],
+                values=[],
                 chart_title=f"No data available for {year}",
-                x_axis_label="Month"
+                x_axis_label="Month",
+                failed=True
+            )
+
+    @staticmethod
+    async def get_range_usage(product_id: str, start: str, end: str, max_points: int) -> Tuple[Chart, str, int]:
+        """
+        Get electricity usage between two moments with at most max_points points.
+
+        The resolution (minutely, hourly or daily averages) is picked from the
+        length of the range, and the series is thinned to max_points with
+        Largest-Triangle-Three-Buckets. Returns the chart, the resolution and
+        the number of points before downsampling.
+        """
+        start_time, end_time = parse_range_time(start), parse_range_time(end)
+        if not 3 <= max_points <= RANGE_MAX_POINTS:
+            raise ValueError(f"max_points must be between 3 and {RANGE_MAX_POINTS}")
+        if start_time >= end_time:
+            raise ValueError("start must be before end")
+
+        # Nothing is recorded ahead of the service clock
+        end_time = min(end_time, get_current_time().replace(tzinfo=None))
+        resolution = range_resolution(start_time, max(end_time, start_time), max_points)
+
+        dates = []
+        day = datetime(start_time.year, start_time.month, start_time.day)
+        while day < end_time:
+            dates.append(day.strftime("%Y-%m-%d"))
+            day += timedelta(days=1)
+
+        # (moment, value) of every bucket with readings, in time order
+        if resolution == "minutely":
+            series = await ElectricityUsageService.range_minutes(product_id, dates)
+        elif resolution == "hourly":
+            series = await ElectricityUsageService.range_hours(product_id, dates)
+        else:
+            series = await ElectricityUsageService.range_days(product_id, dates)
+
+        # Buckets count when they start inside the range
+        size = dict(RANGE_RESOLUTIONS)[resolution]
+        first = start_time - timedelta(minutes=(start_time.hour * 60 + start_time.minute) % size,
+                                       seconds=start_time.second, microseconds=start_time.microsecond)
+        series = [(moment, value) for moment, value in series if first <= moment < end_time]
+
+        kept = range(len(series))
+        if len(series) > max_points:
+            offsets = np.array([(moment - first).total_seconds() for moment, _ in series])
+            kept = lttb(offsets, np.array([value for _, value in series]), max_points).tolist()
+
+        label_format = "%Y-%m-%d" if resolution == "daily" else "%Y-%m-%d %H:%M"
+        chart = Chart(
+            labels=[series[index][0].strftime(label_format) for index in kept],
+            values=[series[index][1] for index in kept],
+            chart_title=f"Usage from {start_time:%Y-%m-%d %H:%M} to {end_time:%Y-%m-%d %H:%M}",
+            x_axis_label="Time"
+        )
+        return chart, resolution, len(series)
+
+    @staticmethod
+    async def range_minutes(product_id: str, dates: List[str]) -> list:
+        """Minute readings of some days, from the archive or each day in one read"""
+        months = list(dict.fromkeys(date_str[:7] for date_str in dates))
+        archives = dict(zip(months, await asyncio.gather(*(
+            RollupService.open_archive(product_id, year_month) for year_month in months
+        ))))
+        unarchived = [date_str for date_str in dates if archives[date_str[:7]] is None]
+        days = dict(zip(unarchived, await asyncio.gather(*(
+            async_database.child(f"electricity_usage/{product_id}/{date_str}").get(closes_at=day_end(date_str))
+            for date_str in unarchived
+        ))))
+
+        series = []
+        for date_str in dates:
+            day = datetime.strptime(date_str, "%Y-%m-%d")
+            month_archive = archives[date_str[:7]]
+            if month_archive is not None:
+                hours = [(f"{hour:02d}", month_archive.hour(day.day, hour)) for hour in range(24)]
+            else:
+                hours = [(hour, hour_array(days[date_str][hour])) for hour in day_hours(days[date_str])]
+
+            for hour, minute_values in hours:
+                minutes = np.flatnonzero(~np.isnan(minute_values))
+                hour_start = day + timedelta(hours=int(hour))
+                series.extend(
+                    (hour_start + timedelta(minutes=minute), round(value, 2))
+                    for minute, value in zip(minutes.tolist(), minute_values[minutes].tolist())
+                )
+        return series
+
+    @staticmethod
+    async def range_hours(product_id: str, dates: List[str]) -> list:
+        """Hourly averages of some days, from their hourly charts"""
+        charts = await asyncio.gather(*(
+            ElectricityUsageService.get_hourly_usage(product_id, date_str) for date_str in dates
+        ))
+
+        series = []
+        for date_str, chart in zip(dates, charts):
+            day = datetime.strptime(date_str, "%Y-%m-%d")
+            series.extend(
+                (day + timedelta(hours=int(label[:2])), value) for label, value in zip(chart.labels, chart.values)
+            )
+        return series
+
+    @staticmethod
+    async def range_days(product_id: str, dates: List[str]) -> list:
+        """Daily averages of some days, from the daily charts of their months"""
+        months = list(dict.fromkeys(date_str[:7] for date_str in dates))
+        charts = await asyncio.gather(*(
+            ElectricityUsageService.get_daily_usage(product_id, year_month) for year_month in months
+        ))
+
+        series = []
+        for year_month, chart in zip(months, charts):
+            series.extend(
+                (datetime.strptime(f"{year_month}-{label}", "%Y-%m-%d"), value)
+                for label, value in zip(chart.labels, chart.values)
             )
+        return series
+
+    @staticmethod
+    async def get_chart(query: ChartQuery) -> Chart:
+        """Build the chart one batch query asks for"""
+        if query.granularity == "minutely":
+            date_str, separator, hour = query.period.partition("/")
+            if not separator:
+                raise ValueError("Minutely periods are given as YYYY-MM-DD/HH")
+            return await ElectricityUsageService.get_minutely_usage(query.product_id, date_str, hour)
+        if query.granularity == "hourly":
+            return await ElectricityUsageService.get_hourly_usage(query.product_id, query.period)
+        if query.granularity == "daily":
+            return await ElectricityUsageService.get_daily_usage(query.product_id, query.period)
+        return await ElectricityUsageService.get_monthly_usage(query.product_id, query.period)
+
+    @staticmethod
+    async def get_charts(queries: List[ChartQuery], chart_format: str = "points") -> List[dict]:
+        """
+        Build many charts in one go, in the order of the queries.
+
+        Identical queries are built once, and at most CHART_BATCH_FANOUT
+        charts are built at a time. Reads shared by several charts (the same
+        rollup node, say) are fetched once, since concurrent identical reads
+        are coalesced by the database layer. Results are ChartBatchResult
+        dicts with charts in chart_format.
+        """
+        if len(queries) > CHART_BATCH_MAX:
+            raise ValueError(f"A batch can hold at most {CHART_BATCH_MAX} queries")
+
+        unique = list(dict.fromkeys((query.product_id, query.granularity, query.period) for query in queries))
+        semaphore = asyncio.Semaphore(CHART_BATCH_FANOUT)
+
+        async def build(key):
+            product_id, granularity, period = key
+            result = {"product_id": product_id, "granularity": granularity, "period": period, "chart": None, "error": None}
+            async with semaphore:
+                try:
+                    chart = await ElectricityUsageService.get_chart(
+                        ChartQuery(product_id=product_id, granularity=granularity, period=period)
+                    )
+                    result["chart"] = chart.as_dict(chart_format)
+                except Exception as e:
+                    logger.error(f"Error building {granularity} chart of {product_id} for {period}: {str(e)}")
+                    result["error"] = str(e)
+            return result
+
+        built = dict(zip(unique, await asyncio.gather(*(build(key) for key in unique))))
+        return [built[(query.product_id, query.granularity, query.period)] for query in queries]
 
     @staticmethod
     def calculate_billing_tiers(total_kwh: float) -> float:
@@ -304,63 +415,40 @@ class ElectricityUsageService:
         return unit_price * total_kwh
 
     @staticmethod
-    def calculate_total_kwh_for_month(product_id: str, year_month: str) -> float:
-        """Calculate the total kWh used in a month."""
-        try:
-            year, month = year_month.split('-')
-            _, days_in_month = calendar.monthrange(int(year), int(month))
+    async def compute_total_kwh_for_month(product_id: str, year_month: str) -> float:
+        """
+        Calculate the total kWh used in a month, raising if it can't be
+        computed (billing must not store a 0 kWh bill for a failed read).
+        """
+        year, month = year_month.split('-')
 
-            # Track the total watt-hours for the month
-            total_watt_hours = 0
+        # Use the monthly rollup if the month has already been summarized,
+        # and otherwise build it from daily rollups and raw readings. The
+        # running total kept by ingestion misses readings written to Firebase
+        # directly, so it is only a live estimate and never billed.
+        stats = (await RollupService.get_monthly_rollups(product_id, year)).get(month)
+        if stats is None:
+            stats = await RollupService.rollup_month(product_id, year_month)
 
-            # Loop through all days in the month
-            for day in range(1, days_in_month + 1):
-                date_str = f"{year_month}-{day:02d}"
-
-                # Get data for this day
-                day_ref_path = f"electricity_usage/{product_id}/{date_str}"
-                day_data = database.child(day_ref_path).get() or {}
-
-                # Loop through all hours in the day
-                for hour, hour_data in day_data.items():
-                    if not hour.isdigit():
-                        continue  # Skip non-hour keys
-
-                    # Calculate the average watts for this hour
-                    hour_watt_values = []
-
-                    # Process minutes
-                    if isinstance(hour_data, dict):
-                        for minute, watt_value in hour_data.items():
-                            if watt_value is not None:
-                                try:
-                                    hour_watt_values.append(float(watt_value))
-                                except (ValueError, TypeError):
-                                    continue
-                    elif isinstance(hour_data, list):
-                        for minute_value in hour_data:
-                            if minute_value is not None:
-                                try:
-                                    hour_watt_values.append(float(minute_value))
-                                except (ValueError, TypeError):
-                                    continue
-
-                    # If we have values for this hour, calculate the average and add to total watt-hours
-                    if hour_watt_values:
-                        avg_watts_for_hour = sum(hour_watt_values) / len(hour_watt_values)
-                        # Add one hour's worth of energy at this power level
-                        total_watt_hours += avg_watts_for_hour
-
-            # Convert watt-hours to kilowatt-hours
-            total_kwh = total_watt_hours / 1000
-
-            return round(total_kwh, 2)
+        # Each hour contributes its average watts for one hour
+        total_watt_hours = stats.get("watt_hours", 0.0)
+
+        # Convert watt-hours to kilowatt-hours
+        total_kwh = total_watt_hours / 1000
+
+        return round(total_kwh, 2)
+
+    @staticmethod
+    async def calculate_total_kwh_for_month(product_id: str, year_month: str) -> float:
+        """Calculate the total kWh used in a month, 0 if it can't be computed."""
+        try:
+            return await ElectricityUsageService.compute_total_kwh_for_month(product_id, year_month)
         except Exception as e:
             logger.error(f"Error calculating kWh for {year_month}: {str(e)}")
             return 0.0
 
     @staticmethod
-    def generate_bill(username: str) -> BillResponse:
+    async def generate_bill(username: str) -> BillResponse:
         """Generate a bill for the past month if it's not already paid."""
         try:
             # Get current date and extract last month
@@ -371,18 +459,18 @@ class ElectricityUsageService:
 
             # Get user's product ID (needed for both paid and unpaid cases)
             user_ref_path = f"user_details/{username}"
-            user_data = database.child(user_ref_path).get() or {}
+            user_data = await async_database.child(user_ref_path).get() or {}
 
             product_id = user_data.get("product_id", "")
             if not product_id:
                 raise ValueError(f"No product_id found for user {username}")
 
             # Calculate total kWh for last month (needed for both paid and unpaid cases)
-            total_kwh = ElectricityUsageService.calculate_total_kwh_for_month(product_id, last_month)
+            total_kwh = await ElectricityUsageService.calculate_total_kwh_for_month(product_id, last_month)
 
             # Check if bill is already paid
             payments_ref_path = f"user_details/{username}/payments"
-            payments_data = database.child(payments_ref_path).get() or {}
+            payments_data = await async_database.child(payments_ref_path).get() or {}
 
             is_paid = last_month in payments_data
 
@@ -432,35 +520,46 @@ class ConnectionService:
     async def get_connection_statuses(tenants: List[TenantRequest]) -> List[TenantStatusResponse]:
         """
         Get connection statuses for multiple product IDs
-        """
-        result = []
-
-        for tenant in tenants:
-            try:
-                # Get connection status from Firebase
-                connection_status = database.child(f"electricity_usage/{tenant.product_id}/connection_status").get()
 
-                # Handle the case where connection_status might be None or has a .val() method
-                if hasattr(connection_status, 'val'):
-                    connection_status = connection_status.val()
+        Statuses come from the in-memory status table while its listener is
+        live; unknown products, or all of them when it isn't, are read from
+        Firebase concurrently.
+        """
+        await status_table.ensure_started()
+        known = {}
+        if status_table.is_live():
+            for tenant in tenants:
+                connection_status = status_table.lookup(tenant.product_id)
+                if connection_status is not None:
+                    known[tenant.product_id] = connection_status
+
+        missing = list(dict.fromkeys(tenant.product_id for tenant in tenants if tenant.product_id not in known))
+        read = await asyncio.gather(*(ConnectionService.read_connection_status(product_id) for product_id in missing))
+        known.update(zip(missing, read))
+
+        return [
+            TenantStatusResponse(tenant_index=tenant.tenant_index, connection_status=known[tenant.product_id])
+            for tenant in tenants
+        ]
 
-                # If status is None, default to False
-                connection_status = bool(connection_status) if connection_status is not None else False
+    @staticmethod
+    async def read_connection_status(product_id: str) -> bool:
+        """Read a product's connection status from Firebase"""
+        try:
+            # Get connection status from Firebase
+            connection_status = await async_database.child(f"electricity_usage/{product_id}/connection_status").get()
 
-                result.append(TenantStatusResponse(
-                    tenant_index=tenant.tenant_index,
-                    connection_status=connection_status
-                ))
+            # Handle the case where connection_status might be None or has a .val() method
+            if hasattr(connection_status, 'val'):
+                connection_status = connection_status.val()
 
-            except Exception as e:
-                logging.error(f"Error retrieving connection status for product {tenant.product_id}: {str(e)}")
-                # In case of error, assume device is disconnected
-                result.append(TenantStatusResponse(
-                    tenant_index=tenant.tenant_index,
-                    connection_status=False
-                ))
+            # If status is None, default to False
+            return bool(connection_status) if connection_status is not None else False
 
-        return result
+        except Exception as e:
+            logging.error(f"Error retrieving connection status for product {product_id}: {str(e)}")
+            # In case of error, assume device is disconnected
+            return False
 
     @staticmethod
     async def update_connection_status(product_id: str, connection_status: bool) -> bool:
@@ -469,8 +568,15 @@ class ConnectionService:
         Returns True if successful, False otherwise
         """
         try:
-            # Update connection status in Firebase
-            database.child(f"electricity_usage/{product_id}/connection_status").set(connection_status)
+            # Update connection status in Firebase, mirror it for the status
+            # listeners and register the product, all in the same write;
+            # heartbeats arriving together share one multi-path update
+            await write_behind.write({
+                f"electricity_usage/{product_id}/connection_status": connection_status,
+                f"{STATUS_ROOT}/{product_id}": connection_status,
+                **ProductRegistry.registration_updates(product_id, last_seen=get_current_time().isoformat())
+            })
+            status_table.set(product_id, connection_status)
             return True
         except Exception as e:
             logging.error(f"Error updating connection status for product {product_id}: {str(e)}")
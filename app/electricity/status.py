@@ -0,0 +1,142 @@
+"""
+In-process table of connection statuses.
+
+Reading `electricity_usage/{product_id}/connection_status` once per tenant
+on every dashboard poll doesn't scale, and listening on electricity_usage
+would stream every raw reading. Status updates are therefore mirrored, in
+the same multi-path write, to a small node of their own:
+
+    connection_status/{product_id}   bool
+
+Each worker keeps one Firebase listener on that node and answers status
+lookups from memory. Updates made through this worker are applied to the
+table directly. The table is live once the listener has delivered the
+node's initial snapshot, for as long as the listener's thread runs:
+firebase_admin drops keep-alives (and every event without data) before
+they reach the callback, so silence says nothing about the stream, but its
+thread ends when the stream fails for good. While the table isn't live,
+lookups fall back to reading the database and the listener is restarted at
+most once every CONNECTION_STATUS_MAX_AGE seconds.
+"""
+import asyncio
+import threading
+import time
+
+from fastapi.logger import logger
+
+from app.config import CONNECTION_STATUS_LISTENER, CONNECTION_STATUS_MAX_AGE
+from app.db.firebase import database, executor
+
+STATUS_ROOT = "connection_status"
+
+
+def listener_running(registration) -> bool:
+    """
+    Whether a listener registration still streams. Both firebase_admin's
+    ListenerRegistration and the local stand-in run the stream on _thread,
+    which ends when the stream fails for good.
+    """
+    thread = getattr(registration, "_thread", None)
+    return thread is None or thread.is_alive()
+
+
+class ConnectionStatusTable:
+    def __init__(self, max_age: float = CONNECTION_STATUS_MAX_AGE):
+        self.max_age = max_age
+        self._statuses = {}  # product_id -> bool
+        self._lock = threading.Lock()
+        self._registration = None
+        self._synced = False  # Whether the listener delivered its initial snapshot
+        self._last_event_at = None  # time.monotonic() of the last event
+        self._started_at = None
+        # Called with (product_id, connection_status) whenever a status changes
+        self.watchers = []
+
+    def start(self):
+        """Start (or restart) the listener on connection_status"""
+        self.stop()
+        self._started_at = time.monotonic()
+        try:
+            self._registration = database.child(STATUS_ROOT).listen(self._on_event)
+            logger.info("Listening for connection status changes")
+        except Exception as e:
+            logger.error(f"Failed to listen for connection status changes: {str(e)}")
+
+    def stop(self):
+        registration, self._registration = self._registration, None
+        self._synced = False
+        self._last_event_at = None
+        if registration is not None:
+            try:
+                registration.close()
+            except Exception as e:
+                logger.warning(f"Failed to close connection status listener: {str(e)}")
+
+    async def ensure_started(self):
+        """Restart a listener that has stopped, at most once per max_age"""
+        if not CONNECTION_STATUS_LISTENER or self.is_live():
+            return
+        if self._started_at is None or time.monotonic() - self._started_at > self.max_age:
+            # Claimed before awaiting so that concurrent requests don't restart it too
+            self._started_at = time.monotonic()
+            # Opening the stream blocks until Firebase answers
+            await asyncio.get_running_loop().run_in_executor(executor, self.start)
+
+    def age(self):
+        """Seconds since the listener last received a change, None if it never has"""
+        if self._last_event_at is None:
+            return None
+        return time.monotonic() - self._last_event_at
+
+    def is_live(self) -> bool:
+        registration = self._registration
+        return registration is not None and self._synced and listener_running(registration)
+
+    def lookup(self, product_id: str):
+        """Status of a product, or None when the table doesn't know it"""
+        return self._statuses.get(product_id)
+
+    def set(self, product_id: str, connection_status: bool):
+        with self._lock:
+            self._apply(product_id, connection_status)
+
+    def _on_event(self, event):
+        # Runs on the listener's thread
+        if event.event_type in ("cancel", "auth_revoked"):
+            logger.error(f"Connection status listener stopped by Firebase ({event.event_type})")
+            self._synced = False
+            return
+        if event.event_type not in ("put", "patch"):
+            return
+        self._last_event_at = time.monotonic()
+
+        parts = [part for part in (event.path or "").split("/") if part]
+        with self._lock:
+            if not parts:
+                if event.event_type == "put":
+                    # The initial snapshot, or a full one after a reconnect
+                    self._statuses.clear()
+                    self._synced = True
+                for product_id, status in (event.data or {}).items():
+                    self._apply(product_id, status)
+            elif len(parts) == 1:
+                self._apply(parts[0], event.data)
+
+    def _apply(self, product_id, status):
+        if status is None:
+            self._statuses.pop(product_id, None)
+            return
+
+        status = bool(status)
+        if self._statuses.get(product_id) == status:
+            return
+        self._statuses[product_id] = status
+        for watcher in self.watchers:
+            try:
+                watcher(product_id, status)
+            except Exception as e:
+                logger.error(f"Connection status watcher failed: {str(e)}")
+
+
+# Table shared by all requests in this worker
+status_table = ConnectionStatusTable()
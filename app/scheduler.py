@@ -1,47 +1,179 @@
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.interval import IntervalTrigger
+"""
+Month-boundary scheduler for the monthly billing run.
+
+A month is due for billing once it has settled: at midnight (SRI_LANKA_TZ)
+METER_BUFFER_DAYS after it ended, when meters have uploaded the readings they
+held back and its rollup is final. Billing at the boundary itself would
+under-count every bill by those late readings, and the bill is never
+recomputed. Rather than waking every minute to look for that moment,
+the scheduler computes the next due instant from get_current_time() and
+sleeps until it. Each month that is billed completely is recorded in
+
+    scheduler_state/monthly_billing
+        last_period:    the newest completely billed month (YYYY-MM)
+        completed_at
+
+On startup, every month after last_period that is already due is billed, so
+a boundary that passed while the app was down or asleep is not skipped.
+Without a record (the first start of the scheduler, or a wiped record),
+older months are taken as billed before the scheduler took over, and the
+newest due month is billed unless its billing run (billing_runs/{month})
+completed already. Its existing bills are kept as they are (see
+run_billing), so products billed before are not billed again. A month that
+isn't billed completely (some products failed, or another worker holds its
+lease) is tried again after SCHEDULER_RETRY_DELAY seconds.
+
+Sleeps follow the debug clock (DebugTimeTracker): debug time running N times
+faster shortens them N times, and setting the debug time wakes the
+scheduler to recompute the due instant.
+"""
+import asyncio
+from datetime import datetime, timedelta
+
 from fastapi.logger import logger
 
-from app.config import get_current_time
-from app.bill.bill_calculator import calculate_monthly_bills_for_all_products
+from app.config import (get_current_time, debug_time_tracker, SRI_LANKA_TZ, SCHEDULER_RETRY_DELAY,
+                        SCHEDULER_MAX_SLEEP, METER_BUFFER)
+from app.db import metrics
+from app.db.firebase import async_database
+from app.bill.bill_calculator import calculate_monthly_bills, previous_month, BILLING_RUNS_ROOT
+
+SCHEDULER_STATE_PATH = "scheduler_state/monthly_billing"
+
+
+def month_start(period: str) -> datetime:
+    """The first instant of a month (YYYY-MM) in Sri Lanka time"""
+    return SRI_LANKA_TZ.localize(datetime.strptime(period, "%Y-%m"))
+
+
+def next_month(period: str) -> str:
+    return (month_start(period) + timedelta(days=31)).strftime("%Y-%m")
+
+
+def due_at(period: str) -> datetime:
+    """The instant a month is due for billing: METER_BUFFER_DAYS after it ended"""
+    return month_start(next_month(period)) + METER_BUFFER
+
 
-# Create scheduler instance
-scheduler = AsyncIOScheduler()
+def newest_due(now: datetime) -> str:
+    """The newest month due for billing at now"""
+    return previous_month(now - METER_BUFFER)
 
 
-async def check_for_new_month():
-    """
-    Function that runs periodically to check if it's the first day of a month
-    between 00:00 and 00:10, and if so, calculate bills
-    """
-    current_time = get_current_time()
+def due_periods(last_period: str, now: datetime) -> list:
+    """The months due for billing at now that come after last_period, oldest first"""
+    newest = newest_due(now)
+    period = next_month(last_period) if last_period else newest
+    periods = []
+    while period <= newest:
+        periods.append(period)
+        period = next_month(period)
+    return periods
 
-    logger.info(f"Scheduler check - Current time: {current_time}")
 
-    # Check if it's the first day of the month (between 00:00 and 00:10)
-    if current_time.day == 1 and current_time.hour == 0 and current_time.minute < 10:
-        logger.info(f"New month detected! Calculating bills at {current_time}")
-        await calculate_monthly_bills_for_all_products()
-    else:
-        logger.info(
-            f"Not time for bill calculation yet. Current day={current_time.day}, hour={current_time.hour}, minute={current_time.minute}")
+class BillingScheduler:
+    def __init__(self):
+        self.next_due = None
+        self._task = None
+        self._wakeup = None
+        self._listener = None
+
+    def start(self):
+        """Start waiting for month boundaries, after catching up with missed ones"""
+        if self._task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._listener = lambda: loop.call_soon_threadsafe(self._wakeup.set)
+        debug_time_tracker.add_listener(self._listener)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        debug_time_tracker.remove_listener(self._listener)
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def last_period(self) -> str:
+        state = await async_database.child(SCHEDULER_STATE_PATH).get() or {}
+        if not state.get("last_period"):
+            # Months before the newest due one were billed without the
+            # scheduler; the newest is only skipped if its run completed
+            period = newest_due(get_current_time())
+            run = await async_database.child(f"{BILLING_RUNS_ROOT}/{period}").get() or {}
+            if run.get("status") != "completed":
+                period = previous_month(month_start(period))
+            logger.info(f"No billing record yet, starting after {period}")
+            await self.record(period)
+            return period
+        return state["last_period"]
+
+    async def record(self, period: str):
+        """Record a month as billed, never moving the record back"""
+        completed_at = get_current_time().isoformat()
+
+        def advance(state):
+            state = state or {}
+            if state.get("last_period", "") >= period:
+                return state
+            return {"last_period": period, "completed_at": completed_at}
+
+        await async_database.child(SCHEDULER_STATE_PATH).transaction(advance)
+
+    async def run_due(self) -> datetime:
+        """Bill the months that are due, oldest first. Returns when to run next."""
+        now = get_current_time()
+        for period in due_periods(await self.last_period(), now):
+            logger.info(f"Billing for {period} is due since {due_at(period)}, running it at {now}")
+            with metrics.operation("job:monthly_billing"):
+                completed = await calculate_monthly_bills(period)
+            if not completed:
+                # Later months wait, so the record always covers every month before it
+                logger.warning(f"Billing for {period} is incomplete, retrying in {SCHEDULER_RETRY_DELAY:.0f}s")
+                return get_current_time() + timedelta(seconds=SCHEDULER_RETRY_DELAY)
+            await self.record(period)
+
+        # The month settling now is the next one due
+        return due_at((now - METER_BUFFER).strftime("%Y-%m"))
+
+    async def _run(self):
+        while True:
+            try:
+                self.next_due = await self.run_due()
+            except Exception as e:
+                logger.error(f"Monthly billing failed: {str(e)}")
+                self.next_due = get_current_time() + timedelta(seconds=SCHEDULER_RETRY_DELAY)
+            logger.info(f"Next billing check at {self.next_due}")
+            await self._sleep_until(self.next_due)
+
+    async def _sleep_until(self, moment: datetime):
+        while True:
+            self._wakeup.clear()
+            remaining = (moment - get_current_time()).total_seconds()
+            if remaining <= 0:
+                return
+            # Real seconds, capped so a clock that jumps (a suspended host)
+            # is looked at again before long
+            timeout = min(remaining / debug_time_tracker.speed(), SCHEDULER_MAX_SLEEP)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                return  # The debug time was set
+            except asyncio.TimeoutError:
+                pass
+
+
+billing_scheduler = BillingScheduler()
 
 
 def start_scheduler():
     """Initialize and start the scheduler"""
-    # Run the check every minute to ensure we don't miss the window
-    scheduler.add_job(
-        check_for_new_month,
-        trigger=IntervalTrigger(minutes=1),
-        id="check_for_new_month",
-        replace_existing=True
-    )
-
-    scheduler.start()
-    logger.info("Scheduler started. Will check for new month every minute.")
+    billing_scheduler.start()
+    logger.info("Scheduler started. Will bill each month as it ends.")
 
 
-def shutdown_scheduler():
+async def shutdown_scheduler():
     """Shut down the scheduler"""
-    scheduler.shutdown()
-    logger.info("Scheduler shut down.")
\ No newline at end of file
+    await billing_scheduler.stop()
+    logger.info("Scheduler shut down.")
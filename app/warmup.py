@@ -0,0 +1,39 @@
+"""
+Optional warm-up of a freshly started worker (WARMUP=true).
+
+A worker initializes the database backend and fills its caches on first
+use, which makes the first requests after a cold start slow. Warming up
+does both in the background as the worker starts: it connects the backend,
+lists the registered products and builds the daily chart of the current
+month for each of them, at most WARMUP_CONCURRENCY at once. The closed days
+of the month then come from the history cache, and their rollups are
+stored if they were missing.
+"""
+import asyncio
+import time
+
+from fastapi.logger import logger
+
+from app.config import get_current_time, WARMUP_CONCURRENCY
+from app.db import metrics
+from app.electricity.registry import ProductRegistry
+from app.electricity.service import ElectricityUsageService
+
+
+async def warm_up() -> float:
+    """Prime the caches of the current month. Returns the seconds it took."""
+    started = time.perf_counter()
+    year_month = get_current_time().strftime("%Y-%m")
+    semaphore = asyncio.Semaphore(WARMUP_CONCURRENCY)
+
+    async def prime(product_id):
+        async with semaphore:
+            await ElectricityUsageService.get_daily_usage(product_id, year_month)
+
+    with metrics.operation("job:warmup"):
+        product_ids = await ProductRegistry.list_product_ids()
+        await asyncio.gather(*(prime(product_id) for product_id in product_ids))
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"Warmed up {len(product_ids)} products for {year_month} in {elapsed:.2f}s")
+    return elapsed
@@ -0,0 +1,169 @@
+"""
+Microbenchmark: NumPy aggregation kernel vs. the pure-Python loops it replaced.
+
+Generates a year of minute readings for one meter (dict and list hour
+formats, nulls and junk values) and aggregates every month four ways:
+
+  legacy averages  the per-value loops the usage service used for chart
+                   averages and kWh (no min/max, nothing stored)
+  legacy rollups   the same loops producing the full hourly and daily
+                   rollups (sum, count, min, max, watt_hours) that are stored
+  kernel           app.electricity.aggregation.summarize_days, which produces
+                   those rollups
+  kernel averages  summarize_days without the hour rollups, as reads of
+                   days whose rollups aren't stored use it
+
+    python -m benchmarks.aggregation [--days 365] [--repeat 3]
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from app.electricity.aggregation import summarize_days
+
+
+def generate_year(days: int, seed: int = 7) -> dict:
+    """{YYYY-MM-DD: day payload} starting 2025-01-01"""
+    rng = random.Random(seed)
+    start = np.datetime64("2025-01-01")
+    year = {}
+    for offset in range(days):
+        date_str = str(start + np.timedelta64(offset, "D"))
+        day = {}
+        for hour in range(24):
+            values = [round(rng.uniform(50, 2500), 2) for _ in range(60)]
+            for minute in rng.sample(range(60), 3):
+                values[minute] = None
+            if rng.random() < 0.01:
+                values[rng.randrange(60)] = rng.choice(["junk", "", str(values[0])])
+            if hour % 2:
+                day[f"{hour:02d}"] = values
+            else:
+                day[f"{hour:02d}"] = {f"{minute:02d}": value for minute, value in enumerate(values)}
+        day["connection_status"] = True
+        year[date_str] = day
+    return year
+
+
+def legacy_month(days: dict):
+    """The per-value loops the usage service used before the kernel"""
+    all_month_values = []
+    total_watt_hours = 0
+    for day_data in days.values():
+        for hour, hour_data in day_data.items():
+            if not hour.isdigit():
+                continue
+            hour_watt_values = []
+            if isinstance(hour_data, dict):
+                for minute, value in hour_data.items():
+                    if value is not None:
+                        try:
+                            hour_watt_values.append(float(value))
+                        except (ValueError, TypeError):
+                            continue
+            elif isinstance(hour_data, list):
+                for value in hour_data:
+                    if value is not None:
+                        try:
+                            hour_watt_values.append(float(value))
+                        except (ValueError, TypeError):
+                            continue
+            all_month_values.extend(hour_watt_values)
+            if hour_watt_values:
+                total_watt_hours += sum(hour_watt_values) / len(hour_watt_values)
+    average = sum(all_month_values) / len(all_month_values) if all_month_values else None
+    return average, total_watt_hours / 1000
+
+
+def legacy_rollups(days: dict):
+    """Hourly and daily rollups built value by value"""
+    result = {}
+    for date_str, day_data in days.items():
+        hourly = {}
+        for hour, hour_data in day_data.items():
+            if not hour.isdigit():
+                continue
+            values = hour_data.values() if isinstance(hour_data, dict) else hour_data
+            stats = {"sum": 0.0, "count": 0, "min": None, "max": None, "watt_hours": 0.0}
+            for value in values:
+                if value is None:
+                    continue
+                try:
+                    value = float(value)
+                except (ValueError, TypeError):
+                    continue
+                stats["sum"] += value
+                stats["count"] += 1
+                stats["min"] = value if stats["min"] is None else min(stats["min"], value)
+                stats["max"] = value if stats["max"] is None else max(stats["max"], value)
+            if stats["count"]:
+                stats["watt_hours"] = stats["sum"] / stats["count"]
+            hourly[hour] = stats
+        daily = {
+            "sum": sum(stats["sum"] for stats in hourly.values()),
+            "count": sum(stats["count"] for stats in hourly.values()),
+            "watt_hours": sum(stats["watt_hours"] for stats in hourly.values()),
+        }
+        result[date_str] = (hourly, daily)
+    return monthly_figures(result)
+
+
+def monthly_figures(summaries: dict):
+    """Monthly average and kWh from per-day rollups"""
+    count = sum(daily["count"] for _, daily in summaries.values())
+    total = sum(daily["sum"] for _, daily in summaries.values())
+    watt_hours = sum(daily["watt_hours"] for _, daily in summaries.values())
+    return (total / count if count else None), watt_hours / 1000
+
+
+def kernel_month(days: dict):
+    return monthly_figures(summarize_days(days))
+
+
+def kernel_averages_month(days: dict):
+    return monthly_figures(summarize_days(days, hourly=False))
+
+
+def by_month(year: dict) -> dict:
+    months = {}
+    for date_str, day in year.items():
+        months.setdefault(date_str[:7], {})[date_str] = day
+    return months
+
+
+def best_of(func, months: dict, repeat: int):
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = {month: func(days) for month, days in months.items()}
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    months = by_month(generate_year(args.days))
+    readings = args.days * 24 * 60
+
+    results = {}
+    for name, func in (("legacy averages", legacy_month), ("legacy rollups", legacy_rollups),
+                       ("kernel", kernel_month), ("kernel averages", kernel_averages_month)):
+        results[name] = best_of(func, months, args.repeat)
+
+    kernel_time, kernel = results["kernel"]
+    print(f"{readings} readings over {len(months)} months (best of {args.repeat})")
+    for name, (elapsed, result) in results.items():
+        for month in months:
+            assert np.allclose(result[month], kernel[month]), f"{name} differs from the kernel for {month}"
+        print(f"  {name:<16}: {elapsed * 1000:8.1f} ms  ({elapsed / kernel_time:5.2f}x kernel time)")
+
+
+if __name__ == "__main__":
+    main()
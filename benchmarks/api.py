@@ -0,0 +1,451 @@
+"""
+End-to-end benchmark of the API on the local database backend.
+
+Loads a synthetic tree (benchmarks.data) into the local backend with a
+simulated round-trip latency, then drives every route of the electricity and
+bill routers through the ASGI app, the live stream fan-out and the monthly
+billing run. For each scenario it reports latency percentiles, throughput,
+backend calls and bytes read per request, and the peak memory traced during
+a separate, untimed pass.
+
+    python -m benchmarks.api [--products 20] [--months 3] [--latency 0.05]
+                             [--requests 200] [--concurrency 16] [--output run.json]
+    python -m benchmarks.api --compare baseline.json run.json [--threshold 0.1]
+
+--compare flags the scenarios where latency, calls, bytes or memory grew (or
+throughput fell) by more than the threshold, and exits with status 1 if any
+did.
+"""
+import os
+
+# The service reads its configuration at import, so the backend has to be
+# chosen before any app module is loaded
+os.environ.setdefault("DATABASE_BACKEND", "local")
+os.environ.setdefault("BILL_NOTIFICATION_URL", "")
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import httpx
+import numpy as np
+
+from app.config import get_current_time
+from app.bill.bill_calculator import calculate_monthly_bills_for_all_products, previous_month
+from app.db import firebase
+from app.db.backend import StorageBackend
+from app.db.cache import usage_cache
+from app.db.local import LocalBackend
+from app.electricity.ingestion import IngestionService
+from app.electricity.live import live_hub
+from app.electricity.models import MeterReading
+from app.electricity.status import status_table
+from benchmarks.data import generate_tree, readings_span
+from main import app
+
+# Metrics compared between runs, and whether higher values are better
+COMPARED = {
+    "p50_ms": False,
+    "p95_ms": False,
+    "p99_ms": False,
+    "throughput_rps": True,
+    "calls_per_request": False,
+    "bytes_per_request": False,
+    "peak_memory_kb": False,
+}
+
+
+class MeteredBackend(StorageBackend):
+    """Counts the calls made to a backend and the bytes they return"""
+
+    def __init__(self, backend: StorageBackend):
+        self.backend = backend
+        self.calls = 0
+        self.bytes_read = 0
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        with self._lock:
+            return self.calls, self.bytes_read
+
+    def _count(self, result=None):
+        size = len(json.dumps(result, separators=(",", ":"), default=str)) if result is not None else 0
+        with self._lock:
+            self.calls += 1
+            self.bytes_read += size
+        return result
+
+    def get(self, path, shallow=False):
+        return self._count(self.backend.get(path, shallow=shallow))
+
+    def set(self, path, value):
+        self.backend.set(path, value)
+        self._count()
+
+    def update(self, path, data):
+        self.backend.update(path, data)
+        self._count()
+
+    def transaction(self, path, func):
+        return self._count(self.backend.transaction(path, func))
+
+    def range(self, path, start=None, end=None):
+        return self._count(self.backend.range(path, start, end))
+
+    def last(self, path, count):
+        return self._count(self.backend.last(path, count))
+
+    def listen(self, path, callback):
+        self._count()
+        return self.backend.listen(path, callback)
+
+
+class Workload:
+    """Picks products and periods of the generated tree to ask for"""
+
+    def __init__(self, tree: dict, seed: int):
+        self.rng = random.Random(seed)
+        self.now = get_current_time()
+        today = self.now.strftime("%Y-%m-%d")
+        self.dates = {product_id: [date for date in dates if date < today] or dates
+                      for product_id, dates in readings_span(tree).items()}
+        self.products = sorted(product_id for product_id, dates in self.dates.items() if dates)
+
+    def product(self) -> str:
+        return self.rng.choice(self.products)
+
+    def date(self, product_id: str) -> str:
+        return self.rng.choice(self.dates[product_id])
+
+    def months(self) -> list:
+        return sorted({date[:7] for dates in self.dates.values() for date in dates})
+
+    def tenants(self) -> list:
+        return [{"tenant_index": index, "product_id": product_id} for index, product_id in enumerate(self.products)]
+
+
+# Scenarios: one request each, returning its response
+
+async def minutely(client, workload):
+    product_id = workload.product()
+    date = workload.date(product_id)
+    return await client.get(f"/electricity/minutely/{product_id}/{date}/{workload.rng.randrange(24):02d}")
+
+
+async def hourly(client, workload):
+    product_id = workload.product()
+    return await client.get(f"/electricity/hourly/{product_id}/{workload.date(product_id)}")
+
+
+async def daily(client, workload):
+    product_id = workload.product()
+    return await client.get(f"/electricity/daily/{product_id}/{workload.date(product_id)[:7]}")
+
+
+async def monthly(client, workload):
+    product_id = workload.product()
+    return await client.get(f"/electricity/monthly/{product_id}/{workload.date(product_id)[:4]}")
+
+
+async def usage_range(client, workload):
+    # A zoomable chart over a day, a week or a quarter, so every resolution is exercised
+    product_id = workload.product()
+    start = datetime.strptime(workload.date(product_id), "%Y-%m-%d")
+    end = start + timedelta(days=workload.rng.choice((1, 7, 90)))
+    return await client.get(f"/electricity/range/{product_id}",
+                            params={"start": start.strftime("%Y-%m-%d"), "end": end.strftime("%Y-%m-%d")})
+
+
+async def batch(client, workload):
+    # A dashboard: every tenant's daily chart for one month
+    month = workload.rng.choice(workload.months())
+    queries = [{"product_id": product_id, "granularity": "daily", "period": month}
+               for product_id in workload.products]
+    return await client.post("/electricity/batch", json={"queries": queries})
+
+
+async def connection_status(client, workload):
+    return await client.post("/electricity/connection-status", json={"tenants": workload.tenants()})
+
+
+async def update_connection_status(client, workload):
+    return await client.post("/electricity/update-connection-status", json={
+        "product_id": workload.product(), "connection_status": workload.rng.random() < 0.9
+    })
+
+
+async def readings(client, workload):
+    # The last 10 minutes of one meter
+    product_id = workload.product()
+    now = get_current_time().replace(second=0, microsecond=0)
+    batch_readings = [
+        {"product_id": product_id, "timestamp": (now - timedelta(minutes=minute)).isoformat(),
+         "value": round(workload.rng.uniform(80, 1800), 2)}
+        for minute in range(10)
+    ]
+    return await client.post("/electricity/readings", json={"readings": batch_readings})
+
+
+async def month_to_date(client, workload):
+    return await client.get(f"/electricity/month-to-date/{workload.product()}")
+
+
+async def bill_latest(client, workload):
+    return await client.post("/bill/latest", json={"tenants": workload.tenants()})
+
+
+SCENARIOS = {
+    "minutely": minutely,
+    "hourly": hourly,
+    "daily": daily,
+    "monthly": monthly,
+    "range": usage_range,
+    "batch": batch,
+    "connection-status": connection_status,
+    "update-connection-status": update_connection_status,
+    "readings": readings,
+    "month-to-date": month_to_date,
+    "bill-latest": bill_latest,
+}
+
+
+async def drive(request, count: int, concurrency: int):
+    """Run request() count times with up to concurrency at once; (latencies, errors)"""
+    counter = itertools.count()
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while next(counter) < count:
+            started = time.perf_counter()
+            try:
+                ok = await request()
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            errors += not ok
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, count))))
+    return latencies, errors
+
+
+async def measure(request, count: int, concurrency: int, metered: MeteredBackend, memory_requests: int,
+                  reset=None) -> dict:
+    """Timed pass, then a traced pass for peak memory (tracing slows everything down)"""
+    if reset:
+        await reset()
+    usage_cache.invalidate()
+
+    calls, bytes_read = metered.snapshot()
+    started = time.perf_counter()
+    latencies, errors = await drive(request, count, concurrency)
+    elapsed = time.perf_counter() - started
+    calls_after, bytes_after = metered.snapshot()
+
+    peak = None
+    if memory_requests:
+        if reset:
+            await reset()
+        usage_cache.invalidate()
+        tracemalloc.start()
+        await drive(request, min(count, memory_requests), concurrency)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    milliseconds = np.array(latencies) * 1000
+    return {
+        "requests": count,
+        "errors": errors,
+        "p50_ms": round(float(np.percentile(milliseconds, 50)), 2),
+        "p95_ms": round(float(np.percentile(milliseconds, 95)), 2),
+        "p99_ms": round(float(np.percentile(milliseconds, 99)), 2),
+        "mean_ms": round(float(milliseconds.mean()), 2),
+        "throughput_rps": round(count / elapsed, 2),
+        "calls_per_request": round((calls_after - calls) / count, 2),
+        "bytes_per_request": round((bytes_after - bytes_read) / count),
+        "peak_memory_kb": round(peak / 1024) if peak is not None else None,
+    }
+
+
+async def live_scenario(workload, viewers: int, count: int, metered, memory_requests: int) -> dict:
+    """Time from ingesting a reading until every viewer of the meter has received it"""
+    product_id = workload.product()
+    delivered = {"count": 0}
+    all_delivered = asyncio.Event()
+
+    async def view():
+        async for chunk in live_hub.stream(product_id):
+            if chunk.startswith("event: reading"):
+                delivered["count"] += 1
+                if delivered["count"] >= viewers:
+                    all_delivered.set()
+
+    tasks = [asyncio.create_task(view()) for _ in range(viewers)]
+    while live_hub.stats().get(product_id, 0) < viewers:
+        await asyncio.sleep(0.01)
+
+    async def publish():
+        delivered["count"] = 0
+        all_delivered.clear()
+        reading = MeterReading(product_id=product_id, timestamp=get_current_time(),
+                               value=round(workload.rng.uniform(80, 1800), 2))
+        await IngestionService.ingest([reading])
+        await asyncio.wait_for(all_delivered.wait(), timeout=10)
+        return True
+
+    try:
+        return await measure(publish, count, 1, metered, memory_requests)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def billing_scenario(runs: int, metered, memory_requests: int) -> dict:
+    """Cold monthly billing runs over every product"""
+    async def reset():
+        # Every run starts as the first of the month would: nothing billed or
+        # summarized. Existing bills are kept by a run, so the month's are removed
+        month = previous_month(get_current_time())
+        bills = {
+            f"electricity_bills/{product_id}/{month}": None
+            for product_id in await firebase.async_database.child("electricity_bills").keys()
+        }
+        await firebase.async_database.update({
+            "billing_runs": None,
+            "scheduler_leases": None,
+            "electricity_rollups": None,
+            "electricity_bills_latest": None,
+            **bills,
+        })
+
+    async def run():
+        await reset()
+        usage_cache.invalidate()
+        await calculate_monthly_bills_for_all_products()
+        return True
+
+    return await measure(run, runs, 1, metered, min(memory_requests, 1), reset=reset)
+
+
+async def run_benchmark(args) -> dict:
+    started = time.perf_counter()
+    tree = generate_tree(args.products, args.months, density=args.density, seed=args.seed)
+    workload = Workload(tree, args.seed)
+
+    local = LocalBackend()
+    local.set("", tree)
+    local.latency = args.latency
+    metered = MeteredBackend(local)
+    firebase.database.backend = metered
+    print(f"Loaded {len(workload.products)} products x {args.months} months "
+          f"in {time.perf_counter() - started:.1f}s, {args.latency * 1000:.0f} ms per backend call")
+    print_header()
+
+    selected = args.scenarios or [*SCENARIOS, "live", "billing"]
+    results = {}
+    status_table.start()
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            for name in selected:
+                if name == "live":
+                    results[name] = await live_scenario(workload, args.viewers, args.requests // 4 or 1,
+                                                        metered, args.memory_requests)
+                elif name == "billing":
+                    results[name] = await billing_scenario(args.billing_runs, metered, args.memory_requests)
+                else:
+                    scenario = SCENARIOS[name]
+
+                    async def request():
+                        response = await scenario(client, workload)
+                        return response.status_code < 400
+
+                    results[name] = await measure(request, args.requests, args.concurrency, metered,
+                                                  args.memory_requests)
+                print_row(name, results[name])
+    finally:
+        status_table.stop()
+
+    return {"config": {key: value for key, value in vars(args).items() if key not in ("compare", "output")},
+            "scenarios": results}
+
+
+def print_header():
+    print(f"{'scenario':<26}{'req':>6}{'err':>5}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'req/s':>9}{'calls/req':>11}{'KB/req':>9}{'peak KB':>9}")
+
+
+def print_row(name: str, result: dict):
+    print(f"{name:<26}{result['requests']:>6}{result['errors']:>5}{result['p50_ms']:>9.1f}"
+          f"{result['p95_ms']:>9.1f}{result['p99_ms']:>9.1f}{result['throughput_rps']:>9.1f}"
+          f"{result['calls_per_request']:>11.2f}{result['bytes_per_request'] / 1024:>9.1f}"
+          f"{result['peak_memory_kb'] if result['peak_memory_kb'] is not None else '-':>9}")
+
+
+def compare(baseline_path: str, current_path: str, threshold: float) -> int:
+    """Print metric changes between two runs; the number of regressions"""
+    with open(baseline_path) as baseline_file, open(current_path) as current_file:
+        baseline = json.load(baseline_file)["scenarios"]
+        current = json.load(current_file)["scenarios"]
+
+    regressions = 0
+    for name in (name for name in current if name in baseline):
+        changes = []
+        for metric, higher_is_better in COMPARED.items():
+            before, after = baseline[name].get(metric), current[name].get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            regressed = change < -threshold if higher_is_better else change > threshold
+            regressions += regressed
+            changes.append(f"{metric} {before:g} -> {after:g} ({change:+.0%}){' REGRESSION' if regressed else ''}")
+        print(f"{name}:")
+        for line in changes:
+            print(f"  {line}")
+    print(f"{regressions} regression(s) beyond {threshold:.0%}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--products", type=int, default=20)
+    parser.add_argument("--months", type=int, default=3)
+    parser.add_argument("--density", type=float, default=0.95, help="share of minutes holding a reading")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every backend call")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--viewers", type=int, default=100, help="subscribers of the live stream scenario")
+    parser.add_argument("--billing-runs", type=int, default=3)
+    parser.add_argument("--memory-requests", type=int, default=20,
+                        help="requests of the traced pass measuring peak memory (0 skips it)")
+    parser.add_argument("--scenarios", nargs="*", choices=[*SCENARIOS, "live", "billing"])
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"))
+    parser.add_argument("--threshold", type=float, default=0.10)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+
+    # Per-request log lines would dominate the output
+    logging.getLogger().setLevel(logging.WARNING)
+    results = asyncio.run(run_benchmark(args))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Synthetic database trees for benchmarks.
+
+generate_tree() builds what a deployment accumulates: minute readings under
+electricity_usage for a number of products and months (up to the current
+time of the service clock), in the mixed shapes meters write them (hours as
+{"MM": value} dicts or as lists, missing minutes, nulls and the odd junk
+value), plus the registry, mirrored connection statuses and the bills of
+the months billed before last month.
+"""
+import random
+from datetime import datetime, timedelta
+
+from app.config import get_current_time
+
+JUNK_VALUES = ("junk", "", "NaN?", "-")
+
+
+def month_starts(months: int, now: datetime) -> list:
+    """First day of the last `months` months, the current one included"""
+    year, month = now.year, now.month
+    starts = []
+    for _ in range(months):
+        starts.append(datetime(year, month, 1))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return starts[::-1]
+
+
+def generate_hour(rng: random.Random, density: float, null_rate: float, junk_rate: float, minutes: int = 60):
+    """One hour of readings as a dict or a list, or None when the meter was offline"""
+    if rng.random() > density ** (1 / 4):
+        return None
+
+    base = rng.uniform(80, 1800)
+    values = []
+    for _ in range(minutes):
+        if rng.random() > density:
+            values.append(None)
+        elif rng.random() < null_rate:
+            values.append(None)
+        else:
+            values.append(round(max(0.0, rng.gauss(base, base * 0.15)), 2))
+    if rng.random() < junk_rate:
+        values[rng.randrange(minutes)] = rng.choice(JUNK_VALUES)
+
+    if rng.random() < 0.5:
+        return values
+    return {f"{minute:02d}": value for minute, value in enumerate(values) if value is not None}
+
+
+def generate_tree(products: int = 10, months: int = 2, density: float = 0.95, null_rate: float = 0.02,
+                  junk_rate: float = 0.01, seed: int = 7, now: datetime = None) -> dict:
+    """
+    A database tree with `products` meters and `months` months of readings.
+
+    density is the share of minutes that hold a reading; hours end at the
+    current time of the service clock, so the last month is still open.
+    """
+    rng = random.Random(seed)
+    now = (now or get_current_time()).replace(tzinfo=None)
+    starts = month_starts(months, now)
+    product_ids = [f"product{index:04d}" for index in range(1, products + 1)]
+
+    usage, registry, statuses, bills = {}, {}, {}, {}
+    for product_id in product_ids:
+        days = {}
+        day = starts[0]
+        while day < now:
+            hours = {}
+            for hour in range(24):
+                start = day + timedelta(hours=hour)
+                if start >= now:
+                    break
+                minutes = min(60, int((now - start).total_seconds() // 60) + 1)
+                hour_data = generate_hour(rng, density, null_rate, junk_rate, minutes)
+                if hour_data:
+                    hours[f"{hour:02d}"] = hour_data
+            if hours:
+                days[day.strftime("%Y-%m-%d")] = hours
+            day += timedelta(days=1)
+
+        connected = rng.random() < 0.9
+        usage[product_id] = {**days, "connection_status": connected}
+        statuses[product_id] = connected
+        registry[product_id] = {
+            "first_reading_date": min(days) if days else None,
+            "last_reading_date": max(days) if days else None,
+            "last_seen": now.isoformat(),
+        }
+        bills[product_id] = {
+            start.strftime("%Y-%m"): {
+                "kw_value": round(rng.uniform(20, 400), 2),
+                "amount": round(rng.uniform(500, 15000), 2),
+                "status": rng.choice(["paid", "not_paid"]),
+                "payment_date": None,
+                "calculated_at": (start + timedelta(days=32)).replace(day=1).isoformat(),
+            }
+            # Last month is left for the billing run
+            for start in starts[:-2]
+        }
+
+    return {
+        "electricity_usage": usage,
+        "product_registry": registry,
+        "connection_status": statuses,
+        "electricity_bills": bills,
+    }
+
+
+def readings_span(tree: dict) -> dict:
+    """{product_id: sorted dates with readings} of a generated tree"""
+    return {
+        product_id: sorted(key for key in days if key[:1].isdigit())
+        for product_id, days in tree["electricity_usage"].items()
+    }
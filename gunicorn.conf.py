@@ -0,0 +1,31 @@
+"""
+Gunicorn settings, used by the Procfile.
+
+The app is preloaded: the master imports it (FastAPI, NumPy, the database
+SDK) once and the forked workers share those pages, instead of every worker
+importing it again after a dyno wakes up. Nothing connects to the database
+on import (see app.db.backend.LazyBackend), so each worker still opens its
+own connections, and worker identities (app.db.lease.worker_id, used by
+leases and the notification outbox) are computed in each worker too.
+GUNICORN_PRELOAD=false makes every worker import the app itself.
+"""
+import os
+import time
+
+started = time.perf_counter()
+
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = 60
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+
+def when_ready(server):
+    if preload_app:
+        from app.db.backend import import_backend
+        import_backend()
+    server.log.info(f"Master ready in {time.perf_counter() - started:.2f}s (preload={preload_app})")
+
+
+def post_fork(server, worker):
+    server.log.info(f"Worker {worker.pid} forked {time.perf_counter() - started:.2f}s after the master started")
@@ -1,13 +1,28 @@
+import asyncio
 import os
+import time
 
-from fastapi import FastAPI
+# Seconds spent in each phase of starting a worker, reported in the logs and /metrics
+startup_timings = {}
+import_started = time.perf_counter()
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 import logging
 
 from app.electricity.routes import router as electricity_router
 from app.bill.routes import router as bill_router
-from app.scheduler import start_scheduler, shutdown_scheduler
-from app.config import get_current_time
+from app.scheduler import start_scheduler, shutdown_scheduler, billing_scheduler
+from app.config import get_current_time, CONNECTION_STATUS_LISTENER, METRICS_ENABLED, WARMUP
+from app.db import metrics
+from app.db.cache import usage_cache
+from app.db.write_behind import write_behind
+from app.bill.outbox import notification_outbox
+from app.electricity.status import status_table
+from app.electricity.live import live_hub
+from app.db.firebase import storage_backend
+from app.warmup import warm_up
 
 # Configure logging
 logging.basicConfig(
@@ -15,6 +30,9 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
 )
 
+# With gunicorn's preload this is measured once, in the master
+startup_timings["import"] = time.perf_counter() - import_started
+
 # Create FastAPI app
 app = FastAPI(
     title="TenantVolt Electricity Usage API",
@@ -30,19 +48,72 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+def route_template(scope) -> str:
+    """The path template of the route a request matched, e.g. /electricity/daily/{product_id}/{year_month}"""
+    route = scope.get("route")
+    if route is None:
+        return "unmatched"
+    # Depending on the FastAPI version the route's path may leave out the
+    # prefix of the router it was included with; that prefix is then taken
+    # from the request path
+    template = route.path.strip("/").split("/")
+    segments = scope["path"].strip("/").split("/")
+    return "/" + "/".join(segments[:max(0, len(segments) - len(template))] + template)
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Attribute database calls to the route and report them in a Server-Timing header"""
+    if not METRICS_ENABLED:
+        return await call_next(request)
+
+    # The route is only known once the router has run, so the label is
+    # resolved when the first database call is recorded
+    started = time.perf_counter()
+    with metrics.operation(lambda: f"{request.method} {route_template(request.scope)}") as timings:
+        response = await call_next(request)
+    elapsed = time.perf_counter() - started
+
+    labels = (route_template(request.scope), request.method, str(response.status_code))
+    metrics.http_request_seconds.observe(labels, elapsed)
+    response.headers["Server-Timing"] = timings.server_timing(elapsed)
+    return response
+
+
 app.include_router(electricity_router, prefix="/electricity", tags=["electricity usage"])
 app.include_router(bill_router, prefix="/bill", tags=["electricity bills"])
 
 # Register events for scheduler
 @app.on_event("startup")
 async def startup_event():
+    started = time.perf_counter()
     current_time = get_current_time()
     logging.info(f"Starting application at {current_time}")
     start_scheduler()
+    notification_outbox.start()
+    if CONNECTION_STATUS_LISTENER:
+        status_table.start()
+    if WARMUP:
+        asyncio.create_task(run_warm_up())
+
+    startup_timings["startup"] = time.perf_counter() - started
+    logging.info(f"Worker {os.getpid()} ready: imports took {startup_timings['import']:.2f}s, "
+                 f"startup {startup_timings['startup']:.2f}s")
+
+
+async def run_warm_up():
+    try:
+        startup_timings["warmup"] = await warm_up()
+    except Exception as e:
+        logging.error(f"Warm-up failed: {str(e)}")
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    shutdown_scheduler()
+    await shutdown_scheduler()
+    status_table.stop()
+    await write_behind.close()
+    await notification_outbox.stop()
 
 # Root endpoint
 @app.get("/")
@@ -64,9 +135,53 @@ async def debug_time():
         "day": current_time.day,
         "hour": current_time.hour,
         "minute": current_time.minute,
-        "is_bill_calculation_time": current_time.day == 1 and current_time.hour == 0 and current_time.minute < 10
+        "next_billing_at": billing_scheduler.next_due.isoformat() if billing_scheduler.next_due else None
     }
 
+# Debug endpoint to check the history cache
+@app.get("/debug/cache")
+async def debug_cache():
+    return usage_cache.stats()
+
+# Prometheus metrics of database calls, API requests, the history cache, write-behind batching
+# the notification outbox and worker startup
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    cache = usage_cache.stats()
+    lines = [
+        "# TYPE tenantvolt_cache_hits_total counter",
+        f"tenantvolt_cache_hits_total {cache['hits']}",
+        "# TYPE tenantvolt_cache_misses_total counter",
+        f"tenantvolt_cache_misses_total {cache['misses']}",
+        "# TYPE tenantvolt_cache_evictions_total counter",
+        f"tenantvolt_cache_evictions_total {cache['evictions']}",
+        "# TYPE tenantvolt_cache_bytes gauge",
+        f"tenantvolt_cache_bytes {cache['bytes']}",
+    ]
+    writes = write_behind.stats()
+    lines += [
+        "# TYPE tenantvolt_write_behind_batches_total counter",
+        f"tenantvolt_write_behind_batches_total {writes['batches']}",
+        "# TYPE tenantvolt_write_behind_coalesced_total counter",
+        f"tenantvolt_write_behind_coalesced_total {writes['coalesced']}",
+    ]
+    lines.append("# TYPE tenantvolt_notification_outbox gauge")
+    for status, count in (await asyncio.to_thread(notification_outbox.stats)).items():
+        lines.append(f'tenantvolt_notification_outbox{{status="{status}"}} {count}')
+    phases = dict(startup_timings)
+    if storage_backend.init_seconds is not None:
+        phases["backend"] = storage_backend.init_seconds
+    lines.append("# TYPE tenantvolt_startup_seconds gauge")
+    for phase, seconds in phases.items():
+        lines.append(f'tenantvolt_startup_seconds{{phase="{phase}"}} {seconds:.6f}')
+    return PlainTextResponse(metrics.render() + "\n".join(lines) + "\n",
+                             media_type="text/plain; version=0.0.4")
+
+# Debug endpoint to check live streams (subscribers per product)
+@app.get("/debug/live")
+async def debug_live():
+    return live_hub.stats()
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
@@ -0,0 +1,30 @@
+import os
+import sys
+
+# The app reads its configuration on import: run it on the local backend,
+# without notifications or the connection status listener
+os.environ.setdefault("DATABASE_BACKEND", "local")
+os.environ.setdefault("CONNECTION_STATUS_LISTENER", "false")
+os.environ.setdefault("BILL_NOTIFICATION_URL", "")
+os.environ.setdefault("LEASE_BACKEND", "local")
+os.environ.setdefault("LEASE_FILE", "")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+from app.db import firebase  # noqa: E402
+from app.db.cache import usage_cache  # noqa: E402
+from app.db.local import LocalBackend  # noqa: E402
+
+
+@pytest.fixture
+def local_db():
+    """A fresh in-memory LocalBackend behind async_database"""
+    backend = LocalBackend()
+    previous = firebase.database.backend
+    firebase.database.backend = backend
+    usage_cache.invalidate()
+    yield backend
+    firebase.database.backend = previous
+    usage_cache.invalidate()
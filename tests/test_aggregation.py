@@ -0,0 +1,61 @@
+import numpy as np
+
+from app.electricity.aggregation import JUNK_RETRIES, hour_array, hour_rows, parse_values, summarize_days
+from app.electricity.rollups import summarize_day
+
+
+def test_nested_lists_are_junk_values():
+    values = parse_values([[1, 2], [3, 4]])
+    assert values.shape == (2,)
+    assert np.isnan(values).all()
+
+
+def test_nested_list_hour_leaves_the_rest_of_the_day():
+    hourly, daily = summarize_day({"00": [[1, 2], [3, 4]], "01": [100, 200]})
+    assert hourly["01"]["count"] == 2
+    assert daily["count"] == 2
+    assert daily["sum"] == 300.0
+
+
+def test_nested_list_in_dict_hour_is_skipped():
+    row = hour_array({"00": [1, 2], "01": [3, 4], "02": 50})
+    assert np.isnan(row[:2]).all()
+    assert row[2] == 50.0
+
+
+def test_junk_values_anywhere_in_a_batch_are_nan():
+    values = [float(value) for value in range(3000)]
+    # Both ends of a day-long chunk, and more junk than is retried in bulk
+    junk = [0, 1439, 1440, 2999] + list(range(2000, 2000 + 10 * JUNK_RETRIES, 10))
+    for position in junk:
+        values[position] = "junk"
+    values[5] = None
+    values[6] = "7.5"
+
+    parsed = parse_values(values)
+    assert np.isnan(parsed[junk]).all()
+    assert np.isnan(parsed[5])
+    assert parsed[6] == 7.5
+    clean = np.ones(3000, dtype=bool)
+    clean[junk + [5, 6]] = False
+    assert (parsed[clean] == np.arange(3000)[clean]).all()
+
+
+def test_hour_rows_are_as_wide_as_the_longest_hour():
+    rows = hour_rows([[1, 2], {"00": 5, "01": None}, "junk", list(range(70))])
+    assert rows.shape == (4, 70)
+    assert rows[0, :2].tolist() == [1.0, 2.0]
+    assert np.isnan(rows[0, 2:]).all()
+    assert rows[1, 0] == 5.0
+    assert np.isnan(rows[1, 1:]).all()
+    assert np.isnan(rows[2]).all()
+    assert rows[3].tolist() == list(range(70))
+
+
+def test_day_figures_without_hour_rollups():
+    day = {"00": [100, 200], "01": {"00": 50, "30": "junk"}, "connection_status": True}
+    hourly, daily = summarize_days({"2026-10-01": day}, hourly=False)["2026-10-01"]
+    assert hourly == {}
+    assert daily == summarize_day(day)[1]
+    assert daily["count"] == 3
+    assert daily["watt_hours"] == 200.0
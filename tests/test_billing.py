@@ -0,0 +1,251 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import scheduler
+from app.bill import bill_calculator
+from app.bill.bill_calculator import calculate_monthly_bills, run_billing
+from app.bill.outbox import notification_outbox
+from app.config import SRI_LANKA_TZ, METER_BUFFER
+from app.db import lease
+from app.db.lease import Lease, LeaseLostError, LocalLeaseStore, worker_id
+from app.electricity.service import ElectricityUsageService
+from app.scheduler import BillingScheduler
+from benchmarks.data import generate_tree
+
+MONTH = "2026-09"
+NOW = SRI_LANKA_TZ.localize(datetime(2026, 10, 1, 0, 5))
+
+compute_total_kwh = ElectricityUsageService.compute_total_kwh_for_month
+
+
+def load_tree(backend, products=3):
+    backend.root = generate_tree(products=products, months=2, density=0.3, now=NOW.replace(tzinfo=None))
+    return sorted(backend.root["electricity_usage"])
+
+
+def count_computations(monkeypatch, failing=()):
+    """Count the kWh computations of the billing run, raising for the products in failing"""
+    computed = []
+
+    async def counted(product_id, year_month):
+        computed.append(product_id)
+        if product_id in failing:
+            raise TimeoutError("Firebase call timed out")
+        return await compute_total_kwh(product_id, year_month)
+
+    monkeypatch.setattr(ElectricityUsageService, "compute_total_kwh_for_month", staticmethod(counted))
+    return computed
+
+
+def test_lease_is_held_by_one_owner():
+    async def scenario():
+        store = LocalLeaseStore()
+        async with Lease("billing-2026-09", ttl=30, store=store, owner="a") as first:
+            async with Lease("billing-2026-09", ttl=30, store=store, owner="b") as second:
+                assert first.acquired
+                assert not second.acquired
+        async with Lease("billing-2026-09", ttl=30, store=store, owner="b") as third:
+            assert third.acquired
+
+    asyncio.run(scenario())
+
+
+def test_expired_lease_is_taken_over():
+    async def scenario():
+        store = LocalLeaseStore()
+        assert await store.acquire("billing-2026-09", "a", ttl=0.01)
+        assert not await store.acquire("billing-2026-09", "b", ttl=30)
+        await asyncio.sleep(0.02)
+        assert await store.acquire("billing-2026-09", "b", ttl=30)
+
+    asyncio.run(scenario())
+
+
+def test_lease_file_is_shared_between_stores(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "leases.json")
+        assert await LocalLeaseStore(path).acquire("billing-2026-09", "a", ttl=30)
+        assert not await LocalLeaseStore(path).acquire("billing-2026-09", "b", ttl=30)
+
+    asyncio.run(scenario())
+
+
+def forked_ids() -> str:
+    """The lease owner and outbox worker of a forked child, as it reports them"""
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        os.write(write_end, f"{Lease('billing-2026-09', ttl=30).owner} {notification_outbox.worker}".encode())
+        os._exit(0)
+    os.close(write_end)
+    os.waitpid(pid, 0)
+    with os.fdopen(read_end) as pipe:
+        return pipe.read()
+
+
+def test_forked_workers_get_their_own_ids():
+    # Computed before forking, like a preloading master would
+    parent = worker_id()
+    first, second = forked_ids(), forked_ids()
+    assert first != second
+    assert parent not in first + second
+    for ids in (first, second):
+        owner, worker = ids.split()
+        assert owner == worker
+
+
+def test_billing_run_checkpoints_and_resumes(local_db, monkeypatch):
+    product_ids = load_tree(local_db)
+    failing = product_ids[1]
+    computed = count_computations(monkeypatch, failing={failing})
+
+    assert not asyncio.run(run_billing(MONTH, NOW))
+
+    # A failed computation leaves the product unbilled, not billed at 0 kWh
+    bills = local_db.root["electricity_bills"]
+    assert MONTH not in bills[failing]
+    assert all(bills[pid][MONTH]["kw_value"] > 0 for pid in product_ids if pid != failing)
+    checkpoint = local_db.root["billing_runs"][MONTH]
+    assert checkpoint["status"] == "running"
+    assert sorted(checkpoint["products"]) == [pid for pid in product_ids if pid != failing]
+
+    # The next run bills only the remaining product and completes the month
+    computed = count_computations(monkeypatch)
+    assert asyncio.run(run_billing(MONTH, NOW))
+    assert computed == [failing]
+    assert local_db.root["electricity_bills"][failing][MONTH]["kw_value"] > 0
+    assert local_db.root["billing_runs"][MONTH]["status"] == "completed"
+
+    # A completed month is not billed again
+    computed = count_computations(monkeypatch)
+    assert asyncio.run(run_billing(MONTH, NOW))
+    assert computed == []
+
+
+def test_billing_skips_month_leased_by_another_worker(local_db, monkeypatch):
+    load_tree(local_db)
+    store = LocalLeaseStore()
+    monkeypatch.setattr(lease, "lease_store", store)
+    monkeypatch.setattr(bill_calculator, "get_current_time", lambda: NOW)
+    computed = count_computations(monkeypatch)
+
+    async def scenario():
+        async with Lease(f"billing-{MONTH}", ttl=30, store=store, owner="other-worker"):
+            assert not await calculate_monthly_bills(MONTH)
+        assert computed == []
+        assert await calculate_monthly_bills(MONTH)
+
+    asyncio.run(scenario())
+    assert local_db.root["billing_runs"][MONTH]["status"] == "completed"
+
+
+def test_existing_bills_are_kept(local_db, monkeypatch):
+    product_ids = load_tree(local_db)
+    paid = {"kw_value": 120.0, "amount": 4200.0, "status": "paid", "payment_date": "2026-10-01T00:02:00+05:30"}
+    local_db.root["electricity_bills"] = {product_ids[0]: {MONTH: dict(paid)}}
+    queued = []
+
+    async def put(key, payload, url=None):
+        queued.append(key)
+        return True
+
+    monkeypatch.setattr(bill_calculator.notification_outbox, "put", put)
+    computed = count_computations(monkeypatch)
+
+    assert asyncio.run(run_billing(MONTH, NOW))
+    assert local_db.root["electricity_bills"][product_ids[0]][MONTH] == paid
+    assert product_ids[0] not in computed
+    assert f"bill-{product_ids[0]}-{MONTH}" not in queued
+    assert sorted(local_db.root["billing_runs"][MONTH]["products"]) == product_ids
+
+
+def test_scheduler_without_record_bills_the_newest_due_month(local_db, monkeypatch):
+    product_ids = load_tree(local_db)
+    settled = NOW + METER_BUFFER
+    monkeypatch.setattr(scheduler, "get_current_time", lambda: settled)
+    monkeypatch.setattr(bill_calculator, "get_current_time", lambda: settled)
+    paid = {"kw_value": 120.0, "amount": 4200.0, "status": "paid", "payment_date": "2026-10-01T00:02:00+05:30"}
+    local_db.root["electricity_bills"][product_ids[0]] = {MONTH: dict(paid)}
+    computed = count_computations(monkeypatch)
+
+    asyncio.run(BillingScheduler().run_due())
+    assert sorted(computed) == product_ids[1:]
+    assert local_db.root["electricity_bills"][product_ids[0]][MONTH] == paid
+    assert local_db.root["scheduler_state"]["monthly_billing"]["last_period"] == MONTH
+
+
+def test_scheduler_without_record_skips_a_completed_month(local_db, monkeypatch):
+    load_tree(local_db)
+    settled = NOW + METER_BUFFER
+    monkeypatch.setattr(scheduler, "get_current_time", lambda: settled)
+    local_db.root["billing_runs"] = {MONTH: {"status": "completed"}}
+    computed = count_computations(monkeypatch)
+
+    asyncio.run(BillingScheduler().run_due())
+    assert computed == []
+    assert local_db.root["scheduler_state"]["monthly_billing"]["last_period"] == MONTH
+
+
+def test_month_is_billed_once_meters_are_done_with_it(local_db, monkeypatch):
+    product_ids = load_tree(local_db)
+    local_db.root["scheduler_state"] = {"monthly_billing": {"last_period": "2026-08"}}
+    monkeypatch.setattr(bill_calculator, "get_current_time", lambda: now)
+    monkeypatch.setattr(scheduler, "get_current_time", lambda: now)
+    computed = count_computations(monkeypatch)
+
+    # At the month boundary, September is not due until its buffered readings are in
+    now = NOW
+    next_due = asyncio.run(BillingScheduler().run_due())
+    assert computed == []
+    assert next_due == SRI_LANKA_TZ.localize(datetime(2026, 10, 1)) + METER_BUFFER
+
+    now = next_due + timedelta(minutes=5)
+    asyncio.run(BillingScheduler().run_due())
+    assert sorted(computed) == product_ids
+    assert local_db.root["scheduler_state"]["monthly_billing"]["last_period"] == MONTH
+
+
+def test_lease_taken_over_is_marked_lost():
+    async def scenario():
+        store = LocalLeaseStore()
+        async with Lease("billing-2026-09", ttl=0.06, store=store, owner="a") as held:
+            held.check()
+            # A long pause let the lease expire and another worker take it
+            store._leases["billing-2026-09"] = {"owner": "b", "expires_at": time.time() + 30}
+            await asyncio.sleep(0.05)
+            assert held.lost
+            with pytest.raises(LeaseLostError):
+                held.check()
+        assert store._leases["billing-2026-09"]["owner"] == "b"
+
+    asyncio.run(scenario())
+
+
+def test_billing_run_stops_writing_once_its_lease_is_lost(local_db, monkeypatch):
+    product_ids = load_tree(local_db)
+    store = LocalLeaseStore()
+
+    async def scenario():
+        async with Lease(f"billing-{MONTH}", ttl=30, store=store, owner="a") as held:
+            computed = []
+
+            async def slow(product_id, year_month):
+                computed.append(product_id)
+                if len(computed) == 1:
+                    # The lease is lost while the first product is computed
+                    held.lost = True
+                return 1.0
+
+            monkeypatch.setattr(ElectricityUsageService, "compute_total_kwh_for_month", staticmethod(slow))
+            return await run_billing(MONTH, NOW, held)
+
+    assert not asyncio.run(scenario())
+    assert not any(MONTH in bills for bills in local_db.root["electricity_bills"].values())
+    checkpoint = local_db.root["billing_runs"][MONTH]
+    assert checkpoint["status"] == "running"
+    assert not checkpoint.get("products")
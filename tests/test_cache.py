@@ -0,0 +1,32 @@
+from datetime import datetime, timedelta
+
+from app.config import SRI_LANKA_TZ, METER_BUFFER
+from app.db import cache
+from app.db.cache import HistoryCache, approximate_size, estimate_size
+from benchmarks.data import generate_tree
+
+
+def test_approximate_size_is_close_to_json_size():
+    tree = generate_tree(products=1, months=1, now=datetime(2026, 10, 31, 23, 0))
+    month = tree["electricity_usage"]["product0001"]
+    exact = estimate_size(month)
+    assert abs(approximate_size(month) - exact) < exact * 0.25
+
+
+def test_approximate_size_of_small_values_is_exact():
+    value = {"sum": 12.5, "count": 3, "labels": ["00", "01"], "closed": True, "note": None}
+    assert approximate_size(value) == estimate_size(value)
+
+
+def test_entries_of_recently_closed_periods_expire(monkeypatch):
+    now = SRI_LANKA_TZ.localize(datetime(2026, 10, 1, 0, 5))
+    monkeypatch.setattr(cache, "get_current_time", lambda: now)
+    history = HistoryCache(open_ttl=0)
+
+    # Meters may still write into a day that closed minutes ago
+    history.put(("electricity_usage/p1/2026-09-30", "get"), {"23": {}}, SRI_LANKA_TZ.localize(datetime(2026, 10, 1)))
+    assert history.get(("electricity_usage/p1/2026-09-30", "get")) == (False, None)
+
+    settled = now - METER_BUFFER - timedelta(minutes=1)
+    history.put(("electricity_usage/p1/2026-09-23", "get"), {"23": {}}, settled)
+    assert history.get(("electricity_usage/p1/2026-09-23", "get")) == (True, {"23": {}})
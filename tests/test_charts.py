@@ -0,0 +1,67 @@
+from datetime import datetime
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.config import SRI_LANKA_TZ, METER_BUFFER, CHART_CLOSED_MAX_AGE, CHART_OPEN_MAX_AGE
+from app.db.cache import usage_cache
+from app.electricity import charts, rollups
+from app.electricity.rollups import RollupService
+from app.electricity.routes import router
+from benchmarks.data import generate_tree
+
+NOW = SRI_LANKA_TZ.localize(datetime(2026, 10, 1, 0, 5))
+
+
+def chart_client(monkeypatch, now=NOW):
+    monkeypatch.setattr(charts, "get_current_time", lambda: now)
+    monkeypatch.setattr(rollups, "get_current_time", lambda: now)
+    app = FastAPI()
+    app.include_router(router, prefix="/electricity")
+    return TestClient(app)
+
+
+def test_settled_period_chart_is_cached(local_db, monkeypatch):
+    local_db.root = generate_tree(products=1, months=2, density=0.3, now=NOW.replace(tzinfo=None))
+    product_id = next(iter(local_db.root["electricity_usage"]))
+    client = chart_client(monkeypatch, NOW + METER_BUFFER)
+
+    response = client.get(f"/electricity/daily/{product_id}/2026-09")
+    assert response.json()["data_points"]
+    assert response.headers["Cache-Control"] == f"public, max-age={CHART_CLOSED_MAX_AGE}"
+    etag = response.headers["ETag"]
+    assert client.get(f"/electricity/daily/{product_id}/2026-09", headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_late_direct_write_changes_the_etag_until_settled(local_db, monkeypatch):
+    local_db.root = generate_tree(products=1, months=2, density=0.3, now=NOW.replace(tzinfo=None))
+    product_id = next(iter(local_db.root["electricity_usage"]))
+    client = chart_client(monkeypatch)
+
+    response = client.get(f"/electricity/hourly/{product_id}/2026-09-30")
+    assert response.headers["Cache-Control"] == f"public, max-age={CHART_OPEN_MAX_AGE}"
+    etag = response.headers["ETag"]
+
+    # A meter uploads readings it held back straight to the database
+    local_db.root["electricity_usage"][product_id]["2026-09-30"]["23"] = {"58": 5000.0, "59": 5000.0}
+    usage_cache.invalidate()
+    response = client.get(f"/electricity/hourly/{product_id}/2026-09-30", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_error_path_chart_is_not_cached(local_db, monkeypatch):
+    local_db.root = generate_tree(products=1, months=2, density=0.3, now=NOW.replace(tzinfo=None))
+    product_id = next(iter(local_db.root["electricity_usage"]))
+    client = chart_client(monkeypatch)
+
+    async def unavailable(*args, **kwargs):
+        raise TimeoutError("Firebase call timed out")
+
+    monkeypatch.setattr(RollupService, "rollup_days", staticmethod(unavailable))
+    response = client.get(f"/electricity/daily/{product_id}/2026-09")
+    assert response.status_code == 200
+    assert response.json()["chart_title"].startswith("No data available")
+    assert response.headers["Cache-Control"] == "no-store"
+    assert "ETag" not in response.headers
+    assert "Last-Modified" not in response.headers
@@ -0,0 +1,84 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from app.config import SRI_LANKA_TZ, METER_BUFFER_DAYS
+from app.electricity import encoding, ingestion
+from app.electricity.aggregation import is_packed
+from app.electricity.encoding import EncodingMigration
+from app.electricity.ingestion import IngestionService
+from app.electricity.models import MeterReading
+from app.electricity.rollups import summarize_hour
+
+
+def reading(minute: int, value: float) -> MeterReading:
+    return MeterReading(product_id="product0001", timestamp=datetime(2026, 10, 5, 9, minute), value=value)
+
+
+def test_concurrent_batches_for_one_hour_add_up(local_db):
+    # Latency makes both batches read the hour before either writes
+    local_db.latency = 0.02
+
+    async def scenario():
+        await asyncio.gather(
+            IngestionService.ingest([reading(0, 100.0)]),
+            IngestionService.ingest([reading(1, 300.0)]),
+        )
+
+    asyncio.run(scenario())
+
+    usage = local_db.root["electricity_usage"]["product0001"]["2026-10-05"]["09"]
+    live = local_db.root["electricity_live"]["product0001"]
+    raw = summarize_hour(usage)
+    assert raw["watt_hours"] == 200.0
+    assert live["months"]["2026-10"]["watt_hours"] == raw["watt_hours"]
+    assert live["months"]["2026-10"]["readings"] == 2
+    assert live["hours"]["2026-10-05"]["09"]["count"] == 2
+
+
+def test_migration_leaves_days_meters_may_write_alone(local_db, monkeypatch):
+    now = SRI_LANKA_TZ.localize(datetime(2026, 10, 20, 12, 0))
+    monkeypatch.setattr(encoding, "get_current_time", lambda: now)
+    local_db.root = {"electricity_usage": {"product0001": {
+        "2026-10-05": {"09": {"00": 100.0}},
+        "2026-10-15": {"09": {"00": 100.0}},
+    }}}
+
+    with pytest.raises(ValueError):
+        asyncio.run(EncodingMigration.migrate("product0001", min_age_days=METER_BUFFER_DAYS - 1))
+
+    asyncio.run(EncodingMigration.migrate("product0001"))
+    days = local_db.root["electricity_usage"]["product0001"]
+    assert is_packed(days["2026-10-05"]["09"])
+    assert days["2026-10-15"]["09"] == {"00": 100.0}
+
+
+def test_late_readings_hold_back_the_migration(local_db, monkeypatch):
+    now = SRI_LANKA_TZ.localize(datetime(2026, 10, 20, 12, 0))
+    monkeypatch.setattr(encoding, "get_current_time", lambda: now)
+    monkeypatch.setattr(ingestion, "get_current_time", lambda: now)
+
+    # A reading for Oct 5 arriving on Oct 20 is 15 days late
+    asyncio.run(IngestionService.ingest([reading(0, 100.0)]))
+    late_reading = local_db.root["encoding_migrations"]["product0001"]["late_reading"]
+    assert late_reading == {"date": "2026-10-05", "lag_days": 15}
+
+    asyncio.run(EncodingMigration.migrate("product0001"))
+    assert local_db.root["electricity_usage"]["product0001"]["2026-10-05"]["09"] == {"00": 100.0}
+
+    # Allowed at 15 days, which leaves Oct 5 alone; refused below that
+    progress = asyncio.run(EncodingMigration.migrate("product0001", min_age_days=15))
+    assert progress["days"] == 0
+    asyncio.run(EncodingMigration.migrate("product0001", min_age_days=14))
+    assert local_db.root["electricity_usage"]["product0001"]["2026-10-05"]["09"] == {"00": 100.0}
+
+
+def test_late_batch_widens_the_registered_reading_dates(local_db):
+    asyncio.run(IngestionService.ingest([reading(0, 100.0)]))
+    late = MeterReading(product_id="product0001", timestamp=datetime(2026, 10, 2, 9, 0), value=100.0)
+    asyncio.run(IngestionService.ingest([late]))
+
+    record = local_db.root["product_registry"]["product0001"]
+    assert record["first_reading_date"] == "2026-10-02"
+    assert record["last_reading_date"] == "2026-10-05"
@@ -0,0 +1,158 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from app.bill import outbox
+from app.bill.outbox import NotificationOutbox, DEAD, PENDING, SENT
+
+
+class StubReceiver:
+    """Local stand-in for the bill notification API, answering with scripted status codes"""
+
+    def __init__(self):
+        self.statuses = []
+        self.requests = []
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                receiver.requests.append((dict(self.headers), body))
+                status = receiver.statuses.pop(0) if receiver.statuses else 200
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/api/bills/send-notification/"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def receiver():
+    stub = StubReceiver()
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def notifications(tmp_path):
+    return NotificationOutbox(path=str(tmp_path / "outbox.db"), concurrency=4)
+
+
+def drain(notifications: NotificationOutbox):
+    async def scenario():
+        notifications.client = httpx.AsyncClient(timeout=5)
+        try:
+            await notifications.drain()
+        finally:
+            await notifications.client.aclose()
+            notifications.client = None
+
+    asyncio.run(scenario())
+
+
+def row(notifications: NotificationOutbox, key: str):
+    return notifications._execute(
+        "SELECT status, attempts, next_attempt_at, last_error FROM notifications WHERE idempotency_key = ?", (key,)
+    )[0]
+
+
+def make_due(notifications: NotificationOutbox):
+    notifications._execute("UPDATE notifications SET next_attempt_at = 0")
+
+
+def test_notification_is_sent_with_its_idempotency_key(receiver, notifications):
+    assert notifications.enqueue("bill-p1-2026-09", {"product_id": "p1", "amount": 4200.0}, receiver.url)
+    drain(notifications)
+
+    (headers, body), = receiver.requests
+    assert headers["Idempotency-Key"] == "bill-p1-2026-09"
+    assert headers["Content-Type"] == "application/json"
+    assert b'"amount": 4200.0' in body
+    assert row(notifications, "bill-p1-2026-09")[:2] == (SENT, 1)
+
+
+def test_duplicate_enqueue_is_dropped(receiver, notifications):
+    assert notifications.enqueue("bill-p1-2026-09", {"amount": 1.0}, receiver.url)
+    assert not notifications.enqueue("bill-p1-2026-09", {"amount": 2.0}, receiver.url)
+    drain(notifications)
+    assert len(receiver.requests) == 1
+    assert notifications.stats()[SENT] == 1
+
+
+@pytest.mark.parametrize("status_code", [503, 429])
+def test_failed_send_is_retried_with_backoff(receiver, notifications, status_code):
+    receiver.statuses = [status_code]
+    notifications.enqueue("bill-p1-2026-09", {"amount": 1.0}, receiver.url)
+
+    before = time.time()
+    drain(notifications)
+    status, attempts, next_attempt_at, error = row(notifications, "bill-p1-2026-09")
+    assert (status, attempts, error) == (PENDING, 1, f"HTTP {status_code}")
+    # Not retried before its backoff runs out
+    assert before + outbox.OUTBOX_BACKOFF_BASE * 0.5 <= next_attempt_at <= time.time() + outbox.OUTBOX_BACKOFF_BASE
+    assert len(receiver.requests) == 1
+
+    make_due(notifications)
+    drain(notifications)
+    assert len(receiver.requests) == 2
+    assert row(notifications, "bill-p1-2026-09")[:2] == (SENT, 2)
+
+
+def test_client_error_is_dead_lettered(receiver, notifications):
+    receiver.statuses = [400]
+    notifications.enqueue("bill-p1-2026-09", {"amount": 1.0}, receiver.url)
+    drain(notifications)
+
+    assert row(notifications, "bill-p1-2026-09")[:2] == (DEAD, 1)
+    assert [key for key, *_ in notifications.dead_letters()] == ["bill-p1-2026-09"]
+
+
+def test_notification_is_dead_lettered_after_max_attempts(receiver, notifications, monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_MAX_ATTEMPTS", 3)
+    receiver.statuses = [500, 500, 500]
+    notifications.enqueue("bill-p1-2026-09", {"amount": 1.0}, receiver.url)
+
+    for _ in range(3):
+        make_due(notifications)
+        drain(notifications)
+    assert len(receiver.requests) == 3
+    assert row(notifications, "bill-p1-2026-09")[:2] == (DEAD, 3)
+
+    # Dead letters are left alone until they are queued again
+    make_due(notifications)
+    drain(notifications)
+    assert len(receiver.requests) == 3
+
+    assert notifications.retry_dead() == 1
+    drain(notifications)
+    assert len(receiver.requests) == 4
+    assert row(notifications, "bill-p1-2026-09")[:2] == (SENT, 1)
+
+
+def test_expired_claim_is_sent_again(receiver, notifications):
+    notifications.enqueue("bill-p1-2026-09", {"amount": 1.0}, receiver.url)
+
+    # A worker claims it and dies before sending
+    assert len(notifications.claim(1)) == 1
+    drain(notifications)
+    assert receiver.requests == []
+
+    # Once the claim expires another worker picks it up
+    notifications._execute("UPDATE notifications SET next_attempt_at = ?", (time.time() - 1,))
+    drain(notifications)
+    assert len(receiver.requests) == 1
+    assert row(notifications, "bill-p1-2026-09")[0] == SENT
@@ -0,0 +1,49 @@
+import asyncio
+from datetime import datetime
+
+from app.config import SRI_LANKA_TZ
+from app.db.cache import usage_cache
+from app.electricity import archive, rollups
+from app.electricity.rollups import RollupService
+from app.electricity.service import ElectricityUsageService
+
+
+def set_now(monkeypatch, moment):
+    monkeypatch.setattr(rollups, "get_current_time", lambda: SRI_LANKA_TZ.localize(moment))
+
+
+def test_late_direct_writes_reach_unsettled_rollups(local_db, monkeypatch):
+    set_now(monkeypatch, datetime(2026, 10, 1, 0, 0, 5))
+    local_db.root = {"electricity_usage": {"p1": {"2026-09-30": {"22": {"00": 1000.0}}}}}
+    assert asyncio.run(ElectricityUsageService.compute_total_kwh_for_month("p1", "2026-09")) == 1.0
+
+    # A meter uploads the last hour it held back straight to the database
+    local_db.root["electricity_usage"]["p1"]["2026-09-30"]["23"] = {"00": 1000.0}
+    usage_cache.invalidate()
+    assert asyncio.run(ElectricityUsageService.compute_total_kwh_for_month("p1", "2026-09")) == 2.0
+    chart = asyncio.run(ElectricityUsageService.get_daily_usage("p1", "2026-09"))
+    assert chart.values == [1000.0]
+    assert "electricity_rollups" not in local_db.root or "monthly" not in local_db.root["electricity_rollups"]["p1"]
+
+
+def test_settled_month_rollup_is_stored(local_db, monkeypatch):
+    set_now(monkeypatch, datetime(2026, 10, 8, 0, 0, 5))
+    local_db.root = {"electricity_usage": {"p1": {"2026-09-30": {"22": {"00": 1000.0}}}}}
+    assert asyncio.run(ElectricityUsageService.compute_total_kwh_for_month("p1", "2026-09")) == 1.0
+    assert local_db.root["electricity_rollups"]["p1"]["monthly"]["2026"]["09"]["watt_hours"] == 1000.0
+    assert RollupService.is_settled_day("2026-09-30")
+    assert not RollupService.is_settled_day("2026-10-01")
+
+
+def test_months_meters_may_still_write_to_are_not_archived(local_db, monkeypatch, tmp_path):
+    set_now(monkeypatch, datetime(2026, 10, 3, 12, 0))
+    monkeypatch.setattr(rollups, "ARCHIVE_PATH", str(tmp_path))
+    monkeypatch.setattr(archive, "ARCHIVE_PATH", str(tmp_path))
+    local_db.root = {"electricity_usage": {"p1": {
+        "2026-08-31": {"22": {"00": 1000.0}},
+        "2026-09-30": {"22": {"00": 1000.0}},
+    }}}
+
+    assert asyncio.run(RollupService.archive("p1", "2026-08", "2026-09")) == 1
+    assert (tmp_path / "p1" / "2026-08.bin").exists()
+    assert not (tmp_path / "p1" / "2026-09.bin").exists()
@@ -0,0 +1,50 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from app.config import SRI_LANKA_TZ
+from app.db.cache import usage_cache
+from app.db.firebase import round_trips
+from app.electricity import rollups
+from app.electricity.service import ElectricityUsageService
+from benchmarks.data import generate_tree
+
+# September and October 2026 have settled, November is in progress
+NOW = SRI_LANKA_TZ.localize(datetime(2026, 11, 15, 12, 0))
+
+
+@pytest.fixture
+def product_id(local_db, monkeypatch):
+    monkeypatch.setattr(rollups, "get_current_time", lambda: NOW)
+    local_db.root = generate_tree(products=1, months=3, density=0.3, now=NOW.replace(tzinfo=None))
+    return next(iter(local_db.root["electricity_usage"]))
+
+
+def count_round_trips(coroutine) -> int:
+    """Round trips a call makes with nothing cached in memory"""
+    usage_cache.invalidate()
+    round_trips.reset()
+    asyncio.run(coroutine)
+    return round_trips.count
+
+
+def test_daily_chart_round_trips(product_id):
+    # Daily rollups, one range read of the raw month, and the write of its rollups
+    assert count_round_trips(ElectricityUsageService.get_daily_usage(product_id, "2026-09")) == 3
+    # Then the stored rollups only
+    assert count_round_trips(ElectricityUsageService.get_daily_usage(product_id, "2026-09")) == 1
+
+
+def test_monthly_chart_round_trips(product_id):
+    # Monthly rollups, then daily rollups and a raw range read for each month.
+    # The settled days of 11 months (up to Nov 7) and 10 settled months are written
+    assert count_round_trips(ElectricityUsageService.get_monthly_usage(product_id, "2026")) == 1 + 12 * 2 + 11 + 10
+    # Then only the months that haven't settled are read again
+    assert count_round_trips(ElectricityUsageService.get_monthly_usage(product_id, "2026")) == 1 + 2 * 2
+
+
+def test_month_kwh_round_trips(product_id):
+    # Monthly rollups, daily rollups, a raw range read, and the day and month rollup writes
+    assert count_round_trips(ElectricityUsageService.compute_total_kwh_for_month(product_id, "2026-09")) == 5
+    assert count_round_trips(ElectricityUsageService.compute_total_kwh_for_month(product_id, "2026-09")) == 1
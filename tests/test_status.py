@@ -0,0 +1,37 @@
+import time
+
+from app.electricity.status import ConnectionStatusTable
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_quiet_listener_stays_live(local_db):
+    local_db.root = {"connection_status": {"product0001": True}}
+    table = ConnectionStatusTable(max_age=0.05)
+    table.start()
+    try:
+        assert wait_for(table.is_live)
+        assert table.lookup("product0001") is True
+        # No change (and, like Firebase, no keep-alive) for longer than max_age
+        time.sleep(0.2)
+        assert table.is_live()
+    finally:
+        table.stop()
+
+
+def test_listener_whose_stream_ended_is_not_live(local_db):
+    local_db.root = {"connection_status": {"product0001": True}}
+    table = ConnectionStatusTable(max_age=0.05)
+    table.start()
+    try:
+        assert wait_for(table.is_live)
+        # The stream fails for good: its thread ends without close()
+        table._registration._closed.set()
+        assert wait_for(lambda: not table.is_live())
+    finally:
+        table.stop()